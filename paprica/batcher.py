@@ -232,6 +232,29 @@ class multiChannelAcquisition():
             imsave(os.path.join(tiles.path, '3D_reconstruction.tif'), merger.merged_data)
 
 
+    def export_pyramid_all_channels(self,
+                                    downsample=(2, 4, 8, 16)):
+        """
+        Export all channels as multiscale pyramids (OME-Zarr layout) in a single pass over the tiles. Pyramids are
+        saved in the same folder as the APR data.
+
+        Parameters
+        ----------
+        downsample: array_like
+            downsample factors of each pyramid level.
+
+        Returns
+        -------
+        None
+        """
+
+        if self.tiles_list_apr is None:
+            raise TypeError('Error: APR data not available, convert data before reconstruction.')
+
+        for tiles in self.tiles_list_apr:
+            merger = paprica.stitcher.tileMerger(tiles, self.database)
+            merger.export_pyramid(os.path.join(tiles.path, 'pyramid.zarr'), downsample=downsample)
+
     def _get_tiles_list(self):
         """
         Function to get the list of tiles (one tileParser object for each channel) for raw, APR or both.
@@ -7,7 +7,14 @@ By using this code you agree to the terms of the software license agreement.
 © Copyright 2020 Wyss Center for Bio and Neuro Engineering – All rights reserved
 """
 
+import copy
+import functools
+import hashlib
+import inspect
+import json
 import os
+import tempfile
+import warnings
 from time import time
 
 import cv2 as cv
@@ -16,28 +23,39 @@ import numpy as np
 import pandas as pd
 import pyapr
 import sparse
-from joblib import load
+from joblib import load, dump, Parallel, delayed
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 
 import paprica
 
 
-def _predict_on_APR_block(x, clf, n_parts=1e7, output='class', verbose=False):
+# Classifiers loaded in each worker process, indexed by their path (see _segment_tile_worker).
+_worker_classifiers = {}
+
+
+def _predict_on_APR_block(x, clf, n_parts=None, output='class', verbose=False, n_jobs=None, max_memory=1e9):
     """
-    Predict particle class with the trained classifier clf on the precomputed features f using a
-    blocked strategy to avoid memory segfault.
+    Predict particle class with the trained classifier clf on the precomputed features f by chunks of consecutive
+    particles to avoid memory segfault. Predictions are written chunk by chunk directly in the output particle arrays.
 
     Parameters
     ----------
     x: ndarray
         features (n_particle, n_features) for particle prediction
     n_parts: int
-        number of particles in the batch to predict
+        number of particles in the batch to predict (default: computed from max_memory)
     output: string
         output type, can be 'class' where each particle get assigned a class or 'proba' where each
         particle get assigned a probability of belonging to each class.
     verbose: bool
         control function verbosity
+    n_jobs: int
+        number of jobs used by the classifier (-1 uses all the cores, None keeps the classifier setting). The
+        classifier parameters are restored after the prediction.
+    max_memory: float
+        approximate memory budget in bytes for the temporary arrays of each block when n_parts is not given. Blocks
+        are chunks of consecutive particles: this bounds the prediction memory, not the memory of x.
 
     Returns
     -------
@@ -49,33 +67,45 @@ def _predict_on_APR_block(x, clf, n_parts=1e7, output='class', verbose=False):
     if verbose:
         t = time()
 
-    n_block = int(np.ceil(x.shape[0] / n_parts))
+    if output not in ['class', 'proba']:
+        raise ValueError('Unknown output \'{}\' for APR block prediction.'.format(output))
+
+    n_classes = len(clf.classes_)
+    if n_parts is None:
+        # Features are copied (scaling) and converted to float32 by the forest, probabilities are float64
+        bytes_per_particle = x.shape[1] * (x.itemsize + 8 + 4) + 2 * n_classes * 8
+        n_parts = max(int(max_memory // bytes_per_particle), 1)
     if int(n_parts) != n_parts:
         raise ValueError('Error: n_parts must be an int.')
     n_parts = int(n_parts)
-    clf[1].set_params(n_jobs=-1)
-
-    if output == 'class':
-        y_pred = np.empty((x.shape[0]))
-        for i in tqdm(range(n_block), desc='Predicting particle type'):
-            y_pred[i * n_parts:min((i + 1) * n_parts, x.shape[0])] = clf.predict(
-                x[i * n_parts:min((i + 1) * n_parts, x.shape[0])])
-        # Transform numpy array to ParticleData
-        parts_pred = pyapr.ShortParticles(y_pred.astype('uint16'))
-
-    elif output == 'proba':
-        y_pred = np.empty((x.shape[0], len(clf.classes_)))
-        for i in tqdm(range(n_block), desc='Predicting particle type'):
-            y_pred[i * n_parts:min((i + 1) * n_parts, x.shape[0]), :] = clf.predict_proba(
-                x[i * n_parts:min((i + 1) * n_parts, x.shape[0])])
-        # Transform numpy array to ParticleData
-        parts_pred = []
-        for i in range(len(clf.classes_)):
-            parts_pred.append(pyapr.ShortParticles(
-                                                   (y_pred[:, i]*(2**16-1))
-                                                    .astype('uint16')))
+    n_block = int(np.ceil(x.shape[0] / n_parts))
+
+    # Number of jobs is set on the estimator and restored afterwards
+    estimator = clf[-1] if hasattr(clf, 'steps') else clf
+    if n_jobs is not None and hasattr(estimator, 'get_params') and 'n_jobs' in estimator.get_params():
+        n_jobs_init = estimator.get_params()['n_jobs']
+        estimator.set_params(n_jobs=n_jobs)
     else:
-        raise ValueError('Unknown output \'{}\' for APR block prediction.'.format(output))
+        estimator = None
+
+    try:
+        if output == 'class':
+            parts_pred = pyapr.ShortParticles(x.shape[0])
+            y_pred = np.array(parts_pred, copy=False)
+            for i in tqdm(range(n_block), desc='Predicting particle type'):
+                y_pred[i * n_parts:min((i + 1) * n_parts, x.shape[0])] = clf.predict(
+                    x[i * n_parts:min((i + 1) * n_parts, x.shape[0])])
+
+        else:
+            parts_pred = [pyapr.ShortParticles(x.shape[0]) for i in range(n_classes)]
+            y_pred = [np.array(p, copy=False) for p in parts_pred]
+            for i in tqdm(range(n_block), desc='Predicting particle type'):
+                proba = clf.predict_proba(x[i * n_parts:min((i + 1) * n_parts, x.shape[0])]).astype('float32')
+                for j in range(n_classes):
+                    y_pred[j][i * n_parts:min((i + 1) * n_parts, x.shape[0])] = proba[:, j] * (2**16-1)
+    finally:
+        if estimator is not None:
+            estimator.set_params(n_jobs=n_jobs_init)
 
     if verbose:
         print('Blocked prediction took {:0.3f} s.\n'.format(time() - t))
@@ -84,6 +114,330 @@ def _predict_on_APR_block(x, clf, n_parts=1e7, output='class', verbose=False):
     return parts_pred
 
 
+def _segment_tile_worker(segmenter, clf_path, tile, save_cc, save_mask, lazy_loading, n_jobs=1):
+    """
+    Segment a tile in a worker process and return the centers of the objects that are not on the tile edges.
+    The classifier is loaded from clf_path only once per worker process.
+
+    Parameters
+    ----------
+    segmenter: multitileSegmenter
+        segmenter used to segment the tile (without its classifier)
+    clf_path: string
+        path to the classifier
+    tile: tileLoader
+        tile to segment
+    save_cc: bool
+        option to save the connected component particle to file
+    save_mask: bool
+        option to save the prediction mask to file
+    lazy_loading: bool
+        option to save the tree particles to allow for lazy loading later on
+    n_jobs: int
+        number of jobs used by the classifier in the worker
+
+    Returns
+    -------
+    cells: ndarray
+        objects center in the tile coordinates
+    shape: ndarray
+        tile shape
+    """
+
+    if clf_path not in _worker_classifiers:
+        _worker_classifiers[clf_path] = load(clf_path)
+    segmenter.clf = _worker_classifiers[clf_path]
+
+    tile = segmenter._segment_tile(tile, save_cc=save_cc, save_mask=save_mask, lazy_loading=lazy_loading,
+                                   n_jobs=n_jobs)
+    segmenter.filtered_APR = None
+
+    # Remove objects on the edge
+    pyapr.morphology.remove_edge_objects(tile.apr, tile.parts_cc, z_edges=False)
+
+    return pyapr.measure.find_label_centers(tile.apr, tile.parts_cc, tile.parts), np.array(tile.apr.shape())
+
+
+def _hash_function(func, version=None):
+    """
+    Compute a hash of a feature function from its source code (and the parameters of a featureBank or of a
+    functools.partial). Helper functions or global values used by func are not hashed: `version` must be changed
+    when they are modified so that the cached features are recomputed.
+
+    Parameters
+    ----------
+    func: func
+        function to hash
+    version: any
+        version of the feature function (its repr is hashed)
+
+    Returns
+    -------
+    _: string
+        hexadecimal hash, or None if the source code of func is not available.
+    """
+
+    h = hashlib.sha1()
+    h.update(repr(version).encode())
+    try:
+        if isinstance(func, featureBank):
+            h.update(inspect.getsource(featureBank).encode())
+            h.update(repr(func.features).encode())
+        elif isinstance(func, functools.partial):
+            h.update(inspect.getsource(func.func).encode())
+            h.update(repr((func.args, sorted(func.keywords.items()))).encode())
+        else:
+            h.update(inspect.getsource(func).encode())
+    except (OSError, TypeError):
+        return None
+    return h.hexdigest()
+
+
+def _hash_tile(apr, parts):
+    """
+    Compute a hash of the content of a tile: the APR structure (dimensions and level of each particle) and the
+    particle values.
+
+    Parameters
+    ----------
+    apr: APR
+        APR structure
+    parts: ParticleData
+        particle values
+
+    Returns
+    -------
+    _: string
+        hexadecimal hash
+    """
+
+    h = hashlib.sha1()
+    h.update(repr((apr.org_dims(0), apr.org_dims(1), apr.org_dims(2), apr.level_min(), apr.level_max(),
+                   apr.total_number_particles())).encode())
+    levels = pyapr.ShortParticles(apr.total_number_particles())
+    levels.fill_with_levels(apr)
+    h.update(np.asarray(levels).tobytes())
+    h.update(np.asarray(parts).tobytes())
+    return h.hexdigest()
+
+
+def _compute_features(tile, func_to_compute_features, cache=False, cache_folder=None, out_of_core=False,
+                      out_of_core_folder=None, cache_version=None):
+    """
+    Compute the features on a tile, or load them from the feature cache if they were already computed with the
+    same function on the same tile content. Cached features are stored as .npy files named after the tile and a
+    hash of the feature function source code, of cache_version and of the tile content (APR structure and
+    particles), so that other particles written to the same file (e.g. the segmentation) don't invalidate the
+    cache. If the source code of the function is not available, a warning is raised and the cache is not used.
+
+    When func_to_compute_features is a featureBank, features are written directly in a memory mapped file (the cache
+    file or a temporary file if out_of_core is True) so that the feature array never needs to fit in memory. Other
+    functions return the full feature array in memory (a warning is raised if out_of_core is True).
+
+    Parameters
+    ----------
+    tile: tileLoader
+        tile on which the features are computed (must be loaded)
+    func_to_compute_features: func
+        function to compute the features on ParticleData
+    cache: bool
+        option to use the feature cache
+    cache_folder: string
+        folder containing the cached features (default: 'features' folder next to the tile)
+    out_of_core: bool
+        option to store the features in a temporary file instead of memory (only for featureBank)
+    out_of_core_folder: string
+        folder for the temporary file (default: system temporary folder)
+    cache_version: any
+        version of the feature function, to be changed when the functions or values it uses are modified
+
+    Returns
+    -------
+    f: ndarray
+        features (n_particle, n_features)
+    """
+
+    streamed = isinstance(func_to_compute_features, featureBank)
+    shape = (tile.apr.total_number_particles(), func_to_compute_features.n_features) if streamed else None
+
+    if out_of_core and not streamed:
+        warnings.warn('Out of core features require a featureBank, features are computed in memory.')
+
+    key = None
+    if cache and tile.path is not None:
+        key = _hash_function(func_to_compute_features, cache_version)
+        if key is None:
+            warnings.warn('Feature function source code is not available, the feature cache is not used.')
+        else:
+            key = hashlib.sha1((key + _hash_tile(tile.apr, tile.parts)).encode()).hexdigest()
+
+    if key is None:
+        if out_of_core and streamed:
+            # The temporary file is deleted as soon as the array is released
+            f = np.memmap(tempfile.TemporaryFile(dir=out_of_core_folder), dtype=np.float32, mode='w+', shape=shape)
+            return func_to_compute_features(tile.apr, tile.parts, out=f)
+        return func_to_compute_features(tile.apr, tile.parts)
+
+    if cache_folder is None:
+        cache_folder = os.path.join(os.path.dirname(os.path.abspath(tile.path)), 'features')
+    path = os.path.join(cache_folder, '{}_{}.npy'.format(os.path.splitext(os.path.basename(tile.path))[0], key))
+
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+
+    os.makedirs(cache_folder, exist_ok=True)
+    if streamed:
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        f = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+        func_to_compute_features(tile.apr, tile.parts, out=f)
+        f.flush()
+        del f
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    f = func_to_compute_features(tile.apr, tile.parts)
+    np.save(path, f)
+    return f
+
+
+def _atomic_write(path, write):
+    """
+    Write a file atomically by writing to a temporary file which then replaces the destination.
+
+    Parameters
+    ----------
+    path: string
+        path of the file to write
+    write: func
+        function writing the content to an opened binary file
+
+    Returns
+    -------
+    None
+    """
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _match_cells(c1, c2, lowe_ratio=0.7, distance_max=5, mutual=True):
+    """
+    Match cells between two sets using a k-d tree. A cell of c1 is matched to its nearest neighbor in c2 if it is
+    closer than distance_max, if it passes the Lowe ratio test (nearest neighbor distance < lowe_ratio * second
+    nearest neighbor distance) and, optionally, if it is also the nearest neighbor of its match in c1.
+
+    Parameters
+    ----------
+    c1: ndarray
+        array containing the first set cells coordinates
+    c2: ndarray
+        array containing the second set cells coordinates
+    lowe_ratio: float
+        ratio of the second nearest neighbor distance / nearest neighbor distance above lowe_ratio, the cell is
+        supposed to be unique. Below lowe_ratio, it might have a second detection on the neighboring tile.
+    distance_max: float
+        maximum distance in pixel for two cells to be considered the same.
+    mutual: bool
+        option to keep only mutual nearest neighbors
+
+    Returns
+    -------
+    ind1, ind2: ndarray
+        indices of the matched cells in c1 and c2
+    """
+
+    if lowe_ratio < 0 or lowe_ratio > 1:
+        raise ValueError('Lowe ratio is {}, expected between 0 and 1.'.format(lowe_ratio))
+
+    if c1.shape[0] == 0 or c2.shape[0] == 0:
+        return np.array([], dtype='int64'), np.array([], dtype='int64')
+
+    d, ind = cKDTree(c2).query(c1, k=2)
+    good = (d[:, 0] < lowe_ratio * d[:, 1]) & (d[:, 0] < distance_max)
+    ind1 = np.where(good)[0]
+    ind2 = ind[good, 0]
+
+    if mutual:
+        _, nn = cKDTree(c1).query(c2[ind2], k=1)
+        is_mutual = nn == ind1
+        ind1, ind2 = ind1[is_mutual], ind2[is_mutual]
+
+    return ind1, ind2
+
+
+def _hash_priority(idx, seed=0):
+    """
+    Compute a pseudo-random priority in [0, 1) for each particle index using a hash function (splitmix64), so that
+    the priority of a particle does not depend on the other particles or on the order in which they were labelled.
+
+    Parameters
+    ----------
+    idx: ndarray
+        particle indices
+    seed: int
+        seed of the hash function
+
+    Returns
+    -------
+    _: ndarray
+        priority of each particle
+    """
+
+    z = np.asarray(idx).astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+    with np.errstate(over='ignore'):
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / 2**53
+
+
+def _sample_stratified(priority, strata, budget):
+    """
+    Select at most budget samples, balanced between strata: each stratum gets the same number of samples (the
+    budget unused by small strata is shared between the others) and the samples with the lowest priority are
+    selected in each stratum. With hash based priorities, this is a reservoir sample: adding samples only replaces
+    selected ones with new samples of lower priority.
+
+    Parameters
+    ----------
+    priority: ndarray
+        priority of each sample
+    strata: ndarray
+        stratum of each sample
+    budget: int
+        maximum number of samples
+
+    Returns
+    -------
+    _: ndarray
+        sorted indices of the selected samples
+    """
+
+    if priority.size <= budget:
+        return np.arange(priority.size)
+
+    _, inv, sizes = np.unique(strata, return_inverse=True, return_counts=True)
+    inv = inv.ravel()
+
+    # Water filling allocation of the budget between strata
+    quota = np.zeros(sizes.size, dtype='int64')
+    remaining = budget
+    for i, n in enumerate(np.argsort(sizes, kind='stable')):
+        quota[n] = min(sizes[n], remaining // (sizes.size - i))
+        remaining -= quota[n]
+
+    # Rank of each sample in its stratum by increasing priority
+    order = np.lexsort((priority, inv))
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    rank = np.empty(priority.size, dtype='int64')
+    rank[order] = np.arange(priority.size) - np.repeat(starts, sizes)
+
+    return np.flatnonzero(rank < quota[inv])
+
+
 def map_feature(apr, parts_cc, features):
     """
     Map feature values to segmented particle data.
@@ -99,28 +453,106 @@ def map_feature(apr, parts_cc, features):
 
     Returns
     -------
-    Array of mapped values (each particle in the connected component now has the value present in features)
+    Mapped particles (each particle in the connected component now has the value present in features). Particles are
+    ShortParticles for integer features and FloatParticles otherwise.
     """
 
     objects_volume = pyapr.measure.find_label_volume(apr, parts_cc)
-    hash_idx = np.arange(0, len(objects_volume))
-    # Object with volume 0 are not in CC so we need to get rid of them
-    hash_idx = hash_idx[objects_volume > 0]
-    # We also need to get rid of the background
-    hash_idx = hash_idx[1:]
+    # Object with volume 0 are not in CC so we need to get rid of them, and also of the background
+    objects = np.flatnonzero(objects_volume)
+    objects = objects[objects > 0]
 
-    if len(hash_idx) != len(features):
+    features = np.asarray(features)
+    if len(objects) != len(features):
         raise ValueError('Error: features length ({}) should be the same as the number of connected components ({}).'
-                         .format(len(features), len(hash_idx)))
+                         .format(len(features), len(objects)))
+
+    if np.issubdtype(features.dtype, np.integer) or features.dtype == bool:
+        if features.size > 0 and (features.min() < 0 or features.max() > np.iinfo(np.uint16).max):
+            raise ValueError('Error: integer features should be in [0, {}].'.format(np.iinfo(np.uint16).max))
+        mapped = pyapr.ShortParticles(apr.total_number_particles())
+    else:
+        mapped = pyapr.FloatParticles(apr.total_number_particles())
+    out = np.array(mapped, copy=False)
 
-    # Create hash dict
-    hash_dict = {x: y for x, y in zip(hash_idx, features)}
-    # Replace 0 by 0
-    hash_dict[0] = 0
+    # Lookup table from label to feature value (background is mapped to 0), painting is a single gather
+    lut = np.zeros(len(objects_volume), dtype=out.dtype)
+    lut[objects] = features
+    np.take(lut, np.array(parts_cc, copy=False), out=out)
 
-    mp = np.arange(0, parts_cc.max() + 1)
-    mp[list(hash_dict.keys())] = list(hash_dict.values())
-    return mp[np.array(parts_cc, copy=False)]
+    return mapped
+
+
+def measure_objects(apr, parts_cc, parts):
+    """
+    Compute per-object measurements in one pass over the particles: centroid, volume, mean and max intensity,
+    bounding box and particle level statistics. Reductions are computed with bincount on the foreground particles,
+    intensities being weighted by the particle volume.
+
+    Parameters
+    ----------
+    apr: pyapr.APR
+        apr object
+    parts_cc: pyapr.ParticleData
+        connected component particle array corresponding to apr
+    parts: pyapr.ParticleData
+        intensity particle array corresponding to apr
+
+    Returns
+    -------
+    _: pd.DataFrame
+        measurement table with one row per object (coordinates are in pixels in the tile frame).
+    """
+
+    labels = np.array(parts_cc, copy=False)
+    fg = np.flatnonzero(labels)
+    labels = labels[fg].astype(np.intp)
+    intensity = np.array(parts, copy=False)[fg].astype(np.float64)
+
+    lvls = pyapr.ShortParticles(apr.total_number_particles())
+    lvls.fill_with_levels(apr)
+    lvls = np.array(lvls, copy=False)[fg]
+    weights = (2.0 ** (apr.level_max() - lvls)) ** 3
+
+    n = labels.max() + 1 if labels.size > 0 else 1
+    n_particles = np.bincount(labels, minlength=n)
+    weights_sum = np.bincount(labels, weights=weights, minlength=n)
+    mean_intensity = np.bincount(labels, weights=weights*intensity, minlength=n)
+    mean_level = np.bincount(labels, weights=lvls, minlength=n)
+
+    # Min/max reductions on particles sorted by label
+    objects = np.flatnonzero(n_particles)
+    objects = objects[objects > 0]
+    order = np.argsort(labels, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(n_particles[objects])[:-1]))
+    if objects.size > 0:
+        max_intensity = np.maximum.reduceat(intensity[order], starts)
+        min_level = np.minimum.reduceat(lvls[order], starts)
+        max_level = np.maximum.reduceat(lvls[order], starts)
+    else:
+        max_intensity = min_level = max_level = np.empty(0)
+
+    centers = pyapr.measure.find_label_centers(apr, parts_cc)[objects]
+    volume = pyapr.measure.find_label_volume(apr, parts_cc)[objects]
+    min_coords, max_coords = pyapr.measure.find_objects(apr, parts_cc)
+
+    return pd.DataFrame({'label': objects,
+                         'z': centers[:, 0],
+                         'y': centers[:, 1],
+                         'x': centers[:, 2],
+                         'volume': volume,
+                         'mean_intensity': mean_intensity[objects] / weights_sum[objects],
+                         'max_intensity': max_intensity,
+                         'bbox_z0': min_coords[objects, 0],
+                         'bbox_y0': min_coords[objects, 1],
+                         'bbox_x0': min_coords[objects, 2],
+                         'bbox_z1': max_coords[objects, 0],
+                         'bbox_y1': max_coords[objects, 1],
+                         'bbox_x1': max_coords[objects, 2],
+                         'n_particles': n_particles[objects],
+                         'min_level': min_level,
+                         'max_level': max_level,
+                         'mean_level': mean_level[objects] / n_particles[objects]})
 
 
 def compute_gradients(apr, parts):
@@ -229,7 +661,570 @@ def particle_levels(apr):
     return 2 ** (lvls.max() - lvls)
 
 
-class tileSegmenter():
+def compute_tree_features(apr, parts, num_levels=(1, 2, 3), tree_parts=None):
+    """
+    Compute multi-scale features by sampling the APR tree average values back onto the particles. For a given
+    num_levels, each particle takes the average value of its ancestor at level (level_max - num_levels), or of its
+    parent if the particle is coarser, which gives context at a scale of 2**num_levels pixels at near linear cost.
+
+    Parameters
+    ----------
+    apr: pyapr.APR
+        apr object
+    parts: pyapr.ParticleData
+        particle data sampled on APR
+    num_levels: tuple
+        number of levels to go up in the tree for each feature
+    tree_parts: pyapr.FloatParticles
+        tree particles filled with the average values (computed if None)
+
+    Returns
+    -------
+    _: ndarray
+        multi-scale features (n_particles, len(num_levels))
+    """
+
+    if not isinstance(parts, pyapr.FloatParticles):
+        parts = pyapr.FloatParticles(np.array(parts, copy=False).astype(np.float32))
+    if tree_parts is None:
+        tree_parts = pyapr.tree.fill_tree_mean(apr, parts, output=pyapr.FloatParticles())
+
+    f = np.empty((apr.total_number_particles(), len(num_levels)), dtype=np.float32)
+    for i, n in enumerate(num_levels):
+        f[:, i] = np.array(pyapr.tree.sample_from_tree(apr, parts, tree_parts, num_levels=n), copy=False)
+
+    return f
+
+
+class featureBank():
+    """
+    Declarative feature bank to be used as func_to_compute_features. The features are listed by name and the
+    intermediate results they share (Gaussian blurs and gradients) are computed only once, each feature being written
+    directly in a preallocated float32 (n_particles, n_features) array. Features are computed on the whole APR at
+    once (there is no spatial blocking), the output array can be memory mapped (see _compute_features()).
+
+    Available features are:
+        - 'intensity': particle intensity
+        - 'levels': particle size in pixel (see particle_levels())
+        - ('gaussian', sigma): Gaussian blur
+        - ('dog', sigma1, sigma2): difference of Gaussians (blur with sigma2 - blur with sigma1)
+        - 'gradients' or ('gradients', sigma): gradient in each direction (3 features)
+        - 'gradmag' or ('gradmag', sigma): gradient magnitude
+        - 'laplacian' or ('laplacian', sigma): Laplacian
+        - ('tree', num_levels): tree average num_levels above the finest level (see compute_tree_features())
+
+    where sigma is the standard deviation of the Gaussian blur applied before computing the feature (no blur if
+    omitted).
+
+    Example
+    -------
+    >>> bank = featureBank(['intensity', 'levels', ('gaussian', 1.5), ('gradmag', 1.5), ('laplacian', 1.5),
+    >>>                     ('dog', 1.5, 3), ('tree', 2), ('tree', 3)])
+    >>> trainer = tileTrainer(tile, func_to_compute_features=bank, func_to_get_cc=get_cc)
+    """
+
+    _n_params = {'intensity': (0,), 'levels': (0,), 'gaussian': (1,), 'dog': (2,),
+                 'gradients': (0, 1), 'gradmag': (0, 1), 'laplacian': (0, 1), 'tree': (1,)}
+
+    def __init__(self, features):
+        """
+
+        Parameters
+        ----------
+        features: list
+            list of features to compute, each feature being a name or a tuple (name, parameters).
+        """
+
+        self.features = []
+        for feature in features:
+            feature = (feature,) if isinstance(feature, str) else tuple(feature)
+            name, params = feature[0], feature[1:]
+            if name not in self._n_params:
+                raise ValueError('Error: unknown feature \'{}\'.'.format(name))
+            if len(params) not in self._n_params[name]:
+                raise ValueError('Error: wrong number of parameters for feature \'{}\'.'.format(name))
+            self.features.append((name,) + params)
+
+        self.names = []
+        for feature in self.features:
+            name = '_'.join(str(x) for x in feature)
+            if feature[0] == 'gradients':
+                self.names += [name + '_' + d for d in ['dz', 'dx', 'dy']]
+            else:
+                self.names.append(name)
+        self.n_features = len(self.names)
+
+        # Intermediate results needed by each feature, so that they can be freed after their last use
+        grads = set(('grad', self._sigma(f)) for f in self.features if f[0] in ['gradients', 'laplacian'])
+        self.requirements = []
+        for feature in self.features:
+            name = feature[0]
+            if name in ['gaussian', 'dog']:
+                req = [('smooth', sigma) for sigma in feature[1:]]
+            elif name in ['gradients', 'laplacian']:
+                req = [('grad', self._sigma(feature))]
+            elif name == 'gradmag':
+                # Gradient magnitude is computed from the gradients only if they are needed anyway
+                key = ('grad', self._sigma(feature))
+                req = [key] if key in grads else [('smooth', self._sigma(feature))]
+            elif name == 'tree':
+                # Tree is filled once and shared by all the scales
+                req = [('tree', None)]
+            else:
+                req = []
+            self.requirements.append(req)
+
+    def __repr__(self):
+        return 'featureBank({})'.format(self.features)
+
+    def __call__(self, apr, parts, out=None):
+        """
+        Compute the features.
+
+        Parameters
+        ----------
+        apr: pyapr.APR
+            apr object
+        parts: pyapr.ParticleData
+            particle data sampled on APR
+        out: ndarray
+            (n_particles, n_features) array in which the features are written. If None, a new float32 array is
+            allocated.
+
+        Returns
+        -------
+        out: ndarray
+            computed features (n_particles, n_features)
+        """
+
+        n_parts = apr.total_number_particles()
+        if out is None:
+            out = np.empty((n_parts, self.n_features), dtype=np.float32)
+        elif out.shape != (n_parts, self.n_features):
+            raise ValueError('Error: out should be of shape {}, got {}.'.format((n_parts, self.n_features), out.shape))
+
+        # Number of remaining uses of each intermediate result
+        uses = {}
+        for req in self.requirements:
+            for key in req:
+                uses[key] = uses.get(key, 0) + 1
+        for key in list(uses):
+            if key[0] == 'grad':
+                uses[('smooth', key[1])] = uses.get(('smooth', key[1]), 0) + 1
+
+        par = apr.get_parameters()
+        cache = {}
+        tmp = pyapr.FloatParticles()
+
+        def release(key):
+            uses[key] -= 1
+            if uses[key] == 0:
+                cache.pop(key, None)
+                if key[0] == 'grad':
+                    release(('smooth', key[1]))
+
+        def get(key):
+            if key not in cache:
+                kind, sigma = key
+                if kind == 'tree':
+                    float_parts = pyapr.FloatParticles(np.array(parts, copy=False).astype(np.float32))
+                    cache[key] = (float_parts, pyapr.tree.fill_tree_mean(apr, float_parts,
+                                                                         output=pyapr.FloatParticles()))
+                elif kind == 'smooth':
+                    if sigma is None:
+                        cache[key] = parts
+                    else:
+                        size = int(2 * np.round(3.5 * sigma) + 1)
+                        cache[key] = gaussian_blur(apr, parts, sigma=sigma, size=size)
+                else:
+                    cache[key] = compute_gradients(apr, get(('smooth', sigma)))
+            return cache[key]
+
+        j = 0
+        for feature, req in zip(self.features, self.requirements):
+            name = feature[0]
+            if name == 'intensity':
+                out[:, j] = np.array(parts, copy=False)
+            elif name == 'levels':
+                out[:, j] = particle_levels(apr)
+            elif name == 'gaussian':
+                out[:, j] = np.array(get(req[0]), copy=False)
+            elif name == 'dog':
+                np.subtract(np.array(get(req[1]), copy=False), np.array(get(req[0]), copy=False), out=out[:, j])
+            elif name == 'gradients':
+                for k, d in enumerate(get(req[0])):
+                    out[:, j+k] = np.array(d, copy=False)
+            elif name == 'gradmag':
+                if req[0][0] == 'grad':
+                    col = out[:, j]
+                    col[:] = 0
+                    for d in get(req[0]):
+                        d = np.array(d, copy=False)
+                        col += d ** 2
+                    np.sqrt(col, out=col)
+                else:
+                    pyapr.filter.gradient_magnitude(apr, get(req[0]), deltas=(par.dz, par.dx, par.dy), output=tmp)
+                    out[:, j] = np.array(tmp, copy=False)
+            elif name == 'laplacian':
+                dz, dx, dy = get(req[0])
+                col = out[:, j]
+                col[:] = 0
+                for d, dim, delta in zip([dz, dx, dy], [2, 1, 0], [par.dz, par.dx, par.dy]):
+                    pyapr.filter.gradient(apr, d, dim=dim, delta=delta, output=tmp)
+                    col += np.array(tmp, copy=False)
+            elif name == 'tree':
+                float_parts, tree_parts = get(req[0])
+                out[:, j:j+1] = compute_tree_features(apr, float_parts, num_levels=feature[1:], tree_parts=tree_parts)
+            j += 3 if name == 'gradients' else 1
+
+            for key in req:
+                release(key)
+
+        return out
+
+    @staticmethod
+    def _sigma(feature):
+        """
+        Returns the Gaussian blur standard deviation applied before computing the feature (None if no blur).
+        """
+        return feature[1] if len(feature) > 1 else None
+
+
+def _get_forest_kernel():
+    """
+    Compile (once) the Numba kernel used by compiledForest to traverse the trees. Trees are evaluated one after
+    the other on chunks of samples, and small groups of samples are traversed together to hide the memory latency.
+
+    Returns
+    -------
+    _: func
+        compiled kernel, or None if Numba is not installed
+    """
+    global _forest_kernel
+
+    if _forest_kernel is None:
+        try:
+            import numba
+        except ImportError:
+            return None
+
+        @numba.njit(nogil=True, boundscheck=False, parallel=True)
+        def kernel(x, roots, left, right, feature, threshold, value, proba, chunk):
+            n, nf = x.shape
+            xf = x.ravel()
+            group = 16
+            for c0 in numba.prange((n + chunk - 1) // chunk):
+                nodes = np.empty(group, dtype=np.uint64)
+                start = c0 * chunk
+                stop = min(start + chunk, n)
+                for t in range(roots.shape[0]):
+                    for i0 in range(start, stop, group):
+                        m = min(group, stop - i0)
+                        for k in range(m):
+                            nodes[k] = roots[t]
+                        moving = True
+                        while moving:
+                            moving = False
+                            for k in range(m):
+                                node = nodes[k]
+                                if xf[(i0 + k) * nf + feature[node]] <= threshold[node]:
+                                    nxt = left[node]
+                                else:
+                                    nxt = right[node]
+                                moving |= nxt != node
+                                nodes[k] = nxt
+                        for k in range(m):
+                            for c in range(value.shape[1]):
+                                proba[i0 + k, c] += value[nodes[k], c]
+
+        _forest_kernel = kernel
+
+    return _forest_kernel
+
+
+# Compiled kernel for compiledForest (see _get_forest_kernel).
+_forest_kernel = None
+
+
+class compiledForest():
+    """
+    Compact array-based version of a trained random forest classifier (optionally preceded by a StandardScaler in a
+    pipeline, as built by tileTrainer.train_classifier). All the trees are stored in flat arrays, which makes the
+    saved model several times smaller, and they are evaluated with a compiled kernel if Numba is installed (faster
+    than sklearn on each core and multi-threaded). Without Numba, a vectorized NumPy traversal is used, which gives
+    the same results but is slower. Predictions are the same as the original classifier.
+
+    """
+    def __init__(self, clf, n_jobs=None):
+        """
+        Constructor for the compiledForest class.
+
+        Parameters
+        ----------
+        clf: sklearn.classifier
+            trained RandomForestClassifier, or pipeline of a StandardScaler and a RandomForestClassifier.
+        n_jobs: int
+            number of threads used for the prediction (-1 or None uses all the cores).
+        """
+
+        steps = clf.steps if hasattr(clf, 'steps') else [(None, clf)]
+        if len(steps) > 2 or not hasattr(steps[-1][1], 'estimators_') or \
+                (len(steps) == 2 and not hasattr(steps[0][1], 'scale_')):
+            raise TypeError('Error: only random forests (optionally preceded by a StandardScaler) can be compiled.')
+
+        # The fitted scaler is kept so that the features are scaled exactly as in the pipeline (sklearn does the
+        # arithmetic in the input dtype, float32 features would give different decisions if scaled in float64)
+        self.scaler = steps[0][1] if len(steps) == 2 else None
+
+        forest = steps[-1][1]
+        self.classes_ = forest.classes_
+        self.n_estimators = len(forest.estimators_)
+        self.n_jobs = n_jobs
+
+        # Trees are concatenated and leaves point to themselves
+        left, right, feature, threshold, value, roots = [], [], [], [], [], []
+        offset = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            is_leaf = tree.children_left == -1
+            idx = np.arange(tree.node_count)
+            left.append(np.where(is_leaf, idx, tree.children_left) + offset)
+            right.append(np.where(is_leaf, idx, tree.children_right) + offset)
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, np.inf, tree.threshold))
+            v = tree.value[:, 0, :]
+            norm = v.sum(axis=1, keepdims=True)
+            norm[norm == 0] = 1
+            value.append(v / norm)
+            roots.append(offset)
+            offset += tree.node_count
+
+        self.left = np.concatenate(left).astype('uint32')
+        self.right = np.concatenate(right).astype('uint32')
+        self.feature = np.concatenate(feature).astype('uint32')
+        self.value = np.concatenate(value)
+        self.roots = np.array(roots, dtype='uint32')
+
+        # Features are compared in float32 (as in sklearn), so the thresholds are rounded down to the closest float32
+        # which gives exactly the same decisions
+        threshold = np.concatenate(threshold)
+        self.threshold = threshold.astype('float32')
+        ind = self.threshold.astype('float64') > threshold
+        self.threshold[ind] = np.nextafter(self.threshold[ind], np.float32(-np.inf))
+
+    def get_params(self, deep=True):
+        """
+        Get the parameters of the compiled forest (sklearn API).
+
+        Returns
+        -------
+        _: dict
+            parameters
+        """
+        return {'n_jobs': self.n_jobs}
+
+    def set_params(self, **params):
+        """
+        Set the parameters of the compiled forest (sklearn API).
+
+        Returns
+        -------
+        self
+        """
+        for key, value in params.items():
+            if key != 'n_jobs':
+                raise ValueError('Error: invalid parameter \'{}\' for compiledForest.'.format(key))
+            self.n_jobs = value
+        return self
+
+    def predict_proba(self, x, n_parts=2**20):
+        """
+        Predict class probabilities for each sample.
+
+        Parameters
+        ----------
+        x: ndarray
+            features (n_samples, n_features)
+        n_parts: int
+            number of samples preprocessed at once
+
+        Returns
+        -------
+        proba: ndarray
+            class probabilities (n_samples, n_classes)
+        """
+
+        proba = np.zeros((x.shape[0], len(self.classes_)))
+        kernel = _get_forest_kernel()
+
+        if kernel is not None:
+            import numba
+            n_threads = numba.get_num_threads()
+            if self.n_jobs is not None and self.n_jobs > 0:
+                numba.set_num_threads(min(self.n_jobs, numba.config.NUMBA_NUM_THREADS))
+            try:
+                arrays = [a.astype('uint64') for a in (self.roots, self.left, self.right, self.feature)]
+                for i in range(0, x.shape[0], n_parts):
+                    kernel(self._preprocess(x[i:i + n_parts]), *arrays, self.threshold, self.value,
+                           proba[i:i + n_parts], 8192)
+            finally:
+                numba.set_num_threads(n_threads)
+        else:
+            for i in range(0, x.shape[0], 2**16):
+                proba[i:i + 2**16] = self._predict_proba_numpy(self._preprocess(x[i:i + 2**16]))
+
+        proba /= self.n_estimators
+        return proba
+
+    def predict(self, x, n_parts=2**20):
+        """
+        Predict class for each sample.
+
+        Parameters
+        ----------
+        x: ndarray
+            features (n_samples, n_features)
+        n_parts: int
+            number of samples preprocessed at once
+
+        Returns
+        -------
+        _: ndarray
+            predicted class for each sample
+        """
+
+        return self.classes_[np.argmax(self.predict_proba(x, n_parts=n_parts), axis=1)]
+
+    def _preprocess(self, x):
+        """
+        Scale the features and convert them to float32, in the same way as sklearn.
+
+        Parameters
+        ----------
+        x: ndarray
+            features (n_samples, n_features)
+
+        Returns
+        -------
+        _: ndarray
+            preprocessed features
+        """
+
+        if self.scaler is not None:
+            x = self.scaler.transform(x)
+        return np.ascontiguousarray(x, dtype='float32')
+
+    def _predict_proba_numpy(self, x):
+        """
+        Sum the class probabilities of all the trees using a vectorized NumPy traversal. Each (sample, tree) pair
+        is moved down one level at each iteration and removed once it reaches a leaf.
+
+        Parameters
+        ----------
+        x: ndarray
+            preprocessed features (n_samples, n_features)
+
+        Returns
+        -------
+        _: ndarray
+            sum of the class probabilities of all the trees (n_samples, n_classes)
+        """
+
+        n = x.shape[0]
+        xf = x.ravel()
+        is_leaf = self.left == np.arange(self.left.size)
+
+        nodes = np.tile(self.roots, n).astype('int64')
+        samples = np.repeat(np.arange(n), self.n_estimators)
+        pos = np.arange(nodes.size)
+        leaves = nodes.copy()
+        while pos.size > 0:
+            go_left = xf[samples * x.shape[1] + self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+            done = is_leaf[nodes]
+            leaves[pos[done]] = nodes[done]
+            pos, nodes, samples = pos[~done], nodes[~done], samples[~done]
+
+        return self.value[leaves].reshape(n, self.n_estimators, -1).sum(axis=1)
+
+
+class _featureMixin():
+    """
+    Feature computation options shared by tileSegmenter, multitileSegmenter and tileTrainer.
+    """
+
+    # Feature cache (set when activate_feature_cache() is called)
+    feature_cache = False
+    feature_cache_folder = None
+    feature_cache_version = None
+    # Out of core features (set when activate_out_of_core_features() is called)
+    out_of_core = False
+    out_of_core_folder = None
+
+    def activate_feature_cache(self, folder=None, version=None):
+        """
+        Activate the feature cache. Features computed on a tile are saved to disk and loaded instead of being
+        recomputed when the same feature function is applied to the same tile content again. The feature function
+        is identified by its source code only: `version` must be changed when the helper functions or the global
+        values it uses are modified.
+
+        Parameters
+        ----------
+        folder: string
+            folder where the features are stored. By default, a `features` folder is created next to each tile.
+        version: any
+            version of the feature function
+
+        Returns
+        -------
+        None
+        """
+        self.feature_cache = True
+        self.feature_cache_folder = folder
+        self.feature_cache_version = version
+
+    def deactivate_feature_cache(self):
+        """
+        Deactivate the feature cache, features are always computed.
+
+        """
+        self.feature_cache = False
+        self.feature_cache_folder = None
+        self.feature_cache_version = None
+
+    def activate_out_of_core_features(self, folder=None):
+        """
+        Activate out of core features. When the feature function is a featureBank, features are written in a
+        temporary memory mapped float32 file instead of memory, so that the (n_particles, n_features) array does not
+        need to fit in memory. Tiles are not split into spatial blocks: pyapr filters are applied on the whole tile, so
+        the intermediate results (a few full particle arrays) are still kept in memory. Prediction is done by chunks
+        of consecutive particles (see _predict_on_APR_block()).
+
+        Other feature functions return their features in memory, so the memory can not be bounded: a warning is
+        raised and the features are computed in memory.
+
+        Parameters
+        ----------
+        folder: string
+            folder for the temporary files. By default, the system temporary folder is used.
+
+        Returns
+        -------
+        None
+        """
+        self.out_of_core = True
+        self.out_of_core_folder = folder
+
+    def deactivate_out_of_core_features(self):
+        """
+        Deactivate out of core features, features are kept in memory.
+
+        """
+        self.out_of_core = False
+        self.out_of_core_folder = None
+
+
+class tileSegmenter(_featureMixin):
     """
     Class used to segment tiles. It is instantiated with a tileLoader object, a previously trained classifier,
     a function to compute features (the same features used to train the classifier and a function to get the
@@ -321,7 +1316,7 @@ class tileSegmenter():
                    verbose=verbose)
 
     def compute_segmentation(self, tile: paprica.loader.tileLoader,
-                             save_cc=True, save_mask=False, lazy_loading=True):
+                             save_cc=True, save_mask=False, lazy_loading=True, n_jobs=-1):
         """
         Compute the segmentation and stores the result as an independent APR.
 
@@ -329,6 +1324,8 @@ class tileSegmenter():
         ----------
         verbose: bool
             control the verbosity of the function to print some info
+        n_jobs: int
+            number of jobs used by the classifier (-1 uses all the cores, None keeps the classifier setting)
 
         Returns
         -------
@@ -342,13 +1339,14 @@ class tileSegmenter():
         if self.verbose:
             t = time()
             print('Computing features on APR')
-        f = self.func_to_compute_features(tile.apr, tile.parts)
+        f = _compute_features(tile, self.func_to_compute_features, self.feature_cache, self.feature_cache_folder,
+                              self.out_of_core, self.out_of_core_folder, self.feature_cache_version)
         # self.filtered_APR = f
         if self.verbose:
             print('Features computation took {:0.2f} s.'.format(time()-t))
 
         # Predict particle class
-        parts_pred = _predict_on_APR_block(f, self.clf, verbose=self.verbose)
+        parts_pred = _predict_on_APR_block(f, self.clf, verbose=self.verbose, n_jobs=n_jobs)
         if self.verbose:
             # Display inference info
             print('\n****** INFERENCE RESULTS ******')
@@ -405,7 +1403,7 @@ class tileSegmenter():
     #     # aprfile.close()
 
 
-class multitileSegmenter():
+class multitileSegmenter(_featureMixin):
     """
     Class used to segment multitiles acquisition.
     """
@@ -438,8 +1436,10 @@ class multitileSegmenter():
         # Store classifier
         if isinstance(clf, str):
             self.clf = load(clf)
+            self.clf_path = clf
         else:
             self.clf = clf
+            self.clf_path = None
         # Store function to compute features
         self.func_to_compute_features = func_to_compute_features
         # Store post processing steps
@@ -467,7 +1467,20 @@ class multitileSegmenter():
         self.verbose = verbose
 
         self.cells = None
+        self.cells_measurements = None
         self.atlas = None
+        # Cells are stored by tile along with the tile bounding box (to deduplicate only against overlapping tiles)
+        self.cells_chunks = []
+        self.cells_boxes = np.empty((0, 2, 3))
+        self.cells_tiles = []
+        # Cells are checkpointed after each tile in an append-only store (one .npy file per tile and a manifest)
+        self.cells_checkpoint_folder = os.path.join(self.path, 'cells_checkpoint')
+        self.cells_dirty = set()
+        # Cells matching parameters (see set_cells_matching())
+        self.cells_matching = 'flann'
+        self.cells_mutual = True
+        self.cells_strategy = 'remove'
+        self.cells_bulk = False
 
 
     @classmethod
@@ -525,20 +1538,48 @@ class multitileSegmenter():
         tileSegmenter object
         """
 
-        if isinstance(classifier, str):
-            clf = load(classifier)
-        else:
-            clf = classifier
-
         return cls(tiles=tiles,
                    database= database,
-                   clf=clf,
+                   clf=classifier,
                    func_to_compute_features=func_to_compute_features,
                    func_to_get_cc=func_to_get_cc,
                    verbose=verbose)
 
 
-    def compute_multitile_segmentation(self, save_cc=True, save_mask=False, lowe_ratio=0.7, distance_max=5, lazy_loading=True):
+    def set_cells_matching(self, method='kdtree', mutual=True, strategy='remove', bulk=False):
+        """
+        Set the method used to find the cells detected twice on the overlapping areas of neighboring tiles.
+
+        Parameters
+        ----------
+        method: string
+            'kdtree' for a vectorized nearest neighbor search (scipy cKDTree) or 'flann' for OpenCV Flann matcher.
+        mutual: bool
+            for the 'kdtree' method, option to keep only the matches that are mutual nearest neighbors.
+        strategy: string
+            'remove' to keep the first detection of each duplicated cell or 'average' to keep the average position of
+            both detections.
+        bulk: bool
+            if True, duplicates are not resolved when each tile is added but once for all overlapping tiles at the end
+            of the cells extraction.
+
+        Returns
+        -------
+        None
+        """
+        if method not in ['kdtree', 'flann']:
+            raise ValueError('Error: unknown cells matching method \'{}\'.'.format(method))
+        if strategy not in ['remove', 'average']:
+            raise ValueError('Error: unknown cells merging strategy \'{}\'.'.format(strategy))
+
+        self.cells_matching = method
+        self.cells_mutual = mutual
+        self.cells_strategy = strategy
+        self.cells_bulk = bulk
+
+    def compute_multitile_segmentation(self, save_cc=True, save_mask=False, lowe_ratio=0.7, distance_max=5,
+                                       lazy_loading=True, n_jobs=1, resume=False,
+                                       n_jobs_classifier=None):
         """
         Compute the segmentation and stores the result as an independent APR.
 
@@ -556,37 +1597,59 @@ class multitileSegmenter():
             maximum distance in pixel for two objects to be matched
         lazy_loading: bool
             option to save the tree particles to allow for lazy loading later on
+        n_jobs: int
+            number of worker processes segmenting the tiles (-1 uses all the cores). When n_jobs is not 1, each worker
+            loads the classifier once and returns the object centers of its tiles, which are then merged in the tile
+            order so that the result does not depend on the number of workers.
+        resume: bool
+            option to resume an interrupted run from the cells checkpoint: the tiles already processed are skipped.
+        n_jobs_classifier: int
+            number of jobs used by the classifier on each tile. By default, the classifier uses all the cores when the
+            tiles are segmented one at a time (n_jobs=1) and a single core in each worker otherwise.
 
         Returns
         -------
         None
         """
 
+        done = self._start_cells_checkpoint(resume)
+
+        if n_jobs != 1:
+            self._compute_multitile_segmentation_parallel(save_cc=save_cc, save_mask=save_mask, lowe_ratio=lowe_ratio,
+                                                          distance_max=distance_max, lazy_loading=lazy_loading,
+                                                          n_jobs=n_jobs, done=done,
+                                                          n_jobs_classifier=(1 if n_jobs_classifier is None
+                                                                             else n_jobs_classifier))
+            return
+
         for tile in tqdm(self.tiles, desc='Extracting and merging cells..'):
+            if (tile.row, tile.col) in done:
+                continue
 
             # Perform tile segmentation
-            tile = self._segment_tile(tile, save_cc=save_cc, save_mask=save_mask, lazy_loading=lazy_loading)
+            tile = self._segment_tile(tile, save_cc=save_cc, save_mask=save_mask, lazy_loading=lazy_loading,
+                                      n_jobs=-1 if n_jobs_classifier is None else n_jobs_classifier)
 
             # Remove objects on the edge
             pyapr.morphology.remove_edge_objects(tile.apr, tile.parts_cc, z_edges=False)
 
-            # Initialized merged cells for the first tile
-            if self.cells is None:
-                self.cells = pyapr.measure.find_label_centers(tile.apr, tile.parts_cc, tile.parts)
-                self.cells += self._get_tile_position(tile.row, tile.col)
-            # Then merge the rest on the first tile
-            else:
-                self._merge_cells(tile, lowe_ratio=lowe_ratio, distance_max=distance_max)
+            self._add_cells(pyapr.measure.find_label_centers(tile.apr, tile.parts_cc, tile.parts),
+                            self._get_tile_position(tile.row, tile.col),
+                            np.array(tile.apr.shape()),
+                            lowe_ratio=lowe_ratio,
+                            distance_max=distance_max,
+                            tile_id=(tile.row, tile.col))
+            self._checkpoint_cells()
 
-            try:
-                self.save_cells(output_path=os.path.join(self.tiles.path, 'cells_backup.csv'))
-            except:
-                print('Could not back up cells.')
+        if self.cells_bulk:
+            self._deduplicate_cells(lowe_ratio=lowe_ratio, distance_max=distance_max)
+            self._checkpoint_cells()
+        self._gather_cells()
 
-    def extract_and_merge_cells(self, lowe_ratio=0.7, distance_max=5):
+    def extract_and_merge_cells(self, lowe_ratio=0.7, distance_max=5, resume=False):
         """
         Function to extract cell positions in each tile and merging across all tiles.
-        Identical cells on overlapping area are automatically detected using Flann method.
+        Identical cells on overlapping area are automatically detected (see set_cells_matching()).
 
         Parameters
         ----------
@@ -595,31 +1658,37 @@ class multitileSegmenter():
             supposed to be unique. Below lowe_ratio, it might have a second detection on the neighboring tile.
         distance_max: float
             maximum distance in pixel for two cells to be considered the same.
+        resume: bool
+            option to resume an interrupted run from the cells checkpoint: the tiles already processed are skipped.
 
         Returns
         -------
         None
         """
-        
+
+        done = self._start_cells_checkpoint(resume)
+
         for tile in tqdm(self.tiles, desc='Extracting and merging cells..'):
+            if (tile.row, tile.col) in done:
+                continue
             tile.load_tile()
             tile.load_segmentation()
             
             # Remove objects on the edge
             pyapr.morphology.remove_edge_objects(tile.apr, tile.parts_cc)
 
-            # Initialized merged cells for the first tile
-            if self.cells is None:
-                self.cells = pyapr.measure.find_label_centers(tile.apr, tile.parts_cc, tile.parts)
-                self.cells += self._get_tile_position(tile.row, tile.col)
-            # Then merge the rest on the first tile
-            else:
-                self._merge_cells(tile, lowe_ratio=lowe_ratio, distance_max=distance_max)
+            self._add_cells(pyapr.measure.find_label_centers(tile.apr, tile.parts_cc, tile.parts),
+                            self._get_tile_position(tile.row, tile.col),
+                            np.array(tile.apr.shape()),
+                            lowe_ratio=lowe_ratio,
+                            distance_max=distance_max,
+                            tile_id=(tile.row, tile.col))
+            self._checkpoint_cells()
 
-            try:
-                self.save_cells(output_path=os.path.join(self.tiles.path, 'cells_backup.csv'))
-            except:
-                print('Could not back up cells.')
+        if self.cells_bulk:
+            self._deduplicate_cells(lowe_ratio=lowe_ratio, distance_max=distance_max)
+            self._checkpoint_cells()
+        self._gather_cells()
 
     def save_cells(self, output_path):
         """
@@ -635,10 +1704,244 @@ class multitileSegmenter():
         None
         """
 
+        self._gather_cells()
         pd.DataFrame(self.cells).to_csv(output_path, header=['z', 'y', 'x'])
 
+    def extract_cells_measurements(self, remove_duplicates=True, lowe_ratio=0.7, distance_max=5):
+        """
+        Compute per-object measurements (see measure_objects()) for each tile and gather them in a single table in
+        the global coordinates. Objects detected twice on the overlapping area of neighboring tiles are removed
+        using the same matching as for the cells (see set_cells_matching()).
+
+        Parameters
+        ----------
+        remove_duplicates: bool
+            option to remove the objects detected twice on overlapping areas.
+        lowe_ratio: float
+            ratio of the second nearest neighbor distance / nearest neighbor distance above lowe_ratio, the cell is
+            supposed to be unique. Below lowe_ratio, it might have a second detection on the neighboring tile.
+        distance_max: float
+            maximum distance in pixel for two cells to be considered the same.
+
+        Returns
+        -------
+        _: pd.DataFrame
+            measurement table with one row per object, also stored in self.cells_measurements.
+        """
+
+        coords = ['z', 'y', 'x']
+        tables = []
+        centers = []
+        boxes = np.empty((0, 2, 3))
+        for tile in tqdm(self.tiles, desc='Measuring cells..'):
+            tile.load_tile()
+            tile.load_segmentation()
+
+            # Remove objects on the edge
+            pyapr.morphology.remove_edge_objects(tile.apr, tile.parts_cc)
+
+            df = measure_objects(tile.apr, tile.parts_cc, tile.parts)
+            position = self._get_tile_position(tile.row, tile.col)
+            df[coords] += position
+            df[['bbox_z0', 'bbox_y0', 'bbox_x0']] += position
+            df[['bbox_z1', 'bbox_y1', 'bbox_x1']] += position
+            df.insert(0, 'col', tile.col)
+            df.insert(0, 'row', tile.row)
+
+            if remove_duplicates:
+                cells = df[coords].to_numpy(dtype=np.float64)
+                box = np.array([position, position + np.array(tile.apr.shape())])
+                lo = np.maximum(boxes[:, 0], box[0])
+                hi = np.minimum(boxes[:, 1], box[1])
+                keep = np.ones(cells.shape[0], dtype=bool)
+                for i in np.where(np.all(hi > lo, axis=1))[0]:
+                    self._resolve_duplicates(centers[i], cells, keep, lo[i], hi[i], lowe_ratio, distance_max)
+                df = df[keep].copy()
+                centers.append(cells[keep])
+                boxes = np.concatenate((boxes, box[np.newaxis]), axis=0)
+
+            tables.append(df)
+
+        # Centroids are averaged in place when using the 'average' strategy
+        if remove_duplicates and self.cells_strategy == 'average':
+            for df, c in zip(tables, centers):
+                df[coords] = c
+
+        self.cells_measurements = pd.concat(tables, ignore_index=True)
+        return self.cells_measurements
+
+    def load_cells_checkpoint(self, folder=None):
+        """
+        Load the cells from a cells checkpoint (written after each tile by compute_multitile_segmentation()
+        and extract_and_merge_cells()).
+
+        Parameters
+        ----------
+        folder: string
+            path to the checkpoint folder. If None, the default folder in the tiles path is used.
+
+        Returns
+        -------
+        _: set
+            (row, col) of the tiles stored in the checkpoint.
+        """
+
+        folder = self.cells_checkpoint_folder if folder is None else folder
+        with open(os.path.join(folder, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+
+        if manifest['bulk'] != self.cells_bulk:
+            raise ValueError('Error: cells checkpoint was written with bulk={}.'.format(manifest['bulk']))
+
+        chunks = manifest['chunks']
+        self.cells_chunks = [np.load(os.path.join(folder, c['file'])) for c in chunks]
+        self.cells_boxes = np.array([c['box'] for c in chunks], dtype=float).reshape((-1, 2, 3))
+        self.cells_tiles = [tuple(c['tile']) if c['tile'] is not None else None for c in chunks]
+        self.cells_dirty = set()
+        self.cells = None
+        self._gather_cells()
+
+        return set(t for t in self.cells_tiles if t is not None)
+
+    def _start_cells_checkpoint(self, resume):
+        """
+        Restore the cells from the checkpoint if resume is True, start a new checkpoint otherwise.
+
+        Parameters
+        ----------
+        resume: bool
+            option to resume from the cells checkpoint.
+
+        Returns
+        -------
+        _: set
+            (row, col) of the tiles already processed.
+        """
+
+        if resume:
+            if os.path.exists(os.path.join(self.cells_checkpoint_folder, 'manifest.json')):
+                done = self.load_cells_checkpoint()
+                if self.verbose:
+                    print('Resuming from cells checkpoint ({} tiles done).'.format(len(done)))
+                return done
+            print('No cells checkpoint found in {}, starting from scratch.'.format(self.cells_checkpoint_folder))
+
+        # Previous chunks are rewritten in the new checkpoint
+        self.cells_dirty = set(range(len(self.cells_chunks)))
+        self._checkpoint_cells()
+        return set()
+
+    def _checkpoint_cells(self):
+        """
+        Write the new (or modified) cells chunks to the checkpoint folder and update the manifest. Chunks are never
+        rewritten unless they are modified so the cost of each checkpoint does not grow with the number of tiles.
+
+        Returns
+        -------
+        None
+        """
+
+        folder = self.cells_checkpoint_folder
+        try:
+            os.makedirs(folder, exist_ok=True)
+
+            chunks = []
+            for i, (tile, box) in enumerate(zip(self.cells_tiles, self.cells_boxes)):
+                if tile is None:
+                    filename = 'cells_{:04d}.npy'.format(i)
+                else:
+                    filename = 'cells_{}_{}.npy'.format(tile[0], tile[1])
+                if i in self.cells_dirty:
+                    _atomic_write(os.path.join(folder, filename),
+                                  lambda f, chunk=self.cells_chunks[i]: np.save(f, chunk))
+                chunks.append({'file': filename,
+                               'tile': None if tile is None else [int(tile[0]), int(tile[1])],
+                               'box': box.tolist(),
+                               'n_cells': int(self.cells_chunks[i].shape[0])})
+
+            # The manifest is written last, a chunk is only part of the checkpoint once the manifest lists it
+            manifest = {'bulk': self.cells_bulk, 'chunks': chunks}
+            _atomic_write(os.path.join(folder, 'manifest.json'),
+                          lambda f: f.write(json.dumps(manifest).encode()))
+            self.cells_dirty = set()
+        except OSError:
+            print('Could not back up cells.')
+
+    def _compute_multitile_segmentation_parallel(self, save_cc, save_mask, lowe_ratio, distance_max, lazy_loading,
+                                                 n_jobs, done=(), n_jobs_classifier=1):
+        """
+        Segment the tiles on several worker processes and merge the cells in the main process, in the tile order.
+
+        Parameters
+        ----------
+        save_cc: bool
+            option to save the connected component particle to file
+        save_mask: bool
+            option to save the prediction mask to file
+        lowe_ratio: float in ]0, 1[
+            ratio between the second nearest neighbor and the first nearest neighbor to be considered a good match
+        distance_max: float
+            maximum distance in pixel for two objects to be matched
+        lazy_loading: bool
+            option to save the tree particles to allow for lazy loading later on
+        n_jobs: int
+            number of worker processes (-1 uses all the cores)
+        done: set
+            (row, col) of the tiles already processed (restored from the cells checkpoint)
+        n_jobs_classifier: int
+            number of jobs used by the classifier in each worker
+
+        Returns
+        -------
+        None
+        """
+
+        # Workers load the classifier from a file, it is dumped to a temporary file if needed
+        clf_path = self.clf_path
+        if clf_path is None:
+            fd, clf_path = tempfile.mkstemp(suffix='.joblib')
+            os.close(fd)
+            dump(self.clf, clf_path)
+
+        # The classifier is not sent with each tile
+        segmenter = copy.copy(self)
+        segmenter.clf = None
+        segmenter.cells = None
+        segmenter.cells_chunks = []
+        segmenter.cells_tiles = []
+        segmenter.filtered_APR = None
+        segmenter.verbose = False
+
+        tiles = [tile for tile in self.tiles if (tile.row, tile.col) not in done]
+        batch_size = 4 * (os.cpu_count() if n_jobs < 0 else n_jobs)
+        try:
+            with Parallel(n_jobs=n_jobs) as parallel:
+                with tqdm(total=len(tiles), desc='Extracting and merging cells..') as pbar:
+                    for b in range(0, len(tiles), batch_size):
+                        batch = tiles[b:b + batch_size]
+                        res = parallel(delayed(_segment_tile_worker)(segmenter, clf_path, tile, save_cc, save_mask,
+                                                                     lazy_loading, n_jobs_classifier)
+                                       for tile in batch)
+                        for tile, (cells, shape) in zip(batch, res):
+                            self._add_cells(cells,
+                                            self._get_tile_position(tile.row, tile.col),
+                                            shape,
+                                            lowe_ratio=lowe_ratio,
+                                            distance_max=distance_max,
+                                            tile_id=(tile.row, tile.col))
+                        pbar.update(len(batch))
+                        self._checkpoint_cells()
+        finally:
+            if self.clf_path is None:
+                os.remove(clf_path)
+
+        if self.cells_bulk:
+            self._deduplicate_cells(lowe_ratio=lowe_ratio, distance_max=distance_max)
+            self._checkpoint_cells()
+        self._gather_cells()
+
     def _segment_tile(self, tile: paprica.loader.tileLoader,
-                      save_cc=True, save_mask=False, lazy_loading=True):
+                      save_cc=True, save_mask=False, lazy_loading=True, n_jobs=None):
         """
         Compute the segmentation and stores the result as an independent APR.
 
@@ -646,6 +1949,8 @@ class multitileSegmenter():
         ----------
         verbose: bool
             control the verbosity of the function to print some info
+        n_jobs: int
+            number of jobs used by the classifier (-1 uses all the cores, None keeps the classifier setting)
 
         Returns
         -------
@@ -659,13 +1964,14 @@ class multitileSegmenter():
         if self.verbose:
             t = time()
             print('Computing features on APR')
-        f = self.func_to_compute_features(tile.apr, tile.parts)
+        f = _compute_features(tile, self.func_to_compute_features, self.feature_cache, self.feature_cache_folder,
+                              self.out_of_core, self.out_of_core_folder, self.feature_cache_version)
         self.filtered_APR = f
         if self.verbose:
             print('Features computation took {:0.2f} s.'.format(time()-t))
 
         # Predict particle class
-        parts_pred = _predict_on_APR_block(f, self.clf, verbose=self.verbose)
+        parts_pred = _predict_on_APR_block(f, self.clf, verbose=self.verbose, n_jobs=n_jobs)
         if self.verbose:
             # Display inference info
             print('\n****** INFERENCE RESULTS ******')
@@ -701,75 +2007,152 @@ class multitileSegmenter():
 
         return tile
 
-    def _merge_cells(self, tile, lowe_ratio, distance_max):
+    def _add_cells(self, cells, position, shape, lowe_ratio, distance_max, tile_id=None):
         """
-        Function to merge cells on a tile to the final cells list and remove duplicate.
+        Add the cells of a tile to the final cells list, removing duplicates on the overlapping area. Only the cells
+        of the previous tiles overlapping the tile are considered, and only on their overlapping area.
 
         Parameters
         ----------
-        tile: tileLoader
-            tile from which to merge cells
+        cells: ndarray
+            cells center in the tile coordinates
+        position: ndarray
+            tile absolute position
+        shape: ndarray
+            tile shape
         lowe_ratio: float
             ratio of the second nearest neighbor distance / nearest neighbor distance above lowe_ratio, the cell is
             supposed to be unique. Below lowe_ratio, it might have a second detection on the neighboring tile.
         distance_max: float
             maximum distance in pixel for two cells to be considered the same.
+        tile_id: tuple
+            (row, col) of the tile, stored in the cells checkpoint to resume an interrupted run.
 
         Returns
         -------
         None
         """
 
-        if self.cells.shape[0]>0:
-            r1 = np.max(self.cells, axis=0)
-        else:
-            r1 = np.array([0, 0, 0])
-        r2 = self._get_tile_position(tile.row, tile.col)
+        # Cells that were set without tile information are considered to be everywhere
+        if self.cells is not None and len(self.cells_chunks) == 0:
+            self.cells_chunks.append(self.cells)
+            self.cells_boxes = np.array([[[-np.inf]*3, [np.inf]*3]])
+            self.cells_tiles.append(None)
+            self.cells_dirty.add(0)
+
+        cells = cells + position
+        box = np.array([position, position + shape])
+
+        # Find the previous tiles overlapping with the tile
+        lo = np.maximum(self.cells_boxes[:, 0], box[0])
+        hi = np.minimum(self.cells_boxes[:, 1], box[1])
+        overlapping = np.where(np.all(hi > lo, axis=1))[0]
+
+        keep = np.ones(cells.shape[0], dtype=bool)
+        if not self.cells_bulk:
+            for i in overlapping:
+                self._resolve_duplicates(self.cells_chunks[i], cells, keep, lo[i], hi[i], lowe_ratio, distance_max)
+            # Previous cells are modified in place when averaging duplicates
+            if self.cells_strategy == 'average':
+                self.cells_dirty.update(overlapping.tolist())
+
+        if self.verbose and cells.shape[0] > 0:
+            print('{:0.2f}% of cells were removed.'.format(np.sum(~keep)/cells.shape[0]*100))
+
+        self.cells_chunks.append(cells[keep])
+        self.cells_boxes = np.concatenate((self.cells_boxes, box[np.newaxis]), axis=0)
+        self.cells_tiles.append(tile_id)
+        self.cells_dirty.add(len(self.cells_chunks) - 1)
+        self.cells = None
+
+    def _gather_cells(self):
+        """
+        Gather the cells of all tiles in self.cells.
 
-        v_size = np.array(tile.apr.shape())
+        Returns
+        -------
+        None
+        """
 
-        # Define the overlapping area
-        overlap_i = r2
-        overlap_f = np.min((r1 + v_size, r2 + v_size), axis=0)
+        if self.cells is None and len(self.cells_chunks) > 0:
+            self.cells = np.vstack(self.cells_chunks)
 
-        # Retrieve cell centers
-        cells2 = pyapr.measure.find_label_centers(tile.apr, tile.parts_cc, tile.parts)
-        cells2 += r2
+    def _deduplicate_cells(self, lowe_ratio, distance_max):
+        """
+        Resolve duplicates for all pairs of overlapping tiles at once (used when cells matching is in bulk mode).
+        Tiles are processed in the order they were added, so the result is the same as resolving duplicates when
+        each tile is added.
 
-        # Filter cells to keep only those on the overlapping area
-        for i in range(3):
-            if i == 0:
-                ind = np.where(self.cells[:, i] < overlap_i[i])[0]
-            else:
-                ind = np.concatenate((ind, np.where(self.cells[:, i] < overlap_i[i])[0]))
-            ind = np.concatenate((ind, np.where(self.cells[:, i] > overlap_f[i])[0]))
+        Parameters
+        ----------
+        lowe_ratio: float
+            ratio of the second nearest neighbor distance / nearest neighbor distance above lowe_ratio, the cell is
+            supposed to be unique. Below lowe_ratio, it might have a second detection on the neighboring tile.
+        distance_max: float
+            maximum distance in pixel for two cells to be considered the same.
+
+        Returns
+        -------
+        None
+        """
 
-        ind = np.unique(ind)
+        boxes = self.cells_boxes
+        for j in range(1, len(self.cells_chunks)):
+            lo = np.maximum(boxes[:j, 0], boxes[j, 0])
+            hi = np.minimum(boxes[:j, 1], boxes[j, 1])
+            keep = np.ones(self.cells_chunks[j].shape[0], dtype=bool)
+            for i in np.where(np.all(hi > lo, axis=1))[0]:
+                self._resolve_duplicates(self.cells_chunks[i], self.cells_chunks[j], keep, lo[i], hi[i],
+                                         lowe_ratio, distance_max)
+            self.cells_chunks[j] = self.cells_chunks[j][keep]
+
+        self.cells_dirty.update(range(len(self.cells_chunks)))
+        self.cells = None
 
-        cells1_out = self.cells[ind, :]
-        cells1_overlap = np.delete(self.cells, ind, axis=0)
+    def _resolve_duplicates(self, cells1, cells2, keep2, lo, hi, lowe_ratio, distance_max):
+        """
+        Find the cells of cells2 that are already in cells1 on the box [lo, hi] and mark them in keep2. The box is
+        padded by distance_max so that duplicates detected on both sides of its edges are matched. With the
+        'average' strategy, the matched cells of cells1 are replaced in place by the average of both detections.
 
-        for i in range(3):
-            if i == 0:
-                ind = np.where(cells2[:, i] < overlap_i[i])[0]
-            else:
-                ind = np.concatenate((ind, np.where(cells2[:, i] < overlap_i[i])[0]))
-            ind = np.concatenate((ind, np.where(cells2[:, i] > overlap_f[i])[0]))
-        ind = np.unique(ind)
+        Parameters
+        ----------
+        cells1: ndarray
+            cells already merged
+        cells2: ndarray
+            cells to merge
+        keep2: ndarray
+            boolean array marking the cells of cells2 to keep (modified in place)
+        lo, hi: ndarray
+            limits of the overlapping area
+        lowe_ratio: float
+            ratio of the second nearest neighbor distance / nearest neighbor distance above lowe_ratio, the cell is
+            supposed to be unique. Below lowe_ratio, it might have a second detection on the neighboring tile.
+        distance_max: float
+            maximum distance in pixel for two cells to be considered the same.
 
-        cells2_out = cells2[ind, :]
-        cells2_overlap = np.delete(cells2, ind, axis=0)
+        Returns
+        -------
+        None
+        """
 
-        # Number of cells should be higher than the number of features for the KNN implementation to work.
-        if cells2_overlap.shape[0] > 4:
-            cells_filtered_overlap = self._filter_cells_flann(cells1_overlap,
-                                                              cells2_overlap,
-                                                              lowe_ratio=lowe_ratio,
-                                                              distance_max=distance_max)
+        lo = lo - distance_max
+        hi = hi + distance_max
+        ind1 = np.where(np.all((cells1 >= lo) & (cells1 <= hi), axis=1))[0]
+        ind2 = np.where(keep2 & np.all((cells2 >= lo) & (cells2 <= hi), axis=1))[0]
 
-            self.cells = np.vstack((cells1_out, cells2_out, cells_filtered_overlap))
+        # Number of cells should be higher than the number of features for the KNN implementation to work, small
+        # overlapping areas (e.g. tile corners) are matched with the k-d tree instead.
+        if self.cells_matching == 'flann' and ind2.size > 4:
+            m1, m2 = self._find_duplicates_flann(cells1[ind1], cells2[ind2], lowe_ratio=lowe_ratio,
+                                                 distance_max=distance_max)
         else:
-            self.cells = np.vstack((cells1_out, cells2_out))
+            m1, m2 = _match_cells(cells1[ind1], cells2[ind2], lowe_ratio=lowe_ratio, distance_max=distance_max,
+                                  mutual=self.cells_mutual)
+
+        if self.cells_strategy == 'average' and len(m1) > 0:
+            cells1[ind1[m1]] = (cells1[ind1[m1]] + cells2[ind2[m2]]) / 2
+        keep2[ind2[m2]] = False
 
     def _get_tile_position(self, row, col):
         """
@@ -796,9 +2179,9 @@ class multitileSegmenter():
 
         return np.array([pz, py, px])
 
-    def _filter_cells_flann(self, c1, c2, lowe_ratio=0.7, distance_max=5):
+    def _find_duplicates_flann(self, c1, c2, lowe_ratio=0.7, distance_max=5):
         """
-        Remove cells duplicate using Flann criteria and distance threshold.
+        Find cells duplicate using Flann criteria and distance threshold.
 
         Parameters
         ----------
@@ -811,18 +2194,19 @@ class multitileSegmenter():
             supposed to be unique. Below lowe_ratio, it might have a second detection on the neighboring tile.
         distance_max: float
             maximum distance in pixel for two cells to be considered the same.
-        verbose: bool
-            control function verbosity
 
         Returns
         -------
-        _: ndarray
-            array containing the merged sets without the duplicates.
+        ind1, ind2: ndarray
+            indices of the matched cells in c1 and c2.
         """
 
         if lowe_ratio < 0 or lowe_ratio > 1:
             raise ValueError('Lowe ratio is {}, expected between 0 and 1.'.format(lowe_ratio))
 
+        if c1.shape[0] == 0:
+            return np.array([], dtype='int64'), np.array([], dtype='int64')
+
         # Match cells descriptors by using Flann method
         FLANN_INDEX_KDTREE = 1
         index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=4)
@@ -835,21 +2219,8 @@ class multitileSegmenter():
             if m.distance < lowe_ratio*n.distance and m.distance < distance_max:
                 good.append(m)
 
-        # Remove cells that are present in both volumes
-        ind_c1 = [m.queryIdx for m in good]
-        ind_c2 = [m.trainIdx for m in good]
-
-        # For now I just remove the cells in c2 but merging strategies can be better
-        c2 = np.delete(c2, ind_c2, axis=0)
-
-        # Display info
-        if self.verbose:
-            try:
-                print('{:0.2f}% of cells were removed.'.format(len(ind_c2)/(c1.shape[0]+c2.shape[0]-len(ind_c2))*100))
-            except ZeroDivisionError:
-                print('No cell removed.')
-
-        return np.vstack((c1, c2))
+        return (np.array([m.queryIdx for m in good], dtype='int64'),
+                np.array([m.trainIdx for m in good], dtype='int64'))
 
     # def _save_segmentation(self, path, name, parts, tree_parts):
     #     """
@@ -876,7 +2247,7 @@ class multitileSegmenter():
     #     # aprfile.close()
 
 
-class tileTrainer():
+class tileTrainer(_featureMixin):
     """
     Class used to train a classifier that works directly on APR data. It uses Napari to manually add labels.
 
@@ -1023,7 +2394,8 @@ class tileTrainer():
         self.labels_manual = sparse.COO(coords=self.pixel_list.T, data=self.labels, shape=self.shape)
 
     def train_classifier(self, verbose=True, n_estimators=10, class_weight='balanced',
-                         mean_norm=True, std_norm=True):
+                         mean_norm=True, std_norm=True, max_samples=None, stratify='class', n_validation=0,
+                         seed=0):
         """
         Train the classifier for segmentation.
 
@@ -1062,6 +2434,18 @@ class tileTrainer():
         std_norm : bool
             If True, scale the data to unit variance (or equivalently,
             unit standard deviation).
+        max_samples : int
+            Maximum number of labelled particles used for training (all of them if None), so that the training time
+            does not grow with the annotations.
+        stratify : {"class", "level"} or None
+            Balance the training samples between classes ("class"), between classes and particle levels ("level")
+            or draw them uniformly (None).
+        n_validation : int
+            Number of labelled particles held out (and not used for training) to report the accuracy. A ValueError
+            is raised if no particle of a label is left for training.
+        seed : int
+            Seed of the sampling. Samples are drawn with a hash of the particle index, so that adding annotations
+            keeps the previously drawn samples unless they are replaced by new ones (reservoir sampling).
 
         Returns
         -------
@@ -1080,13 +2464,41 @@ class tileTrainer():
         # We remove ambiguous case where a particle was labeled differently
         self._remove_ambiguities(verbose=verbose)
 
+        # Draw the validation and training samples from the labelled particles
+        priority = _hash_priority(self.parts_train_idx, seed=seed)
+        is_validation = np.zeros(priority.size, dtype=bool)
+        if n_validation > 0:
+            is_validation[_sample_stratified(priority, np.zeros(priority.size), n_validation)] = True
+        ind_train = np.flatnonzero(~is_validation)
+        ind_val = np.flatnonzero(is_validation)
+        missing = np.setdiff1d(self.unique_labels, self.parts_labels[ind_train])
+        if missing.size > 0:
+            raise ValueError('Error: n_validation={} leaves no training particle for label(s) {} ({} labelled '
+                             'particles).'.format(n_validation, missing.tolist(), self.parts_labels.size))
+        if max_samples is not None:
+            if stratify == 'class':
+                strata = self.parts_labels[ind_train]
+            elif stratify == 'level':
+                lvls = pyapr.ShortParticles(self.apr.total_number_particles())
+                lvls.fill_with_levels(self.apr)
+                lvls = np.array(lvls, copy=False)[self.parts_train_idx[ind_train].astype('int64')]
+                strata = np.unique(np.stack((self.parts_labels[ind_train], lvls), axis=1), axis=0,
+                                   return_inverse=True)[1].ravel()
+            elif stratify is None:
+                strata = np.zeros(ind_train.size)
+            else:
+                raise ValueError('Error: unknown stratify option \'{}\'.'.format(stratify))
+            ind_train = ind_train[_sample_stratified(priority[ind_train], strata, max_samples)]
+
         # We compute features and train the classifier
         if self.f is None:
-            self.f = self.func_to_compute_features(self.apr, self.parts)
+            self.f = _compute_features(self.tile, self.func_to_compute_features, self.feature_cache,
+                                       self.feature_cache_folder, self.out_of_core, self.out_of_core_folder,
+                                       self.feature_cache_version)
 
         # Fetch data that was manually labelled
-        x = self.f[self.parts_train_idx]
-        y = self.parts_labels
+        x = self.f[self.parts_train_idx[ind_train]]
+        y = self.parts_labels[ind_train]
 
         # Train random forest
         clf = make_pipeline(preprocessing.StandardScaler(with_mean=mean_norm, with_std=std_norm),
@@ -1095,20 +2507,29 @@ class tileTrainer():
         clf.fit(x, y.ravel())
         print('Training took {} s.\n'.format(time() - t))
 
-        x_pred = clf.predict(x)
+        # Accuracy is reported on the held out particles if any
+        if ind_val.size > 0:
+            y = self.parts_labels[ind_val]
+            x_pred = clf.predict(self.f[self.parts_train_idx[ind_val]])
+        else:
+            x_pred = clf.predict(x)
 
         # Display training info
         if verbose:
             print('\n****** TRAINING RESULTS ******')
+            print('{} particles used for training, accuracy computed on {} {} particles.'
+                  .format(ind_train.size, y.size, 'held out' if ind_val.size > 0 else 'training'))
             print('Total accuracy: {:0.2f}%'.format(np.sum(x_pred == y) / y.size * 100))
-            for l in self.unique_labels:
-                print('Class {} accuracy: {:0.2f}% ({} cell particles)'.format(l,
-                    np.sum((x_pred == y) * (y == l)) / np.sum(y == l) * 100, np.sum(y == l)))
+            labels, inv = np.unique(y, return_inverse=True)
+            n_correct = np.bincount(inv.ravel(), weights=(x_pred == y))
+            n_labels = np.bincount(inv.ravel())
+            for l, nc, n in zip(labels, n_correct, n_labels):
+                print('Class {} accuracy: {:0.2f}% ({} cell particles)'.format(l, nc / n * 100, n))
             print('******************************\n')
 
         self.clf = clf
 
-    def segment_training_tile(self, bg_label=None, display_result=True, verbose=True):
+    def segment_training_tile(self, bg_label=None, display_result=True, verbose=True, n_jobs=-1):
         """
         Apply classifier to the whole tile and display segmentation results using Napari.
 
@@ -1118,6 +2539,8 @@ class tileTrainer():
             option to display segmentation results using Napari
         verbose: bool
             option to print out information.
+        n_jobs: int
+            number of jobs used by the classifier (-1 uses all the cores, None keeps the classifier setting)
 
         Returns
         -------
@@ -1126,7 +2549,7 @@ class tileTrainer():
 
         # Apply on whole dataset
         if self.parts_mask is None:
-            parts_pred = _predict_on_APR_block(self.f, self.clf, verbose=verbose)
+            parts_pred = _predict_on_APR_block(self.f, self.clf, verbose=verbose, n_jobs=n_jobs)
             self.parts_mask = parts_pred
 
         if (self.func_to_get_cc is not None) and self.parts_cc is None:
@@ -1174,7 +2597,8 @@ class tileTrainer():
             viewer.add_layer(label_map)
         napari.run()
 
-    def apply_on_tile(self, tile, bg_label=None, func_to_get_cc=None, display_result=True, verbose=True):
+    def apply_on_tile(self, tile, bg_label=None, func_to_get_cc=None, display_result=True, verbose=True,
+                      n_jobs=-1):
         """
         Apply classifier to the whole tile and display segmentation results using Napari.
 
@@ -1184,6 +2608,8 @@ class tileTrainer():
             option to display segmentation results using Napari
         verbose: bool
             option to print out information.
+        n_jobs: int
+            number of jobs used by the classifier (-1 uses all the cores, None keeps the classifier setting)
 
         Returns
         -------
@@ -1193,8 +2619,9 @@ class tileTrainer():
         # Apply on whole dataset
         if tile.apr is None:
             tile.load_tile()
-        f = self.func_to_compute_features(tile.apr, tile.parts)
-        parts_pred = _predict_on_APR_block(f, self.clf, verbose=verbose)
+        f = _compute_features(tile, self.func_to_compute_features, self.feature_cache, self.feature_cache_folder,
+                              self.out_of_core, self.out_of_core_folder, self.feature_cache_version)
+        parts_pred = _predict_on_APR_block(f, self.clf, verbose=verbose, n_jobs=n_jobs)
         tile.parts_mask = parts_pred.copy()
 
         # Display inference info
@@ -1216,7 +2643,7 @@ class tileTrainer():
                 parts_pred = pyapr.ShortParticles(parts_pred)
                 paprica.viewer.display_segmentation(tile.apr, tile.parts, parts_pred)
 
-    def save_classifier(self, path=None):
+    def save_classifier(self, path=None, compiled=False):
         """
         Save the trained classifier.
 
@@ -1224,6 +2651,8 @@ class tileTrainer():
         ----------
         path: string
             path for saving the classifier. By default, it is saved in the data root folder.
+        compiled: bool
+            option to save the classifier as a compiledForest (smaller file and faster prediction)
 
         Returns
         -------
@@ -1234,7 +2663,10 @@ class tileTrainer():
         if path is None:
             path = os.path.join(self.tile.folder_root, 'random_forest_n100.joblib')
 
-        dump(self.clf, path)
+        if compiled:
+            dump(compiledForest(self.clf), path)
+        else:
+            dump(self.clf, path)
 
     def load_classifier(self, path=None):
         """
@@ -1285,73 +2717,63 @@ class tileTrainer():
         if self.parts_train_idx is None:
             raise ValueError('Error: train classifier before removing ambiguities.')
 
-        idx_unique = np.unique(self.parts_train_idx)
+        # Labels are grouped by particle: a particle is kept only if all its labels are the same
+        idx_unique, inv, counts = np.unique(self.parts_train_idx, return_inverse=True, return_counts=True)
+        labels = np.asarray(self.labels)[np.argsort(inv.ravel(), kind='stable')]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        labels_min = np.minimum.reduceat(labels, starts)
+        is_same = labels_min == np.maximum.reduceat(labels, starts)
+        cnt = np.sum(~is_same)
 
-        parts_train = []
-        parts_labels = []
-
-        cnt = 0
-        for idx in idx_unique:
-            local_labels = self.labels[self.parts_train_idx==idx]
-            is_same, l = self._are_labels_the_same(local_labels)
-            if is_same:
-                # If labels are the same we assign it
-                parts_labels.append(l)
-                parts_train.append(idx)
-            else:
-                cnt += 1
-
-        self.parts_train_idx = np.array(parts_train)
-        self.parts_labels = np.array(parts_labels)
-        self.unique_labels = np.unique(self.parts_labels)
+        self.parts_train_idx = idx_unique[is_same]
+        self.parts_labels = labels_min[is_same]
+        self.unique_labels, labels_count = np.unique(self.parts_labels, return_counts=True)
 
         if verbose:
             print('\n********* ANNOTATIONS ***********')
             print('{} ambiguous particles were removed.'.format(cnt))
             print('{} particles were labeled.'.format(self.parts_labels.shape[0]))
-            for l in self.unique_labels:
-                print('{} particles ({:0.2f}%) were labeled as {}.'.format(np.sum(self.parts_labels==l),
-                                                                       100*np.sum(self.parts_labels==l)/self.parts_labels.shape[0],
-                                                                        l))
+            for l, n in zip(self.unique_labels, labels_count):
+                print('{} particles ({:0.2f}%) were labeled as {}.'.format(n, 100*n/self.parts_labels.shape[0], l))
             print('***********************************\n')
 
-    def _sample_pixel_list_on_APR(self):
-        """
-        Convert manual annotations coordinates from pixel to APR.
-
-        Returns
-        -------
-        None
-        """
-        self.parts_train_idx = np.empty(self.pixel_list.shape[0], dtype='uint64')
-
-        for i in tqdm(range(self.pixel_list.shape[0]), desc='Sampling labels on APR.'):
-            idx = self._find_particle(self.pixel_list[i, :])
-
-            self.parts_train_idx[i] = idx
-
-    def _find_particle(self, coords):
+    def _sample_pixel_list_on_APR(self, max_memory=1e9):
         """
-        Find particle index corresponding to pixel location coords.
+        Convert manual annotations coordinates from pixel to APR. The index of each particle is reconstructed
+        (piecewise constant) on the bounding box of the annotations by slabs of planes, so that the particle
+        containing each annotated pixel is found with a single array lookup.
 
         Parameters
         ----------
-        coords: array_like
-            pixel coordinate [z, y, x]
+        max_memory: float
+            maximum memory in bytes used to reconstruct a slab of the particle index image
 
         Returns
         -------
-        idx: (int) particle index
-        """
-        # TODO: @JOEL PUT THIS IN C++ PLEASE
-        for level in range(self.apr_it.level_min(), self.apr_it.level_max()+1):
-            particle_size = 2 ** (self.apr.level_max() - level)
-            z_l, x_l, y_l = coords // particle_size
-            for idx in range(self.apr_it.begin(level, z_l, x_l), self.apr_it.end()):
-                if self.apr_it.y(idx) == y_l:
-                    # if np.sqrt(np.sum((coords-np.array([z_l, x_l, y_l])*particle_size)**2))/particle_size > np.sqrt(3):
-                    #     print('ich')
-                    return idx
+        None
+        """
+        coords = np.asarray(self.pixel_list).astype('int64')
+        self.parts_train_idx = np.empty(coords.shape[0], dtype='uint64')
+        if coords.shape[0] == 0:
+            return
+
+        # Particle index sampled on the APR
+        parts_idx = pyapr.LongParticles(self.apr.total_number_particles())
+        np.array(parts_idx, copy=False)[:] = np.arange(self.apr.total_number_particles())
+        slicer = pyapr.reconstruction.APRSlicer(self.apr, parts_idx, mode='constant')
+
+        lo = coords.min(axis=0)
+        hi = coords.max(axis=0) + 1
+        slab_size = max(int(max_memory // (8 * (hi[1] - lo[1]) * (hi[2] - lo[2]))), 1)
+
+        slab = (coords[:, 0] - lo[0]) // slab_size
+        for n in tqdm(np.unique(slab), desc='Sampling labels on APR.'):
+            ind = np.where(slab == n)[0]
+            z0 = lo[0] + n * slab_size
+            z1 = min(z0 + slab_size, hi[0])
+            # APRSlicer squeezes the dimensions of size 1
+            idx_image = slicer[z0:z1, lo[1]:hi[1], lo[2]:hi[2]].reshape((z1 - z0, hi[1] - lo[1], hi[2] - lo[2]))
+            self.parts_train_idx[ind] = idx_image[coords[ind, 0] - z0, coords[ind, 1] - lo[1], coords[ind, 2] - lo[2]]
 
     def _order_labels(self):
         """
@@ -1365,19 +2787,3 @@ class tileTrainer():
             ind = np.argsort(self.pixel_list[:, d])
             self.pixel_list = self.pixel_list[ind]
             self.labels = self.labels[ind]
-
-    @staticmethod
-    def _are_labels_the_same(local_labels):
-        """
-        Determine if manual labels in particle are the same and return the labels
-
-        Parameters
-        ----------
-        local_labels: ndarray
-            particle labels
-
-        Returns
-        -------
-        ((bool): True if labels are the same, (int) corresponding label)
-        """
-        return ((local_labels == local_labels[0]).all(), local_labels[0])
\ No newline at end of file
@@ -17,12 +17,22 @@ Others channel can then easily stitched using the previous one as reference:
 Doing that each tile in the second data set will be registered to the corresponding autofluorescence tile and
 then their spatial position will be adjusted.
 
+For sparse samples, the pair-wise registration can also be computed by matching the cell centroids detected on each
+overlapping area (the segmentation must be computed first):
+
+>>> stitcher.compute_registration_from_cells()
+
 WARNING: when stitching, the expected overlap must be HIGHER than the real one. To enforce this, a margin of 20% is
 automatically taken (this margin can be set lower by the user for speed improvement). In order to get the best stitching
 quality it requires to have a good estimate of the overlap, hence why the full volume is not considered.
 
 This submodule also contains a class for merging and reconstructing the data. It was intended to be used at lower
-resolution for atlasing. The generated data can quickly become out of hands, use with caution!
+resolution for atlasing. The generated data can quickly become out of hands, use with caution! For higher resolutions
+the merged volume can be written out-of-core to disk:
+
+>>> merger = paprica.stitcher.tileMerger(tiles, stitcher.database)
+>>> merger.activate_out_of_core(folder=path_to_merged_data)
+>>> merger.merge_max()
 
 By using this code you agree to the terms of the software license agreement.
 
@@ -30,7 +40,10 @@ By using this code you agree to the terms of the software license agreement.
 """
 
 import os
+import threading
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2 as cv
@@ -40,11 +53,13 @@ import numpy as np
 import pandas as pd
 import pyapr
 import seaborn as sns
+from joblib import Parallel, delayed
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 # from skimage.registration import phase_cross_correlation
 from scipy.signal import correlate
 from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import minimum_spanning_tree, depth_first_order
+from scipy.sparse.csgraph import minimum_spanning_tree, depth_first_order, connected_components
+from scipy.spatial import cKDTree
 from skimage.color import label2rgb, hsv2rgb
 from skimage.exposure import equalize_adapthist, rescale_intensity
 from skimage.filters import gaussian
@@ -461,6 +476,341 @@ def _get_masked_proj_shifts(proj1, proj2, threshold, upsample_factor=1):
     return np.array([dz, dy, dx]), np.array([rz, ry, rx])
 
 
+def _get_centroid_shifts(cells1, cells2, d_expected, search_radius, tolerance=2, min_matches=5, k=3):
+    """
+    This function computes shifts from cell centroids detected on overlapping areas. Each centroid of the first
+    tile is matched to its k nearest neighbors on the second tile (after applying the expected displacement) and
+    the displacement supported by the largest number of pairs is kept (robust consensus). This is much cheaper than
+    the phase cross-correlation on sparse data where the max-projections are mostly empty.
+
+    Parameters
+    ----------
+    cells1: ndarray
+        (n, 3) centroids [z, y, x] of tile 1 expressed in the overlapping area coordinates
+    cells2: ndarray
+        (m, 3) centroids [z, y, x] of tile 2 expressed in the overlapping area coordinates
+    d_expected: array_like
+        expected displacement [dz, dy, dx] (e.g. from the expected overlap)
+    search_radius: float
+        maximum distance in pixel between a centroid and its match once the expected displacement is applied
+    tolerance: float
+        maximum distance in pixel between a candidate displacement and the consensus to be considered an inlier
+    min_matches: int
+        minimum number of inliers for the registration to be considered valid
+    k: int
+        number of nearest neighbors considered for each centroid
+
+    Returns
+    -------
+    _: array_like
+        shifts in (z, y, x) and error measure (0=reliable, 1=not reliable, 2 if the registration failed)
+    """
+
+    d_expected = np.array(d_expected, dtype='float64')
+    not_reliable = (d_expected, np.array([2, 2, 2], dtype='float64'))
+
+    if cells1.shape[0] < min_matches or cells2.shape[0] < min_matches:
+        return not_reliable
+
+    # Find candidate pairs with a k-d tree
+    k = min(k, cells2.shape[0])
+    tree = cKDTree(cells2)
+    dist, ind = tree.query(cells1 - d_expected, k=k, distance_upper_bound=search_radius)
+    dist = dist.reshape(cells1.shape[0], -1)
+    ind = ind.reshape(cells1.shape[0], -1)
+    rows, cols = np.nonzero(np.isfinite(dist))
+    if rows.size < min_matches:
+        return not_reliable
+    ind = ind[rows, cols]
+    candidates = cells1[rows] - cells2[ind]
+
+    # Consensus: keep the displacement supported by the largest number of candidate pairs
+    support = cKDTree(candidates).query_ball_point(candidates, r=tolerance, return_length=True)
+    d = candidates[np.argmax(support)]
+    for _ in range(2):
+        inliers = np.linalg.norm(candidates - d, axis=1) <= tolerance
+        d = np.median(candidates[inliers], axis=0)
+
+    # Each cell of the second tile can only be matched once
+    n_inliers = np.unique(ind[inliers]).size
+    if n_inliers < min_matches:
+        return not_reliable
+
+    # Error is the standard error on the displacement weighted by the ratio of matched cells
+    inlier_ratio = n_inliers / min(cells1.shape[0], cells2.shape[0])
+    residuals = candidates[inliers] - d
+    rel = (np.std(residuals, axis=0) + 0.5) / np.sqrt(n_inliers) / inlier_ratio
+
+    # Map the error to [0, 1) like the cross-correlation error so that it is comparable with it and always below the
+    # error of a non reliable registration
+    rel = rel / (1 + rel)
+
+    # Replace error == 0 with 1e-6 otherwise the minimum spanning tree considers that vertex are not connected
+    rel[rel == 0] = 1e-6
+
+    return d, rel
+
+
+def _merge_block(block, tiles_to_merge, level_delta, parts_name, dtype, output_path=None):
+    """
+    Merge the tiles intersecting a block of the merged volume with a maximum algorithm. Only the intersecting part
+    of each tile is reconstructed using a LazySlicer, so this function can run independently on disjoint blocks.
+
+    Parameters
+    ----------
+    block: array_like
+        block limits [[z_begin, z_end], [y_begin, y_end], [x_begin, x_end]] in the merged volume
+    tiles_to_merge: list
+        list of (path, position, shape) of each tile intersecting the block, position and shape being in the merged
+        volume coordinates
+    level_delta: int
+        parameter controlling the resolution at which the APR is read lazily
+    parts_name: string
+        name of the particles to reconstruct (e.g. 'particles' or 'segmentation cc')
+    dtype: string
+        merged data type
+    output_path: string
+        if given, the block is written in the memory mapped .npy merged array at this path instead of being returned
+
+    Returns
+    -------
+    data: ndarray
+        merged block (None if output_path is given)
+    """
+    block = np.array(block)
+    data = np.zeros(block[:, 1] - block[:, 0], dtype=dtype)
+
+    for path, pos, shape in tiles_to_merge:
+        lo = np.maximum(block[:, 0], pos)
+        hi = np.minimum(block[:, 1], pos + shape)
+        if np.any(hi <= lo):
+            continue
+
+        slicer = pyapr.reconstruction.LazySlicer(path, level_delta=level_delta, parts_name=parts_name,
+                                                 tree_parts_name=parts_name)
+        u = slicer[lo[0]-pos[0]:hi[0]-pos[0], lo[1]-pos[1]:hi[1]-pos[1], lo[2]-pos[2]:hi[2]-pos[2]]
+
+        view = data[lo[0]-block[0, 0]:hi[0]-block[0, 0],
+                    lo[1]-block[1, 0]:hi[1]-block[1, 0],
+                    lo[2]-block[2, 0]:hi[2]-block[2, 0]]
+        # LazySlicer squeezes the dimensions of size 1
+        np.maximum(view, u.reshape(view.shape), out=view, casting='unsafe')
+
+    if output_path is not None:
+        merged = np.load(output_path, mmap_mode='r+')
+        merged[block[0, 0]:block[0, 1], block[1, 0]:block[1, 1], block[2, 0]:block[2, 1]] = data
+        merged.flush()
+        return None
+
+    return data
+
+
+def _get_blending_ramp(n, overlap):
+    """
+    Compute a linear blending ramp along one tile dimension. The weight increases linearly from the tile edge over
+    the overlapping area and is equal to 1 elsewhere.
+
+    Parameters
+    ----------
+    n: int
+        tile size along the dimension
+    overlap: float
+        overlap size along the dimension (0 for no blending)
+
+    Returns
+    -------
+    _: ndarray
+        (n,) array of strictly positive weights
+    """
+    x = np.arange(n, dtype='float32')
+    return np.minimum(1, np.minimum(x + 1, n - x) / (max(overlap, 0) + 1))
+
+
+def _get_block_interpolation(edges, n):
+    """
+    Compute the linear interpolation between the centers of consecutive blocks along one dimension.
+
+    Parameters
+    ----------
+    edges: ndarray
+        (n_blocks + 1,) edges of the blocks
+    n: int
+        size along the dimension
+
+    Returns
+    -------
+    _: tuple
+        index of the previous block, index of the next block and weight of the next block for each position
+    """
+    centers = (edges[:-1] + edges[1:] - 1) / 2
+    x = np.arange(n)
+    i0 = np.clip(np.searchsorted(centers, x, side='right') - 1, 0, centers.size - 1)
+    i1 = np.minimum(i0 + 1, centers.size - 1)
+    w = np.clip((x - centers[i0]) / np.maximum(centers[i1] - centers[i0], 1), 0, 1)
+    return i0, i1, w.astype('float32')
+
+
+class slabCache():
+    """
+    Class to read tiles by slabs of planes for reconstructing whole sample slices. LazySlicer handles are kept
+    open and the most recently read slabs are kept in memory (least recently used are discarded first), so that
+    consecutive reconstructions at close locations reuse the data instead of reading the files again.
+
+    """
+    def __init__(self, slab_size=16, max_memory=2e9, n_threads=None):
+        """
+        Constructor for the slabCache class.
+
+        Parameters
+        ----------
+        slab_size: int
+            number of planes read at once for each tile, slabs are aligned on multiples of slab_size so that
+            reconstructions at close locations reuse them. If None, each slab is exactly the block of planes
+            requested by the reconstruction so that no additional plane is read, but only identical requests hit the
+            cache.
+        max_memory: float
+            maximum memory used by the cached slabs in bytes. Slabs larger than this are read but not cached.
+        n_threads: int
+            number of threads used to read the tiles (default: number of cores)
+        """
+        self.slab_size = slab_size
+        self.max_memory = max_memory
+        self.n_threads = os.cpu_count() if n_threads is None else n_threads
+
+        self.slicers = {}
+        self.slicer_locks = {}
+        self.slabs = OrderedDict()
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # LazySlicer and locks can't be pickled, only the parameters are kept.
+        return {'slab_size': self.slab_size, 'max_memory': self.max_memory, 'n_threads': self.n_threads}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_slicer(self, path, level_delta, parts_name='particles'):
+        """
+        Get the LazySlicer for the given tile, it is opened only once. LazySlicer is not thread safe, it must only
+        be read while holding the corresponding lock in `slicer_locks`.
+
+        Parameters
+        ----------
+        path: string
+            tile path
+        level_delta: int
+            parameter controlling the resolution at which the APR will be read lazily
+        parts_name: string
+            name of the particles to read
+
+        Returns
+        -------
+        _: LazySlicer
+            lazy slicer
+        """
+        return self._open(path, level_delta, parts_name)[0]
+
+    def read(self, path, level_delta, parts_name, dim, begin, end):
+        """
+        Read the planes [begin, end[ along the given dimension.
+
+        Parameters
+        ----------
+        path: string
+            tile path
+        level_delta: int
+            parameter controlling the resolution at which the APR will be read lazily
+        parts_name: string
+            name of the particles to read
+        dim: int
+            dimension along which the planes are read
+        begin: int
+            first plane to read
+        end: int
+            last plane to read (excluded)
+
+        Returns
+        -------
+        _: ndarray
+            3D array containing the planes
+        """
+        end = min(end, self.get_slicer(path, level_delta, parts_name).shape[dim])
+        if self.slab_size is None:
+            return self._get_slab(path, level_delta, parts_name, dim, begin, end)
+
+        data = []
+        for n in range(begin // self.slab_size, (end - 1) // self.slab_size + 1):
+            slab = self._get_slab(path, level_delta, parts_name, dim, n * self.slab_size, (n + 1) * self.slab_size)
+            sl = [slice(None)] * 3
+            sl[dim] = slice(max(begin - n * self.slab_size, 0), min(end - n * self.slab_size, self.slab_size))
+            data.append(slab[tuple(sl)])
+
+        return np.concatenate(data, axis=dim)
+
+    def clear(self):
+        """
+        Close the tiles kept open and free the cached slabs.
+
+        """
+        with self.lock:
+            self.slicers = {}
+            self.slicer_locks = {}
+            self.slabs = OrderedDict()
+            self.memory = 0
+
+    def _open(self, path, level_delta, parts_name):
+        """
+        Get the LazySlicer for the given tile and the lock guarding it, opening it if needed.
+
+        Returns
+        -------
+        _: tuple
+            lazy slicer and its lock
+        """
+        key = (path, level_delta, parts_name)
+        with self.lock:
+            if key not in self.slicers:
+                self.slicers[key] = pyapr.reconstruction.LazySlicer(path, level_delta=level_delta,
+                                                                    parts_name=parts_name, tree_parts_name=parts_name)
+                self.slicer_locks[key] = threading.Lock()
+            return self.slicers[key], self.slicer_locks[key]
+
+    def _get_slab(self, path, level_delta, parts_name, dim, begin, end):
+        """
+        Get the slab of planes [begin, end[ along the given dimension, either from the cache or by reading it.
+
+        Returns
+        -------
+        _: ndarray
+            3D array containing the slab
+        """
+        key = (path, level_delta, parts_name, dim, begin, end)
+        with self.lock:
+            if key in self.slabs:
+                self.slabs.move_to_end(key)
+                return self.slabs[key]
+
+        slicer, slicer_lock = self._open(path, level_delta, parts_name)
+        shape = list(slicer.shape)
+        sl = [slice(0, n) for n in shape]
+        sl[dim] = slice(begin, min(end, shape[dim]))
+        shape[dim] = sl[dim].stop - sl[dim].start
+        # LazySlicer returns its internal (squeezed) buffer which is overwritten by the next read, so it is copied
+        with slicer_lock:
+            slab = np.array(slicer[tuple(sl)]).reshape(shape)
+
+        with self.lock:
+            if key not in self.slabs and slab.nbytes <= self.max_memory:
+                self.slabs[key] = slab
+                self.memory += slab.nbytes
+            while self.memory > self.max_memory:
+                _, old = self.slabs.popitem(last=False)
+                self.memory -= old.nbytes
+
+        return slab
+
+
 class baseStitcher():
     """
     Base class for stitching multi-tile data.
@@ -516,6 +866,9 @@ class baseStitcher():
         self.z_begin = None
         self.z_end = None
 
+        # Cache for reconstructing whole sample slices (created when needed).
+        self.slab_cache = None
+
     def activate_mask(self, threshold):
         """
         Activate the masked cross-correlation for the displacement estimation. Pixels above threshold are
@@ -689,16 +1042,15 @@ class baseStitcher():
 
         level_delta = int(-np.sign(downsample) * np.log2(np.abs(downsample)))
 
-        tile = self.tiles[0]
-        tile.lazy_load_tile(level_delta=level_delta)
+        tile_shape = self._get_slab_cache().get_slicer(self.tiles[0].path, level_delta).shape
 
         if z is None:
-            z = int(tile.lazy_data.shape[0] / 2)
+            z = int(tile_shape[0] / 2)
 
-        if z > tile.lazy_data.shape[0]:
-            raise ValueError('Error: z is too large ({}), maximum depth at this downsample is {}.'.format(z, tile.lazy_data.shape[0]))
+        if z > tile_shape[0]:
+            raise ValueError('Error: z is too large ({}), maximum depth at this downsample is {}.'.format(z, tile_shape[0]))
 
-        frame_size = tile.lazy_data.shape[1:]
+        frame_size = tile_shape[1:]
         x_pos = self.database['ABS_H'].to_numpy()
         nx = int(np.ceil((x_pos.max() - x_pos.min()) / downsample + frame_size[1]))
         y_pos = self.database['ABS_V'].to_numpy()
@@ -710,12 +1062,12 @@ class baseStitcher():
         H_pos = (x_pos - x_pos.min()) / downsample
         V_pos = (y_pos - y_pos.min()) / downsample
 
-        for i, tile in enumerate(tqdm(self.tiles, desc='Merging', disable=not progress_bar)):
-            tile.lazy_load_tile(level_delta=level_delta)
-            zf = min(z+n_proj, tile.lazy_data.shape[0])
-            data = tile.lazy_data[z:zf]
-            v = data.max(axis=0)
-            h = np.argmax(data, axis=0)
+        zf = min(z + n_proj, tile_shape[0])
+        projs = self._read_tiles_planes(self.tiles, dim=0, begins=[z]*len(self.tiles), ends=[zf]*len(self.tiles),
+                                        level_delta=level_delta, func=lambda u: (u.max(axis=0), np.argmax(u, axis=0)),
+                                        progress_bar=progress_bar)
+
+        for i, (v, h) in enumerate(projs):
 
             # In debug mode we highlight each tile edge to see where it was
             if debug:
@@ -749,6 +1101,38 @@ class baseStitcher():
 
         return rgb
 
+    def set_reconstruction_cache(self, slab_size=16, max_memory=2e9, n_threads=None):
+        """
+        Set the parameters of the cache used to reconstruct whole sample slices. Tiles are read on a thread pool and
+        the most recently read slabs are kept in memory, so that consecutive reconstructions at the same or close
+        locations reuse the data.
+
+        Parameters
+        ----------
+        slab_size: int
+            number of planes read at once for each tile. Slabs are read ahead so that scrolling through close
+            locations hits the cache, at the cost of reading up to slab_size planes more than requested. If None,
+            each slab is exactly the block of planes requested by the reconstruction (no read amplification) and only
+            identical requests hit the cache.
+        max_memory: float
+            maximum memory used by the cached slabs in bytes
+        n_threads: int
+            number of threads used to read the tiles (default: number of cores)
+
+        Returns
+        -------
+        None
+        """
+        self.slab_cache = slabCache(slab_size=slab_size, max_memory=max_memory, n_threads=n_threads)
+
+    def clear_reconstruction_cache(self):
+        """
+        Close the tiles kept open and free the cached slabs.
+
+        """
+        if self.slab_cache is not None:
+            self.slab_cache.clear()
+
     def _reconstruct_z_slice(self, z=None, n_proj=0, downsample=1, color=False,
                              debug=False, plot=True, seg=False, progress_bar=True):
         """
@@ -781,18 +1165,15 @@ class baseStitcher():
 
         level_delta = int(-np.sign(downsample) * np.log2(np.abs(downsample)))
 
-        tile = self.tiles[0]
-        tile.lazy_load_tile(level_delta=level_delta)
-        if seg:
-            tile.lazy_load_segmentation(level_delta=level_delta)
+        tile_shape = self._get_slab_cache().get_slicer(self.tiles[0].path, level_delta).shape
 
         if z is None:
-            z = int(tile.lazy_data.shape[0] / 2)
+            z = int(tile_shape[0] / 2)
 
-        if z > tile.lazy_data.shape[0]:
-            raise ValueError('Error: z is too large ({}), maximum depth at this downsample is {}.'.format(z, tile.lazy_data.shape[0]))
+        if z > tile_shape[0]:
+            raise ValueError('Error: z is too large ({}), maximum depth at this downsample is {}.'.format(z, tile_shape[0]))
 
-        frame_size = tile.lazy_data.shape[1:]
+        frame_size = tile_shape[1:]
         x_pos = self.database['ABS_H'].to_numpy()
         nx = int(np.ceil((x_pos.max() - x_pos.min()) / downsample + frame_size[1]))
         y_pos = self.database['ABS_V'].to_numpy()
@@ -809,19 +1190,15 @@ class baseStitcher():
         H_pos = (x_pos - x_pos.min()) / downsample
         V_pos = (y_pos - y_pos.min()) / downsample
 
-        for i, tile in enumerate(tqdm(self.tiles, desc='Merging', disable=not progress_bar)):
-            tile.lazy_load_tile(level_delta=level_delta)
-            if seg:
-                tile.lazy_load_segmentation(level_delta=level_delta)
-            zf = min(z+n_proj, tile.lazy_data.shape[0])
-            if zf > z:
-                data = tile.lazy_data[z:zf].max(axis=0)
-                if seg:
-                    cc = tile.lazy_segmentation[z:zf].max(axis=0)
-            else:
-                data = tile.lazy_data[z]
-                if seg:
-                    cc = tile.lazy_segmentation[z]
+        zf = min(z + n_proj, tile_shape[0])
+        begins, ends = [z]*len(self.tiles), [zf]*len(self.tiles)
+        projs = self._read_tiles_planes(self.tiles, dim=0, begins=begins, ends=ends, level_delta=level_delta,
+                                        progress_bar=progress_bar)
+        if seg:
+            ccs = self._read_tiles_planes(self.tiles, dim=0, begins=begins, ends=ends, level_delta=level_delta,
+                                          parts_name='segmentation cc', progress_bar=progress_bar)
+
+        for i, (tile, data) in enumerate(zip(self.tiles, projs)):
 
             # In debug mode we highlight each tile edge to see where it was
             if debug:
@@ -851,7 +1228,7 @@ class baseStitcher():
             else:
                 merged_data[y1:y2, x1:x2] = np.maximum(merged_data[y1:y2, x1:x2], data)
                 if seg:
-                    merged_seg[y1:y2, x1:x2] = np.maximum(merged_seg[y1:y2, x1:x2], cc)
+                    merged_seg[y1:y2, x1:x2] = np.maximum(merged_seg[y1:y2, x1:x2], ccs[i])
 
         if plot:
             viewer = napari.Viewer()
@@ -897,16 +1274,14 @@ class baseStitcher():
 
         level_delta = int(-np.sign(downsample) * np.log2(np.abs(downsample)))
 
-        tile = self.tiles[0]
-        tile.lazy_load_tile(level_delta=level_delta)
-        tile_shape = tile.lazy_data.shape
+        tile_shape = self._get_slab_cache().get_slicer(self.tiles[0].path, level_delta).shape
 
         if y is None:
             y = int(tile_shape[1]*self.tiles.nrow/2)
 
-        if y > tile.lazy_data.shape[1]*self.tiles.nrow:
+        if y > tile_shape[1]*self.tiles.nrow:
             raise ValueError('Error: y is too large ({}), maximum depth at this downsample is {}.'
-                             .format(y, tile.lazy_data.shape[1]*self.tiles.nrow))
+                             .format(y, tile_shape[1]*self.tiles.nrow))
 
         x_pos = self.database['ABS_H'].to_numpy()
         nx = int(np.ceil((x_pos.max() - x_pos.min()) / downsample + tile_shape[2]))
@@ -930,14 +1305,12 @@ class baseStitcher():
         else:
             merged_data = np.zeros((nz, nx), dtype='uint16')
 
-        for i, tile in enumerate(tqdm(tiles_to_load, desc='Merging', disable=not progress_bar)):
-            tile.lazy_load_tile(level_delta=level_delta)
-            y_tile = int(y - tiles_pos[i, 1])
-            yf = min(y_tile+n_proj, tiles_pos[i, 1]+tile.lazy_data.shape[1])
-            if yf > y:
-                data = tile.lazy_data[:, y_tile:yf, :].max(axis=1)
-            else:
-                data = tile.lazy_data[:, y_tile, :]
+        begins = [int(y - pos[1]) for pos in tiles_pos]
+        ends = [min(b + n_proj, tile_shape[1]) for b in begins]
+        projs = self._read_tiles_planes(tiles_to_load, dim=1, begins=begins, ends=ends, level_delta=level_delta,
+                                        progress_bar=progress_bar)
+
+        for i, (tile, data) in enumerate(zip(tiles_to_load, projs)):
 
             # In debug mode we highlight each tile edge to see where it was
             if debug:
@@ -1007,16 +1380,14 @@ class baseStitcher():
 
         level_delta = int(-np.sign(downsample) * np.log2(np.abs(downsample)))
 
-        tile = self.tiles[0]
-        tile.lazy_load_tile(level_delta=level_delta)
-        tile_shape = tile.lazy_data.shape
+        tile_shape = self._get_slab_cache().get_slicer(self.tiles[0].path, level_delta).shape
 
         if x is None:
             x = int(tile_shape[2]*self.tiles.ncol/2)
 
-        if x > tile.lazy_data.shape[2]*self.tiles.ncol:
+        if x > tile_shape[2]*self.tiles.ncol:
             raise ValueError('Error: y is too large ({}), maximum depth at this downsample is {}.'
-                             .format(x, tile.lazy_data.shape[2]*self.tiles.ncol))
+                             .format(x, tile_shape[2]*self.tiles.ncol))
 
         x_pos = self.database['ABS_H'].to_numpy()
         nx = int(np.ceil((x_pos.max() - x_pos.min()) / downsample + tile_shape[2]))
@@ -1040,14 +1411,12 @@ class baseStitcher():
         else:
             merged_data = np.zeros((nz, ny), dtype='uint16')
 
-        for i, tile in enumerate(tqdm(tiles_to_load, desc='Merging', disable=not progress_bar)):
-            tile.lazy_load_tile(level_delta=level_delta)
-            x_tile = int(x - tiles_pos[i, 2])
-            xf = min(x_tile+n_proj, tiles_pos[i, 2]+tile.lazy_data.shape[2])
-            if xf > x:
-                data = tile.lazy_data[:, :, x_tile:xf].max(axis=2)
-            else:
-                data = tile.lazy_data[:, :, x_tile]
+        begins = [int(x - pos[2]) for pos in tiles_pos]
+        ends = [min(b + n_proj, tile_shape[2]) for b in begins]
+        projs = self._read_tiles_planes(tiles_to_load, dim=2, begins=begins, ends=ends, level_delta=level_delta,
+                                        progress_bar=progress_bar)
+
+        for i, (tile, data) in enumerate(zip(tiles_to_load, projs)):
 
             # In debug mode we highlight each tile edge to see where it was
             if debug:
@@ -1087,6 +1456,60 @@ class baseStitcher():
 
         return merged_data
 
+    def _get_slab_cache(self):
+        """
+        Get the cache used to reconstruct whole sample slices (created with default parameters if needed).
+
+        Returns
+        -------
+        _: slabCache
+            slab cache
+        """
+        if self.slab_cache is None:
+            self.slab_cache = slabCache()
+        return self.slab_cache
+
+    def _read_tiles_planes(self, tiles, dim, begins, ends, level_delta, parts_name='particles', func=None,
+                           progress_bar=True):
+        """
+        Read the planes [begin, end[ along the given dimension for each tile on a thread pool and project them.
+
+        Parameters
+        ----------
+        tiles: list
+            list of tileLoader to read
+        dim: int
+            dimension along which the planes are read
+        begins: list
+            first plane to read for each tile
+        ends: list
+            last plane (excluded) to read for each tile. If end <= begin only the first plane is read.
+        level_delta: int
+            parameter controlling the resolution at which the APR will be read lazily
+        parts_name: string
+            name of the particles to read
+        func: func
+            function applied to the planes of each tile (default: maximum projection along dim)
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        _: list
+            list containing the result of func for each tile
+        """
+        cache = self._get_slab_cache()
+        if func is None:
+            func = lambda u: u.max(axis=dim)
+
+        def _read(args):
+            path, begin, end = args
+            return func(cache.read(path, level_delta, parts_name, dim, begin, max(end, begin + 1)))
+
+        args = [(tile.path, b, e) for tile, b, e in zip(tiles, begins, ends)]
+        with ThreadPoolExecutor(max_workers=cache.n_threads) as executor:
+            return list(tqdm(executor.map(_read, args), total=len(args), desc='Merging', disable=not progress_bar))
+
     def _process_RGB_for_display(self, u):
         """
         Process RGB data for correctly displaying it.
@@ -1303,6 +1726,53 @@ class baseStitcher():
 
         self.projs = projs
 
+    def _precompute_centroids(self, progress_bar=True):
+        """
+        Precompute the cell centroids on each overlapping area for loading the data only once during the stitching.
+        Centroids are expressed in the coordinates of the overlapping area so that they can be directly compared
+        between neighboring tiles.
+
+        Returns
+        -------
+        None
+        """
+        centroids = np.empty((self.nrow, self.ncol), dtype=object)
+        for tile in tqdm(self.tiles, desc='Computing centroids', disable=not progress_bar):
+            tile.load_tile()
+            if self.segment:
+                self.segmenter.compute_segmentation(tile)
+            else:
+                tile.load_segmentation()
+
+            cells = pyapr.measure.find_label_centers(tile.apr, tile.parts_cc, tile.parts)
+            cells = cells[np.all(np.isfinite(cells), axis=1)]
+            if self.z_begin is not None:
+                cells = cells[(cells[:, 0] >= self.z_begin) & (cells[:, 0] < self.z_end)]
+
+            cent = {}
+            if tile.col + 1 < self.tiles.ncol:
+                if self.tiles.tiles_pattern[tile.row, tile.col + 1] == 1:
+                    # EAST 1
+                    tmp = cells[cells[:, 2] >= self.frame_size - self.overlap_h]
+                    cent['east'] = tmp - np.array([0, 0, self.frame_size - self.overlap_h])
+            if tile.col - 1 >= 0:
+                if self.tiles.tiles_pattern[tile.row, tile.col - 1] == 1:
+                    # EAST 2
+                    cent['west'] = cells[cells[:, 2] < self.overlap_h]
+            if tile.row + 1 < self.tiles.nrow:
+                if self.tiles.tiles_pattern[tile.row + 1, tile.col] == 1:
+                    # SOUTH 1
+                    tmp = cells[cells[:, 1] >= self.frame_size - self.overlap_v]
+                    cent['south'] = tmp - np.array([0, self.frame_size - self.overlap_v, 0])
+            if tile.row - 1 >= 0:
+                if self.tiles.tiles_pattern[tile.row - 1, tile.col] == 1:
+                    # SOUTH 2
+                    cent['north'] = cells[cells[:, 1] < self.overlap_v]
+
+            centroids[tile.row, tile.col] = cent
+
+        self.centroids = centroids
+
 
 class tileStitcher(baseStitcher):
     """
@@ -1364,6 +1834,7 @@ class tileStitcher(baseStitcher):
         self.graph_relia_D = None
         self.database = None
         self.projs = None
+        self.centroids = None
 
     def _compute_registration_old(self):
         """
@@ -1527,6 +1998,83 @@ class tileStitcher(baseStitcher):
         self._build_database()
         self._print_info()
 
+    def compute_registration_from_cells(self, search_radius=None, tolerance=2, min_matches=5, progress_bar=True):
+        """
+        Compute the pair-wise registration for all tiles by matching the cell centroids detected on each overlapping
+        area. This is a fast alternative to the max-projection cross-correlation for sparse and bright samples. The
+        segmentation must have been computed and saved beforehand, or activated using `activate_segmentation()`.
+
+        Parameters
+        ----------
+        search_radius: float
+            maximum distance in pixel between a centroid and its match once the expected displacement is applied. By
+            default the largest regularization value is used.
+        tolerance: float
+            maximum distance in pixel between a pair displacement and the consensus displacement to be considered
+            an inlier.
+        min_matches: int
+            minimum number of matched cells for a pair-wise registration to be considered valid. Otherwise the
+            expected displacement is taken with a large uncertainty.
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        None
+        """
+
+        if search_radius is None:
+            search_radius = max(self.reg_x, self.reg_y, self.reg_z)
+
+        self._precompute_centroids(progress_bar=progress_bar)
+
+        for tile in tqdm(self.tiles, desc='Matching centroids', disable=not progress_bar):
+            cent1 = self.centroids[tile.row, tile.col]
+
+            for coords in tile.neighbors:
+                cent2 = self.centroids[coords[0], coords[1]]
+
+                if tile.row == coords[0] and tile.col < coords[1]:
+                    # EAST
+                    reg, rel = _get_centroid_shifts(cent1['east'], cent2['west'],
+                                                    d_expected=[0, 0, self.overlap_h - self.expected_overlap_h],
+                                                    search_radius=search_radius,
+                                                    tolerance=tolerance,
+                                                    min_matches=min_matches)
+
+                elif tile.col == coords[1] and tile.row < coords[0]:
+                    # SOUTH
+                    reg, rel = _get_centroid_shifts(cent1['south'], cent2['north'],
+                                                    d_expected=[0, self.overlap_v - self.expected_overlap_v, 0],
+                                                    search_radius=search_radius,
+                                                    tolerance=tolerance,
+                                                    min_matches=min_matches)
+
+                else:
+                    raise TypeError('Error: couldn''t determine registration to perform.')
+
+                self.cgraph_from.append(np.ravel_multi_index([tile.row, tile.col],
+                                                                    dims=(self.nrow, self.ncol)))
+                self.cgraph_to.append(np.ravel_multi_index([coords[0], coords[1]],
+                                                                  dims=(self.nrow, self.ncol)))
+
+                # Regularize in case of aberrant displacements
+                reg, rel = self._regularize(reg, rel)
+
+                # H=x, V=y, D=z
+                self.dH.append(reg[2])
+                self.dV.append(reg[1])
+                self.dD.append(reg[0])
+                self.relia_H.append(rel[2])
+                self.relia_V.append(rel[1])
+                self.relia_D.append(rel[0])
+
+        self._build_sparse_graphs()
+        self._optimize_sparse_graphs()
+        _, _ = self._produce_registration_map()
+        self._build_database()
+        self._print_info()
+
     def compute_expected_registration(self):
         """
         Compute the expected registration if the expected overlap are correct.
@@ -2278,11 +2826,18 @@ class tileMerger():
         self.level_delta = 0
         self.merged_data = None
         self.merged_segmentation = None
+        # Tile shapes at each resolution (filled when needed).
+        self.tile_shapes = {}
+
+        # Out-of-core merging (set when activate_out_of_core() is called).
+        self.out_of_core = False
+        self.folder_out_of_core = None
+        self.chunk_size = None
 
     def merge_additive(self, reconstruction_mode='constant', tree_mode='mean', progress_bar=True):
         """
-        Perform merging with a mean algorithm for overlapping areas. Maximum merging should be preferred to
-        avoid integer overflowing and higher signals on the overlapping areas.
+        Perform merging with a mean algorithm for overlapping areas. Maximum merging or blending merging
+        (`merge_blend()`) should be preferred to avoid integer overflowing and higher signals on the overlapping areas.
 
         Parameters
         ----------
@@ -2296,37 +2851,17 @@ class tileMerger():
         if self.merged_data is None:
             self._initialize_merged_array()
 
-        H_pos = self.database['ABS_H'].to_numpy()
-        H_pos = (H_pos - H_pos.min())/self.downsample
-        V_pos = self.database['ABS_V'].to_numpy()
-        V_pos = (V_pos - V_pos.min())/self.downsample
-        D_pos = self.database['ABS_D'].to_numpy()
-        D_pos = (D_pos - D_pos.min())/self.downsample
+        D_pos, V_pos, H_pos = self._get_tile_positions()
 
         for i, tile in enumerate(tqdm(self.tiles, desc='Merging', disable=not progress_bar)):
 
-            if self.type == 'apr':
-                if self.lazy:
-                    tile.lazy_load_tile(level_delta=self.level_delta)
-                    data = tile.lazy_data[:, :, :]
-                else:
-                    tile.load_tile()
-                    u = pyapr.reconstruction.APRSlicer(tile.apr, tile.parts, level_delta=self.level_delta,
-                                                        mode=reconstruction_mode, tree_mode=tree_mode)
-                    data = u[:, :, :]
-            else:
-                tile.load_tile()
-                data = tile.data
+            reader = self._get_tile_reader(tile, reconstruction_mode=reconstruction_mode, tree_mode=tree_mode)
 
-            x1 = int(H_pos[i])
-            x2 = int(H_pos[i] + data.shape[2])
-            y1 = int(V_pos[i])
-            y2 = int(V_pos[i] + data.shape[1])
-            z1 = int(D_pos[i])
-            z2 = int(D_pos[i] + data.shape[0])
+            for z, data in self._iter_tile_chunks(reader):
+                self._merge_chunk(self.merged_data, data, D_pos[i] + z, V_pos[i], H_pos[i], np.add)
 
-            self.merged_data[z1:z2, y1:y2, x1:x2] = self.merged_data[z1:z2, y1:y2, x1:x2] + data
-            self.merged_data = self.merged_data.astype('uint16')
+        if self.out_of_core:
+            self.merged_data.flush()
 
     def merge_max(self, reconstruction_mode='constant', tree_mode='mean', debug=False, progress_bar=True):
         """
@@ -2346,45 +2881,21 @@ class tileMerger():
         if self.merged_data is None:
             self._initialize_merged_array()
 
-        H_pos = self.database['ABS_H'].to_numpy()
-        H_pos = (H_pos - H_pos.min())/self.downsample
-        V_pos = self.database['ABS_V'].to_numpy()
-        V_pos = (V_pos - V_pos.min())/self.downsample
-        D_pos = self.database['ABS_D'].to_numpy()
-        D_pos = (D_pos - D_pos.min())/self.downsample
+        D_pos, V_pos, H_pos = self._get_tile_positions()
 
         for i, tile in enumerate(tqdm(self.tiles, desc='Merging', disable=not progress_bar)):
 
-            if self.type == 'apr':
-                if self.lazy:
-                    tile.lazy_load_tile(level_delta=self.level_delta)
-                    data = tile.lazy_data[:, :, :]
-                else:
-                    tile.load_tile()
-                    u = pyapr.reconstruction.APRSlicer(tile.apr, tile.parts, level_delta=self.level_delta,
-                                                        mode=reconstruction_mode, tree_mode=tree_mode)
-                    data = u[:, :, :]
-            else:
-                tile.load_tile()
-                data = downscale_local_mean(tile.data, factors=(self.downsample, self.downsample, self.downsample))
+            reader = self._get_tile_reader(tile, reconstruction_mode=reconstruction_mode, tree_mode=tree_mode)
 
-            # In debug mode we highlight each tile edge to see where it was
-            if debug:
-                data[0, :, :] = 2**16-1
-                data[-1, :, :] = 2 ** 16 - 1
-                data[:, 0, :] = 2 ** 16 - 1
-                data[:, -1, :] = 2 ** 16 - 1
-                data[:, :, 0] = 2 ** 16 - 1
-                data[:, :, -1] = 2 ** 16 - 1
+            for z, data in self._iter_tile_chunks(reader):
+                # In debug mode we highlight each tile edge to see where it was
+                if debug:
+                    self._highlight_edges(data, first=(z == 0), last=(z + data.shape[0] == reader.shape[0]))
 
-            x1 = int(H_pos[i])
-            x2 = int(H_pos[i] + data.shape[2])
-            y1 = int(V_pos[i])
-            y2 = int(V_pos[i] + data.shape[1])
-            z1 = int(D_pos[i])
-            z2 = int(D_pos[i] + data.shape[0])
+                self._merge_chunk(self.merged_data, data, D_pos[i] + z, V_pos[i], H_pos[i], np.maximum)
 
-            self.merged_data[z1:z2, y1:y2, x1:x2] = np.maximum(self.merged_data[z1:z2, y1:y2, x1:x2], data)
+        if self.out_of_core:
+            self.merged_data.flush()
 
     def merge_segmentation(self, reconstruction_mode='constant', tree_mode='max', debug=False, progress_bar=True):
         """
@@ -2404,42 +2915,512 @@ class tileMerger():
         if self.merged_segmentation is None:
             self._initialize_merged_segmentation()
 
-        H_pos = self.database['ABS_H'].to_numpy()
-        H_pos = (H_pos - H_pos.min())/self.downsample
-        V_pos = self.database['ABS_V'].to_numpy()
-        V_pos = (V_pos - V_pos.min())/self.downsample
-        D_pos = self.database['ABS_D'].to_numpy()
-        D_pos = (D_pos - D_pos.min())/self.downsample
+        D_pos, V_pos, H_pos = self._get_tile_positions()
 
         for i, tile in enumerate(tqdm(self.tiles, desc='Merging', disable=not progress_bar)):
 
-            if self.type == 'apr':
-                if self.lazy:
-                    tile.lazy_load_segmentation(level_delta=self.level_delta)
-                    data = tile.lazy_segmentation[:, :, :]
-                else:
-                    tile.load_segmentation()
-                    u = pyapr.reconstruction.APRSlicer(tile.apr, tile.parts_cc, level_delta=self.level_delta,
-                                                        mode=reconstruction_mode, tree_mode=tree_mode)
-                    data = u[:, :, :]
+            reader = self._get_tile_reader(tile, reconstruction_mode=reconstruction_mode, tree_mode=tree_mode,
+                                           segmentation=True)
 
-            # In debug mode we highlight each tile edge to see where it was
-            if debug:
-                data[0, :, :] = 2**16-1
-                data[-1, :, :] = 2 ** 16 - 1
-                data[:, 0, :] = 2 ** 16 - 1
-                data[:, -1, :] = 2 ** 16 - 1
-                data[:, :, 0] = 2 ** 16 - 1
-                data[:, :, -1] = 2 ** 16 - 1
+            for z, data in self._iter_tile_chunks(reader):
+                # In debug mode we highlight each tile edge to see where it was
+                if debug:
+                    self._highlight_edges(data, first=(z == 0), last=(z + data.shape[0] == reader.shape[0]))
 
-            x1 = int(H_pos[i])
-            x2 = int(H_pos[i] + data.shape[2])
-            y1 = int(V_pos[i])
-            y2 = int(V_pos[i] + data.shape[1])
-            z1 = int(D_pos[i])
-            z2 = int(D_pos[i] + data.shape[0])
+                self._merge_chunk(self.merged_segmentation, data, D_pos[i] + z, V_pos[i], H_pos[i], np.maximum)
+
+        if self.out_of_core:
+            self.merged_segmentation.flush()
+
+    def merge_segmentation_global(self, min_overlap=1, reconstruction_mode='constant', tree_mode='max',
+                                  progress_bar=True):
+        """
+        Merge the segmentation with globally unique labels. The labels of each tile are offset into a global label
+        space (uint32) so that labels from different tiles can't collide, and the labels overlapping in the
+        overlapping areas are recorded while merging. Objects spanning several tiles are then fused by computing the
+        connected components of the label overlap graph, and the merged segmentation is relabeled in a single pass
+        using a look-up table.
+
+        Parameters
+        ----------
+        min_overlap: int
+            minimum number of overlapping pixels for two labels to be considered as the same object.
+        reconstruction_mode: string
+            APR reconstruction type among ('constant', 'smooth', 'level')
+        tree_mode: string
+            APR tree reconstruction type among ('mean', 'max')
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        None
+        """
+        self.nx = int(np.ceil(self._get_nx() / self.downsample))
+        self.ny = int(np.ceil(self._get_ny() / self.downsample))
+        self.nz = int(np.ceil(self._get_nz() / self.downsample))
+        self.merged_segmentation = self._allocate_array('merged_segmentation', dtype='uint32')
+
+        D_pos, V_pos, H_pos = self._get_tile_positions()
+
+        offset = 0
+        # Overlap counts of each label pair (encoded as a single uint64), accumulated chunk by chunk so that the
+        # memory grows with the number of distinct pairs instead of the number of overlapping pixels
+        codes = np.empty(0, dtype='uint64')
+        counts = np.empty(0, dtype='int64')
+        for i, tile in enumerate(tqdm(self.tiles, desc='Merging', disable=not progress_bar)):
+
+            reader = self._get_tile_reader(tile, reconstruction_mode=reconstruction_mode, tree_mode=tree_mode,
+                                           segmentation=True)
+
+            n_labels = 0
+            for z, data in self._iter_tile_chunks(reader):
+                data = data.astype('uint32')
+                n_labels = max(n_labels, data.max())
+                data[data > 0] += offset
+                pairs = self._merge_chunk_labels(self.merged_segmentation, data, D_pos[i] + z, V_pos[i], H_pos[i])
+                if pairs.shape[0] > 0:
+                    chunk_codes, chunk_counts = np.unique((pairs[:, 0].astype('uint64') << np.uint64(32)) |
+                                                          pairs[:, 1].astype('uint64'), return_counts=True)
+                    codes, inv = np.unique(np.concatenate((codes, chunk_codes)), return_inverse=True)
+                    counts = np.bincount(inv.ravel(), weights=np.concatenate((counts, chunk_counts)),
+                                         minlength=codes.size).astype('int64')
+            offset += int(n_labels)
+
+        # Labels overlapping on at least min_overlap pixels are fused
+        codes = codes[counts >= min_overlap]
+        pairs = np.stack((codes >> np.uint64(32), codes & np.uint64(0xFFFFFFFF)), axis=1).astype('int64')
+        graph = csr_matrix((np.ones(pairs.shape[0]), (pairs[:, 0], pairs[:, 1])), shape=(offset + 1, offset + 1))
+        _, comp = connected_components(graph, directed=False)
+
+        # Background component is mapped to 0
+        lut = np.where(comp == comp[0], 0, np.where(comp == 0, comp[0], comp)).astype('uint32')
+
+        chunk_size = 32 if self.chunk_size is None else self.chunk_size
+        for z in range(0, self.nz, chunk_size):
+            self.merged_segmentation[z:z+chunk_size] = lut[self.merged_segmentation[z:z+chunk_size]]
+
+        if self.out_of_core:
+            self.merged_segmentation.flush()
+
+    def merge_blend(self, blending='linear', reconstruction_mode='constant', tree_mode='mean', progress_bar=True):
+        """
+        Perform merging with a weighted mean for overlapping areas. Each tile contribution is accumulated in place
+        in a float32 accumulator along with its weight, and the merged data is normalized once at the end. With
+        linear blending, the weights decrease linearly over the overlapping areas to avoid visible seams.
+
+        Parameters
+        ----------
+        blending: string
+            blending type among ('linear', 'mean'). 'mean' gives the same weight to each tile.
+        reconstruction_mode: string
+            APR reconstruction type among ('constant', 'smooth', 'level')
+        tree_mode: string
+            APR tree reconstruction type among ('mean', 'max')
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        None
+        """
+        if blending not in ['linear', 'mean']:
+            raise ValueError('Error: unknown blending \'{}\'.'.format(blending))
+
+        if self.merged_data is None:
+            self._initialize_merged_array()
+
+        accumulator = self._allocate_array('accumulator', dtype='float32')
+        weights = self._allocate_array('weights', dtype='float32')
+
+        D_pos, V_pos, H_pos = self._get_tile_positions()
+        overlap_v, overlap_h = self._get_overlaps()
+
+        for i, tile in enumerate(tqdm(self.tiles, desc='Merging', disable=not progress_bar)):
+
+            reader = self._get_tile_reader(tile, reconstruction_mode=reconstruction_mode, tree_mode=tree_mode)
+
+            if blending == 'linear':
+                wy = _get_blending_ramp(reader.shape[1], overlap_v/self.downsample)
+                wx = _get_blending_ramp(reader.shape[2], overlap_h/self.downsample)
+            else:
+                wy = np.ones(reader.shape[1], dtype='float32')
+                wx = np.ones(reader.shape[2], dtype='float32')
+
+            for z, data in self._iter_tile_chunks(reader):
+                w = np.empty(data.shape, dtype='float32')
+                w[:] = wy[np.newaxis, :, np.newaxis] * wx[np.newaxis, np.newaxis, :]
+                self._merge_chunk(weights, w, D_pos[i] + z, V_pos[i], H_pos[i], np.add)
+                np.multiply(w, data, out=w)
+                self._merge_chunk(accumulator, w, D_pos[i] + z, V_pos[i], H_pos[i], np.add)
+
+        # Normalization is done once at the end, by chunks of planes
+        chunk_size = 32 if self.chunk_size is None else self.chunk_size
+        for z in range(0, self.nz, chunk_size):
+            acc = accumulator[z:z+chunk_size]
+            w = weights[z:z+chunk_size]
+            np.divide(acc, w, out=acc, where=w > 0)
+            np.clip(acc, 0, 2**16-1, out=acc)
+            self.merged_data[z:z+chunk_size] = np.rint(acc)
+
+        if self.out_of_core:
+            self.merged_data.flush()
+            del accumulator, weights, acc, w
+            for name in ['accumulator', 'weights']:
+                os.remove(os.path.join(self.folder_out_of_core, name + '.npy'))
+
+    def export_pyramid(self, path, downsample=(1, 2, 4, 8, 16), method='apr', chunks=(64, 256, 256),
+                       reconstruction_mode='constant', tree_mode='mean', progress_bar=True):
+        """
+        Export the merged sample at several resolutions in a single pass over the tiles, using a multiscale
+        OME-Zarr layout (one array per level named '0', '1', ... and the `multiscales` metadata). Overlapping areas are
+        merged with a maximum algorithm. Requires the `zarr` package.
+
+        Parameters
+        ----------
+        path: string
+            path of the zarr group to create
+        downsample: array_like
+            downsample factors of each level (must be compatible with APR levels)
+        method: string
+            'apr' to reconstruct each level directly from the APR tree (lazy loading required) or 'downsample' to
+            compute each level by downsampling the level below.
+        chunks: array_like
+            chunk shape [z, y, x] of the zarr arrays
+        reconstruction_mode: string
+            APR reconstruction type among ('constant', 'smooth', 'level')
+        tree_mode: string
+            APR tree reconstruction type among ('mean', 'max')
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        None
+        """
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError('Error: zarr is required to export a multiscale pyramid.')
+
+        downsample = sorted(downsample)
+        for ds in downsample:
+            if ds not in [1, 2, 4, 8, 16, 32]:
+                raise ValueError('Error: downsample value should be compatible with APR levels.')
+        if method not in ['apr', 'downsample']:
+            raise ValueError('Error: unknown method \'{}\' for pyramid export.'.format(method))
+        if method == 'apr' and not (self.type == 'apr' and self.lazy):
+            raise TypeError('Error: pyramid export from APR levels requires lazy loadable APR data.')
+
+        # Create the multiscale arrays
+        root = zarr.open_group(path, mode='w')
+        levels = []
+        for i, ds in enumerate(downsample):
+            shape = (int(np.ceil(self._get_nz() / ds)),
+                     int(np.ceil(self._get_ny() / ds)),
+                     int(np.ceil(self._get_nx() / ds)))
+            levels.append(root.zeros(name=str(i), shape=shape, chunks=chunks, dtype='uint16'))
+        root.attrs['multiscales'] = [{'version': '0.4',
+                                      'name': os.path.basename(os.path.normpath(path)),
+                                      'axes': [{'name': d, 'type': 'space'} for d in ['z', 'y', 'x']],
+                                      'datasets': [{'path': str(i),
+                                                    'coordinateTransformations': [{'type': 'scale',
+                                                                                   'scale': [ds, ds, ds]}]}
+                                                   for i, ds in enumerate(downsample)]}]
+
+        # The downsampling is changed for each level and restored even if the export fails
+        downsample_init = self.downsample
+        try:
+            # Tile positions for each level
+            positions = []
+            for ds in downsample:
+                self.set_downsample(ds)
+                positions.append(self._get_tile_positions())
+
+            for i, tile in enumerate(tqdm(self.tiles, desc='Exporting pyramid', disable=not progress_bar)):
+                if method == 'apr':
+                    for level, ds in enumerate(downsample):
+                        self.set_downsample(ds)
+                        reader = self._get_tile_reader(tile, reconstruction_mode=reconstruction_mode,
+                                                       tree_mode=tree_mode)
+                        for z, data in self._iter_tile_chunks(reader):
+                            D_pos, V_pos, H_pos = positions[level]
+                            self._merge_chunk_max(levels[level], data, D_pos[i] + z, V_pos[i], H_pos[i])
+                else:
+                    self.set_downsample(downsample[0])
+                    reader = self._get_tile_reader(tile, reconstruction_mode=reconstruction_mode, tree_mode=tree_mode)
+                    # Chunks must be a multiple of the coarsest downsampling to be downsampled consistently
+                    ratio = downsample[-1] // downsample[0]
+                    chunk_size = None if self.chunk_size is None else int(np.ceil(self.chunk_size / ratio) * ratio)
+                    for z, data in self._iter_tile_chunks(reader, chunk_size=chunk_size):
+                        for level, ds in enumerate(downsample):
+                            if level > 0:
+                                f = ds // downsample[level - 1]
+                                data = downscale_local_mean(data, factors=(f, f, f))
+                            D_pos, V_pos, H_pos = positions[level]
+                            self._merge_chunk_max(levels[level], data, D_pos[i] + z // (ds // downsample[0]),
+                                                  V_pos[i], H_pos[i])
+        finally:
+            self.set_downsample(downsample_init)
+
+    def merge_max_parallel(self, block_shape=(64, 512, 512), n_jobs=-1, progress_bar=True):
+        """
+        Perform merging with a maximum algorithm for overlapping areas using several workers. The merged volume is
+        partitioned into blocks and each worker reconstructs only the parts of the tiles intersecting its block, so
+        that blocks are written independently without any locking. Tiles must be lazy loadable.
+
+        Parameters
+        ----------
+        block_shape: array_like
+            shape of the blocks [z, y, x] in the merged volume
+        n_jobs: int
+            number of workers (-1 uses all the cores)
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        None
+        """
+        if self.merged_data is None:
+            self._initialize_merged_array()
+
+        self._merge_blocks(self.merged_data, 'merged_data', 'particles', block_shape, n_jobs, progress_bar)
+
+    def merge_segmentation_parallel(self, block_shape=(64, 512, 512), n_jobs=-1, progress_bar=True):
+        """
+        Perform segmentation merging with a maximum algorithm for overlapping areas using several workers
+        (see `merge_max_parallel()`).
+
+        Parameters
+        ----------
+        block_shape: array_like
+            shape of the blocks [z, y, x] in the merged volume
+        n_jobs: int
+            number of workers (-1 uses all the cores)
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        None
+        """
+        if self.merged_segmentation is None:
+            self._initialize_merged_segmentation()
+
+        self._merge_blocks(self.merged_segmentation, 'merged_segmentation', 'segmentation cc', block_shape,
+                           n_jobs, progress_bar)
+
+    def activate_out_of_core(self, folder=None, chunk_size=32):
+        """
+        Activate the out-of-core merging. The merged arrays are then stored as memory mapped .npy files and each tile
+        is reconstructed and written chunk by chunk, so that the peak memory is bounded by a chunk of `chunk_size`
+        planes and the OS page cache rather than by the merged volume. The merged arrays can be reopened later using
+        `np.load(path, mmap_mode='r')`.
+
+        Parameters
+        ----------
+        folder: string
+            folder where the merged arrays are stored. By default, a `merged` folder is created in the tiles folder.
+        chunk_size: int
+            number of tile planes reconstructed and written at once.
+
+        Returns
+        -------
+        None
+        """
+
+        if folder is None:
+            folder = os.path.join(self.tiles.path, 'merged')
+        Path(folder).mkdir(parents=True, exist_ok=True)
+
+        self.out_of_core = True
+        self.folder_out_of_core = folder
+        self.chunk_size = chunk_size
+
+    def deactivate_out_of_core(self):
+        """
+        Deactivate the out-of-core merging, merged arrays are stored in RAM.
+
+        """
+
+        self.out_of_core = False
+        self.folder_out_of_core = None
+        self.chunk_size = None
+
+    def merge_roi(self, zlim=None, ylim=None, xlim=None, downsample=None, seg=False):
+        """
+        Merge a region of interest with a maximum algorithm for overlapping areas. Only the tiles intersecting the
+        region are read and only their intersecting part is reconstructed, so that the cost scales with the region
+        size rather than the sample size. Tiles must be lazy loadable.
+
+        Parameters
+        ----------
+        zlim: array_like
+            z limits [begin, end[ of the region in the merged volume (default: whole volume)
+        ylim: array_like
+            y limits [begin, end[ of the region in the merged volume (default: whole volume)
+        xlim: array_like
+            x limits [begin, end[ of the region in the merged volume (default: whole volume)
+        downsample: int
+            downsample factor for the reconstruction, limits are expressed at this downsampling (default: current
+            downsample value).
+        seg: bool
+            option to merge the segmentation instead of the data
+
+        Returns
+        -------
+        data: ndarray
+            merged region of interest
+        """
+        if not (self.type == 'apr' and self.lazy):
+            raise TypeError('Error: region of interest merging is only supported for lazy loadable APR data.')
+
+        downsample_init = self.downsample
+        if downsample is not None:
+            self.set_downsample(downsample)
+
+        # The downsampling is restored even if the merging fails
+        try:
+            shape = (int(np.ceil(self._get_nz() / self.downsample)),
+                     int(np.ceil(self._get_ny() / self.downsample)),
+                     int(np.ceil(self._get_nx() / self.downsample)))
+            block = []
+            for lim, n in zip([zlim, ylim, xlim], shape):
+                if lim is None:
+                    block.append([0, n])
+                else:
+                    block.append([max(int(lim[0]), 0), min(int(lim[1]), n)])
+            block = np.array(block)
+            if np.any(block[:, 1] <= block[:, 0]):
+                raise ValueError('Error: region of interest is empty or outside of the merged volume.')
+
+            parts_name = 'segmentation cc' if seg else 'particles'
+            data = _merge_block(block,
+                                self._get_tiles_in_box(block[:, 0], block[:, 1], parts_name),
+                                self.level_delta,
+                                parts_name,
+                                'uint16')
+        finally:
+            self.set_downsample(downsample_init)
+
+        return data
+
+    def iter_planes(self, slab_depth=1, downsample=None, seg=False, progress_bar=True):
+        """
+        Generator yielding the merged sample by slabs of z-planes, in order, without materializing the merged volume.
+        Each slab is merged with a maximum algorithm from the tiles overlapping it only. The LazySlicer of a tile is
+        opened when the first slab overlapping it is reached and released after the last one, so that the memory
+        is bounded by a slab and the tiles of one z-position. Tiles must be lazy loadable.
+
+        Parameters
+        ----------
+        slab_depth: int
+            number of z-planes in each slab
+        downsample: int
+            downsample factor for the reconstruction (default: current downsample value).
+        seg: bool
+            option to merge the segmentation instead of the data
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        _: generator
+            generator of (z, slab) where z is the first plane of the slab in the merged volume and slab is an
+            array of shape (slab_depth, ny, nx) (the last slab can be thinner)
+        """
+        if not (self.type == 'apr' and self.lazy):
+            raise TypeError('Error: plane by plane merging is only supported for lazy loadable APR data.')
+        if slab_depth < 1:
+            raise ValueError('Error: slab_depth should be at least 1.')
+
+        downsample_init = self.downsample
+        if downsample is not None:
+            self.set_downsample(downsample)
+        level_delta = self.level_delta
+
+        parts_name = 'segmentation cc' if seg else 'particles'
+        shape = (int(np.ceil(self._get_nz() / self.downsample)),
+                 int(np.ceil(self._get_ny() / self.downsample)),
+                 int(np.ceil(self._get_nx() / self.downsample)))
+        D_pos, V_pos, H_pos = self._get_tile_positions()
+        pos = np.vstack((D_pos, V_pos, H_pos)).T.astype('int64')
+        n_planes = self._get_tile_shape(parts_name)[0]
+
+        self.set_downsample(downsample_init)
+
+        slicers = {}
+        for z0 in tqdm(range(0, shape[0], slab_depth), desc='Merging', disable=not progress_bar):
+            z1 = min(z0 + slab_depth, shape[0])
+            slab = np.zeros((z1 - z0, shape[1], shape[2]), dtype='uint16')
+
+            # Release the tiles that are behind the current slab
+            for i in [i for i in slicers if pos[i, 0] + n_planes <= z0]:
+                del slicers[i]
+
+            for i in np.where((pos[:, 0] < z1) & (pos[:, 0] + n_planes > z0))[0]:
+                if i not in slicers:
+                    slicers[i] = pyapr.reconstruction.LazySlicer(self.tiles[int(i)].path, level_delta=level_delta,
+                                                                 parts_name=parts_name, tree_parts_name=parts_name)
+                a = max(z0, pos[i, 0])
+                b = min(z1, pos[i, 0] + n_planes)
+                # LazySlicer squeezes the z dimension when a single plane is read
+                data = slicers[i][a - pos[i, 0]:b - pos[i, 0], :, :]
+                data = data.reshape((b - a,) + data.shape[-2:])
+                self._merge_chunk_max(slab, data, a - z0, pos[i, 1], pos[i, 2])
+
+            yield z0, slab
+
+    def export_planes(self, path, format='tiff', slab_depth=16, downsample=None, seg=False, progress_bar=True):
+        """
+        Export the merged sample to disk plane by plane (see `iter_planes()`), so that full resolution exports
+        run in constant memory. Tiles must be lazy loadable.
+
+        Parameters
+        ----------
+        path: string
+            path of the file to create
+        format: string
+            'tiff' to write a BigTIFF with one page per plane (requires the `tifffile` package) or 'raw' to write
+            the uint16 planes contiguously (C order, native byte order) without header.
+        slab_depth: int
+            number of z-planes merged at once
+        downsample: int
+            downsample factor for the reconstruction (default: current downsample value).
+        seg: bool
+            option to export the segmentation instead of the data
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        shape: tuple
+            shape (nz, ny, nx) of the exported volume
+        """
+        if format not in ['tiff', 'raw']:
+            raise ValueError('Error: unknown format \'{}\' for plane export.'.format(format))
+
+        shape = None
+        if format == 'tiff':
+            try:
+                import tifffile
+            except ImportError:
+                raise ImportError('Error: tifffile is required to export planes to BigTIFF.')
+            with tifffile.TiffWriter(path, bigtiff=True) as tif:
+                for z, slab in self.iter_planes(slab_depth=slab_depth, downsample=downsample, seg=seg,
+                                                progress_bar=progress_bar):
+                    for plane in slab:
+                        tif.write(plane, contiguous=True)
+                    shape = (z + slab.shape[0], slab.shape[1], slab.shape[2])
+        else:
+            with open(path, 'wb') as f:
+                for z, slab in self.iter_planes(slab_depth=slab_depth, downsample=downsample, seg=seg,
+                                                progress_bar=progress_bar):
+                    slab.tofile(f)
+                    shape = (z + slab.shape[0], slab.shape[1], slab.shape[2])
 
-            self.merged_segmentation[z1:z2, y1:y2, x1:x2] = np.maximum(self.merged_segmentation[z1:z2, y1:y2, x1:x2], data)
+        return shape
 
     def crop(self, background=0, xlim=None, ylim=None, zlim=None):
         """
@@ -2481,15 +3462,33 @@ class tileMerger():
             if zlim[1] != self.merged_data.shape[0]:
                 self.merged_data[zlim[1]:, :, :] = background
 
-    def equalize_hist(self, method='opencv'):
+    def equalize_hist(self, method='opencv', n_jobs=1, clip_limit=0.01, chunk_size=32, n_blocks=(4, 8, 8),
+                      n_bins=256):
         """
         Perform histogram equalization to improve the contrast on merged data.
-        Both OpenCV (only 2D) and Skimage (3D but 10 times slower) are available.
+        Both OpenCV (only 2D) and Skimage (3D but 10 times slower) are available. OpenCV equalization can be run on
+        several threads (one slice per thread at a time). The 'blockwise' method is a 3D CLAHE: the volume is divided
+        in `n_blocks` blocks, a contrast limited look-up table is computed from the histogram of each block and the
+        look-up tables of the 8 closest blocks are trilinearly interpolated for each pixel, so that there is no
+        discontinuity between blocks. With `n_blocks=(1, 1, 1)` it is a global contrast limited equalization.
+        Both 'opencv' and 'blockwise' methods work in place by chunks of planes, so they can be used on out-of-core
+        merged data.
 
         Parameters
         ----------
         method: string
-            method for performing histogram equalization among 'skimage' and 'opencv'.
+            method for performing histogram equalization among 'skimage', 'opencv' and 'blockwise'.
+        n_jobs: int
+            number of threads for the 'opencv' method (-1 uses all the cores)
+        clip_limit: float
+            for the 'blockwise' method, maximum fraction of the pixels of a block in a histogram bin. The excess is
+            redistributed uniformly to limit the contrast enhancement.
+        chunk_size: int
+            for the 'blockwise' method, number of planes processed at once
+        n_blocks: tuple
+            for the 'blockwise' method, number of blocks along (z, y, x)
+        n_bins: int
+            for the 'blockwise' method, number of histogram bins
 
         Returns
         -------
@@ -2499,14 +3498,70 @@ class tileMerger():
             raise TypeError('Error: please merge data before equalizing histogram.')
 
         if method == 'opencv':
-            clahe = cv.createCLAHE(tileGridSize=(8, 8))
-            for i in range(self.merged_data.shape[0]):
-                self.merged_data[i] = clahe.apply(self.merged_data[i])
+            if n_jobs == 1:
+                clahe = cv.createCLAHE(tileGridSize=(8, 8))
+                for i in range(self.merged_data.shape[0]):
+                    self.merged_data[i] = clahe.apply(self.merged_data[i])
+            else:
+                # CLAHE objects are not thread safe so each thread has its own
+                local = threading.local()
+
+                def _apply(i):
+                    if not hasattr(local, 'clahe'):
+                        local.clahe = cv.createCLAHE(tileGridSize=(8, 8))
+                    self.merged_data[i] = local.clahe.apply(self.merged_data[i])
+
+                with ThreadPoolExecutor(max_workers=os.cpu_count() if n_jobs < 0 else n_jobs) as executor:
+                    list(executor.map(_apply, range(self.merged_data.shape[0])))
         elif method == 'skimage':
             self.merged_data = equalize_adapthist(self.merged_data)
+        elif method == 'blockwise':
+            data = self.merged_data
+            n_blocks = np.minimum(n_blocks, data.shape)
+            edges = [np.linspace(0, n, b + 1).astype('int64') for n, b in zip(data.shape, n_blocks)]
+            blocks = [np.searchsorted(e, np.arange(n), side='right') - 1 for e, n in zip(edges, data.shape)]
+
+            def _block_index(bz, by, bx):
+                return (bz[:, None, None] * n_blocks[1] + by[None, :, None]) * n_blocks[2] + bx[None, None, :]
+
+            # Histograms of each block are computed by chunks of planes
+            vmin = min(int(data[z:z+chunk_size].min()) for z in range(0, data.shape[0], chunk_size))
+            vmax = max(int(data[z:z+chunk_size].max()) for z in range(0, data.shape[0], chunk_size))
+
+            def _get_bins(u):
+                return (u.astype('int64') - vmin) * n_bins // (vmax - vmin + 1)
+
+            hist = np.zeros(np.prod(n_blocks) * n_bins, dtype='int64')
+            for z in range(0, data.shape[0], chunk_size):
+                ind = _block_index(blocks[0][z:z+chunk_size], blocks[1], blocks[2]) * n_bins
+                hist += np.bincount((ind + _get_bins(data[z:z+chunk_size])).ravel(), minlength=hist.size)
+
+            # Clip the histograms and redistribute the excess uniformly
+            hist = hist.reshape(-1, n_bins).astype('float64')
+            limit = np.maximum(clip_limit * hist.sum(axis=1, keepdims=True), 1)
+            excess = np.maximum(hist - limit, 0).sum(axis=1, keepdims=True)
+            cdf = np.cumsum(np.minimum(hist, limit) + excess / n_bins, axis=1)
+            lut = (cdf - cdf[:, :1]) / np.maximum(cdf[:, -1:] - cdf[:, :1], 1) * (2**16-1)
+            lut = lut.astype('float32').ravel()
+
+            # Look-up tables of neighboring blocks are interpolated
+            interp = [_get_block_interpolation(e, n) for e, n in zip(edges, data.shape)]
+            for z in range(0, data.shape[0], chunk_size):
+                bins = _get_bins(data[z:z+chunk_size])
+                out = np.zeros(bins.shape, dtype='float32')
+                iz0, iz1, wz = [u[z:z+chunk_size] for u in interp[0]]
+                for bz, cz in ((iz0, 1 - wz), (iz1, wz)):
+                    for by, cy in ((interp[1][0], 1 - interp[1][2]), (interp[1][1], interp[1][2])):
+                        for bx, cx in ((interp[2][0], 1 - interp[2][2]), (interp[2][1], interp[2][2])):
+                            w = cz[:, None, None] * cy[None, :, None] * cx[None, None, :]
+                            out += w * lut[_block_index(bz, by, bx) * n_bins + bins]
+                data[z:z+chunk_size] = np.rint(out).astype('uint16')
         else:
             raise ValueError('Error: unknown method for adaptive histogram normalization.')
 
+        if isinstance(self.merged_data, np.memmap):
+            self.merged_data.flush()
+
     def set_downsample(self, downsample):
         """
         Set the downsampling value for the merging reconstruction.
@@ -2541,7 +3596,7 @@ class tileMerger():
         self.ny = int(np.ceil(self._get_ny() / self.downsample))
         self.nz = int(np.ceil(self._get_nz() / self.downsample))
 
-        self.merged_data = np.zeros((self.nz, self.ny, self.nx), dtype='uint16')
+        self.merged_data = self._allocate_array('merged_data', dtype='uint16')
 
     def _initialize_merged_segmentation(self):
         """
@@ -2555,7 +3610,340 @@ class tileMerger():
         self.ny = int(np.ceil(self._get_ny() / self.downsample))
         self.nz = int(np.ceil(self._get_nz() / self.downsample))
 
-        self.merged_segmentation = np.zeros((self.nz, self.ny, self.nx), dtype='uint16')
+        self.merged_segmentation = self._allocate_array('merged_segmentation', dtype='uint16')
+
+    def _allocate_array(self, name, dtype):
+        """
+        Allocate a zero-filled merged array, either in RAM or as a memory mapped .npy file if the out-of-core
+        merging is activated.
+
+        Parameters
+        ----------
+        name: string
+            name of the array (used as file name for out-of-core merging)
+        dtype: string
+            array data type
+
+        Returns
+        -------
+        _: ndarray
+            zero-filled array of shape (nz, ny, nx)
+        """
+        shape = (self.nz, self.ny, self.nx)
+        if self.out_of_core:
+            return np.lib.format.open_memmap(os.path.join(self.folder_out_of_core, name + '.npy'),
+                                            mode='w+', dtype=dtype, shape=shape)
+        else:
+            return np.zeros(shape, dtype=dtype)
+
+    def _merge_blocks(self, merged, name, parts_name, block_shape, n_jobs, progress_bar):
+        """
+        Merge the tiles block by block on several workers.
+
+        Parameters
+        ----------
+        merged: ndarray
+            merged array to fill
+        name: string
+            name of the merged array (used as file name for out-of-core merging)
+        parts_name: string
+            name of the particles to reconstruct
+        block_shape: array_like
+            shape of the blocks [z, y, x] in the merged volume
+        n_jobs: int
+            number of workers
+        progress_bar: bool
+            control the display of the progress bar
+
+        Returns
+        -------
+        None
+        """
+        if not (self.type == 'apr' and self.lazy):
+            raise TypeError('Error: parallel merging is only supported for lazy loadable APR data.')
+
+        if self.out_of_core:
+            merged.flush()
+            output_path = os.path.join(self.folder_out_of_core, name + '.npy')
+        else:
+            output_path = None
+
+        # Partition the merged volume in blocks
+        limits = [[(b, min(b + bs, n)) for b in range(0, n, bs)] for n, bs in zip(merged.shape, block_shape)]
+        blocks = [np.array([lz, ly, lx]) for lz in limits[0] for ly in limits[1] for lx in limits[2]]
+
+        # Blocks are processed by batches to avoid keeping all of them in memory when they are returned
+        batch_size = 4 * (os.cpu_count() if n_jobs < 0 else n_jobs)
+        with Parallel(n_jobs=n_jobs) as parallel:
+            with tqdm(total=len(blocks), desc='Merging', disable=not progress_bar) as pbar:
+                for b in range(0, len(blocks), batch_size):
+                    batch = blocks[b:b + batch_size]
+                    res = parallel(delayed(_merge_block)(block,
+                                                         self._get_tiles_in_box(block[:, 0], block[:, 1], parts_name),
+                                                         self.level_delta,
+                                                         parts_name,
+                                                         merged.dtype.name,
+                                                         output_path) for block in batch)
+                    if output_path is None:
+                        for block, data in zip(batch, res):
+                            merged[block[0, 0]:block[0, 1], block[1, 0]:block[1, 1], block[2, 0]:block[2, 1]] = data
+                    pbar.update(len(batch))
+
+    def _get_tiles_in_box(self, lo, hi, parts_name='particles'):
+        """
+        Find the tiles intersecting a box of the merged volume using the registered tile positions.
+
+        Parameters
+        ----------
+        lo: array_like
+            box lower limits [z, y, x] (included)
+        hi: array_like
+            box upper limits [z, y, x] (excluded)
+        parts_name: string
+            name of the particles used to get the tile shape
+
+        Returns
+        -------
+        _: list
+            list of (path, position, shape) of each intersecting tile in the merged volume coordinates
+        """
+        D_pos, V_pos, H_pos = self._get_tile_positions()
+        pos = np.vstack((D_pos, V_pos, H_pos)).T.astype('int64')
+        shape = np.array(self._get_tile_shape(parts_name))
+
+        ind = np.where(np.all(pos < np.array(hi), axis=1) & np.all(pos + shape > np.array(lo), axis=1))[0]
+
+        return [(self.tiles[int(i)].path, pos[i], shape) for i in ind]
+
+    def _get_tile_shape(self, parts_name='particles'):
+        """
+        Get the tile shape at the asked downsampling (all tiles are assumed to have the same shape).
+
+        Parameters
+        ----------
+        parts_name: string
+            name of the particles to read lazily
+
+        Returns
+        -------
+        _: tuple
+            tile shape [z, y, x]
+        """
+        key = (self.level_delta, parts_name)
+        if key not in self.tile_shapes:
+            slicer = pyapr.reconstruction.LazySlicer(self.tiles[0].path, level_delta=self.level_delta,
+                                                     parts_name=parts_name, tree_parts_name=parts_name)
+            self.tile_shapes[key] = slicer.shape
+        return self.tile_shapes[key]
+
+    def _get_overlaps(self):
+        """
+        Estimate the vertical and horizontal overlaps between neighboring tiles from the registered tile positions.
+
+        Returns
+        -------
+        overlap_v, overlap_h: float
+            vertical and horizontal overlaps in pixel at full resolution
+        """
+        overlaps = []
+        for loc, d in zip(['row', 'col'], ['ABS_V', 'ABS_H']):
+            pos = self.database.groupby(loc)[d].median().sort_index().to_numpy()
+            if pos.size > 1:
+                overlaps.append(self.frame_size - np.median(np.diff(pos)))
+            else:
+                overlaps.append(0)
+
+        return overlaps[0], overlaps[1]
+
+    def _get_tile_positions(self):
+        """
+        Compute the position of each tile in the merged array in accordance with the asked downsampling.
+
+        Returns
+        -------
+        D_pos, V_pos, H_pos: ndarray
+            tiles position in z, y and x
+        """
+        H_pos = self.database['ABS_H'].to_numpy()
+        H_pos = (H_pos - H_pos.min())/self.downsample
+        V_pos = self.database['ABS_V'].to_numpy()
+        V_pos = (V_pos - V_pos.min())/self.downsample
+        D_pos = self.database['ABS_D'].to_numpy()
+        D_pos = (D_pos - D_pos.min())/self.downsample
+
+        return D_pos, V_pos, H_pos
+
+    def _get_tile_reader(self, tile, reconstruction_mode='constant', tree_mode='mean', segmentation=False):
+        """
+        Get an object that can be sliced to reconstruct the tile (or its segmentation) at the asked downsampling.
+
+        Parameters
+        ----------
+        tile: tileLoader
+            tile to reconstruct
+        reconstruction_mode: string
+            APR reconstruction type among ('constant', 'smooth', 'level')
+        tree_mode: string
+            APR tree reconstruction type among ('mean', 'max')
+        segmentation: bool
+            option to reconstruct the segmentation instead of the data
+
+        Returns
+        -------
+        _: LazySlicer, APRSlicer or ndarray
+            sliceable tile reconstruction
+        """
+        if self.type == 'apr':
+            if self.lazy:
+                if segmentation:
+                    tile.lazy_load_segmentation(level_delta=self.level_delta)
+                    return tile.lazy_segmentation
+                tile.lazy_load_tile(level_delta=self.level_delta)
+                return tile.lazy_data
+            else:
+                tile.load_tile()
+                if segmentation:
+                    tile.load_segmentation()
+                    parts = tile.parts_cc
+                else:
+                    parts = tile.parts
+                return pyapr.reconstruction.APRSlicer(tile.apr, parts, level_delta=self.level_delta,
+                                                      mode=reconstruction_mode, tree_mode=tree_mode)
+        else:
+            if segmentation:
+                raise TypeError('Error: segmentation merging is only supported for APR data.')
+            tile.load_tile()
+            return downscale_local_mean(tile.data, factors=(self.downsample, self.downsample, self.downsample))
+
+    def _iter_tile_chunks(self, reader, chunk_size=None):
+        """
+        Iterate over the tile planes by chunks. The whole tile is reconstructed at once unless the out-of-core
+        merging is activated.
+
+        Parameters
+        ----------
+        reader: LazySlicer, APRSlicer or ndarray
+            sliceable tile reconstruction
+        chunk_size: int
+            number of planes per chunk (default: the out-of-core chunk size)
+
+        Returns
+        -------
+        _: generator
+            generator of (z, data) where z is the first plane of the chunk in the tile
+        """
+        n_planes = reader.shape[0]
+        if chunk_size is None:
+            chunk_size = n_planes if self.chunk_size is None else self.chunk_size
+        for z in range(0, n_planes, chunk_size):
+            z_end = min(z + chunk_size, n_planes)
+            # LazySlicer squeezes the z dimension when a single plane is read
+            yield z, reader[z:z_end, :, :].reshape((z_end - z,) + tuple(reader.shape[1:]))
+
+    @staticmethod
+    def _merge_chunk(merged, data, z1, y1, x1, op):
+        """
+        Merge a chunk of data in place in the merged array.
+
+        Parameters
+        ----------
+        merged: ndarray
+            merged array (can be memory mapped)
+        data: ndarray
+            chunk to merge
+        z1, y1, x1: float
+            position of the chunk in the merged array
+        op: numpy.ufunc
+            operation used to merge the data (e.g. np.maximum or np.add)
+
+        Returns
+        -------
+        None
+        """
+        z1, y1, x1 = int(z1), int(y1), int(x1)
+        view = merged[z1:z1+data.shape[0], y1:y1+data.shape[1], x1:x1+data.shape[2]]
+        op(view, data, out=view, casting='unsafe')
+
+    @staticmethod
+    def _merge_chunk_labels(merged, data, z1, y1, x1):
+        """
+        Merge a chunk of labels in place in the merged array and return the pairs of labels overlapping.
+
+        Parameters
+        ----------
+        merged: ndarray
+            merged label array (can be memory mapped)
+        data: ndarray
+            chunk of labels to merge
+        z1, y1, x1: float
+            position of the chunk in the merged array
+
+        Returns
+        -------
+        _: ndarray
+            array of shape (n, 2) containing the (merged, chunk) labels of each overlapping pixel
+        """
+        z1, y1, x1 = int(z1), int(y1), int(x1)
+        view = merged[z1:z1+data.shape[0], y1:y1+data.shape[1], x1:x1+data.shape[2]]
+        mask = data > 0
+        overlap = mask & (view > 0)
+        pairs = np.vstack((view[overlap], data[overlap])).T
+        view[mask] = data[mask]
+        return pairs
+
+    @staticmethod
+    def _merge_chunk_max(merged, data, z1, y1, x1):
+        """
+        Merge a chunk of data with a maximum algorithm in any array supporting numpy slicing (e.g. a zarr array).
+        The chunk is cropped if it goes beyond the merged array.
+
+        Parameters
+        ----------
+        merged: array_like
+            merged array
+        data: ndarray
+            chunk to merge
+        z1, y1, x1: float
+            position of the chunk in the merged array
+
+        Returns
+        -------
+        None
+        """
+        lo = np.array([int(z1), int(y1), int(x1)])
+        hi = np.minimum(lo + np.array(data.shape), np.array(merged.shape))
+        if np.any(hi <= lo):
+            return
+        data = data[:hi[0]-lo[0], :hi[1]-lo[1], :hi[2]-lo[2]]
+        region = merged[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        merged[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = np.maximum(region, data).astype(merged.dtype)
+
+    @staticmethod
+    def _highlight_edges(data, first=True, last=True):
+        """
+        Add white border on the edge of a tile chunk to see where it was overlapping.
+
+        Parameters
+        ----------
+        data: ndarray
+            tile chunk
+        first: bool
+            the chunk contains the first plane of the tile
+        last: bool
+            the chunk contains the last plane of the tile
+
+        Returns
+        -------
+        None
+        """
+        if first:
+            data[0, :, :] = 2**16-1
+        if last:
+            data[-1, :, :] = 2 ** 16 - 1
+        data[:, 0, :] = 2 ** 16 - 1
+        data[:, -1, :] = 2 ** 16 - 1
+        data[:, :, 0] = 2 ** 16 - 1
+        data[:, :, -1] = 2 ** 16 - 1
 
     def _get_nx(self):
         """
@@ -0,0 +1,263 @@
+"""
+Test script for merging pipeline.
+
+By using this code you agree to the terms of the software license agreement.
+
+© Copyright 2020 Wyss Center for Bio and Neuro Engineering – All rights reserved
+"""
+
+import paprica
+import pyapr
+import os
+import numpy as np
+
+
+def get_synthetic_tiles(path, frame_size=32, overlap=25, n_planes=24, nrow=2, ncol=2):
+    # Crop overlapping tiles from a synthetic volume and save them as APR with their tree
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(0)
+    step = frame_size - int(overlap / 100 * frame_size)
+    data = np.full((n_planes, step * (nrow - 1) + frame_size, step * (ncol - 1) + frame_size), 100, dtype='uint16')
+    for z, y, x in rng.integers(0, data.shape, (150, 3)):
+        data[max(z-1, 0):z+2, max(y-1, 0):y+2, max(x-1, 0):x+2] = rng.integers(500, 2000)
+    data += rng.integers(0, 20, data.shape).astype('uint16')
+
+    for v in range(nrow):
+        for h in range(ncol):
+            tile = np.ascontiguousarray(data[:, v*step:v*step+frame_size, h*step:h*step+frame_size])
+            apr, parts = pyapr.converter.get_apr(tile, verbose=False)
+            tree_parts = pyapr.tree.fill_tree_mean(apr, parts, pyapr.FloatParticles())
+            pyapr.io.write(os.path.join(path, '{}_{}.apr'.format(v, h)), apr, parts, tree_parts=tree_parts)
+
+    tiles = paprica.parser.tileParser(str(path), frame_size=frame_size, ftype='apr', verbose=False)
+    stitcher = paprica.stitcher.tileStitcher(tiles, overlap_h=overlap, overlap_v=overlap)
+    stitcher.compute_expected_registration()
+    return tiles, stitcher.database
+
+
+def test_equalize_hist(tmp_path):
+    tiles, database = get_synthetic_tiles(tmp_path)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+
+    # Volume with a dark and a bright half
+    rng = np.random.default_rng(0)
+    data = (rng.random((20, 64, 64)) * 100).astype('uint16')
+    data[:, :, 32:] += 1000
+    data[:, :, 32:] *= 2
+
+    # A single block is a global contrast limited equalization (monotonic look-up table)
+    merger.merged_data = data.copy()
+    merger.equalize_hist(method='blockwise', n_blocks=(1, 1, 1), clip_limit=1)
+    order = np.argsort(data, axis=None, kind='stable')
+    assert(np.all(np.diff(merger.merged_data.ravel()[order].astype('int64')) >= 0))
+    assert(merger.merged_data.max() == 2**16-1)
+
+    # Blocks are processed by chunks of planes consistently and locally enhance the contrast
+    merger.merged_data = data.copy()
+    merger.equalize_hist(method='blockwise', n_blocks=(2, 4, 4), clip_limit=1, chunk_size=3)
+    local = merger.merged_data.copy()
+    merger.merged_data = data.copy()
+    merger.equalize_hist(method='blockwise', n_blocks=(2, 4, 4), clip_limit=1, chunk_size=32)
+    assert(np.array_equal(merger.merged_data, local))
+    merger.merged_data = data.copy()
+    merger.equalize_hist(method='blockwise', n_blocks=(1, 1, 1), clip_limit=1)
+    assert(local[:, :, :16].std() > 2 * merger.merged_data[:, :, :16].std())
+
+    # Each block stretches its part of a ramp to the whole range, the interpolation avoids jumps at the block borders
+    ramp = np.tile(np.arange(64, dtype='uint16') * 100, (8, 64, 1))
+    merger.merged_data = ramp.copy()
+    merger.equalize_hist(method='blockwise', n_blocks=(1, 1, 4), clip_limit=1)
+    steps = np.diff(merger.merged_data[0, 0].astype('int64'))
+    assert(np.abs(steps).max() < 2**13)
+
+
+def test_merge_out_of_core(tmp_path):
+    tiles, database = get_synthetic_tiles(tmp_path)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+    merger.merge_max(progress_bar=False)
+    assert(merger.merged_data.max() > 0)
+
+    # Out-of-core merging gives the same result, written chunk by chunk in a memory mapped file. With 24 planes per
+    # tile, a chunk size of 23 leaves a last chunk of a single plane.
+    for chunk_size in [5, 23]:
+        merger_ooc = paprica.stitcher.tileMerger(tiles, database)
+        merger_ooc.activate_out_of_core(folder=str(tmp_path / 'merged'), chunk_size=chunk_size)
+        merger_ooc.merge_max(progress_bar=False)
+        assert(isinstance(merger_ooc.merged_data, np.memmap))
+        assert(np.array_equal(merger_ooc.merged_data, merger.merged_data))
+        assert(np.array_equal(np.load(str(tmp_path / 'merged' / 'merged_data.npy'), mmap_mode='r'),
+                              merger.merged_data))
+
+    merger_ooc.deactivate_out_of_core()
+    assert(not merger_ooc.out_of_core and merger_ooc.chunk_size is None)
+
+
+def test_merge_max_parallel(tmp_path):
+    tiles, database = get_synthetic_tiles(tmp_path)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+    merger.merge_max(progress_bar=False)
+
+    # Blocks smaller than the tiles and not aligned with them
+    merger_parallel = paprica.stitcher.tileMerger(tiles, database)
+    merger_parallel.merge_max_parallel(block_shape=(10, 20, 17), n_jobs=2, progress_bar=False)
+    assert(np.array_equal(merger_parallel.merged_data, merger.merged_data))
+
+
+def test_merge_blend(tmp_path):
+    tiles, database = get_synthetic_tiles(tmp_path)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+    merger.merge_max(progress_bar=False)
+
+    # Away from the overlaps (tiles are 32 pixels wide every 24 pixels) blending is identical to maximum merging,
+    # elsewhere a weighted mean can't exceed the maximum
+    for blending in ['linear', 'mean']:
+        merger_blend = paprica.stitcher.tileMerger(tiles, database)
+        merger_blend.merge_blend(blending=blending, progress_bar=False)
+        assert(merger_blend.merged_data.shape == merger.merged_data.shape)
+        assert(np.array_equal(merger_blend.merged_data[:, :24, :24], merger.merged_data[:, :24, :24]))
+        assert(np.array_equal(merger_blend.merged_data[:, 32:, 32:], merger.merged_data[:, 32:, 32:]))
+        assert(np.all(merger_blend.merged_data <= merger.merged_data))
+
+    # Out-of-core blending gives the same result and removes its temporary arrays
+    merger_ooc = paprica.stitcher.tileMerger(tiles, database)
+    merger_ooc.activate_out_of_core(folder=str(tmp_path / 'merged'), chunk_size=5)
+    merger_ooc.merge_blend(blending='mean', progress_bar=False)
+    assert(np.array_equal(merger_ooc.merged_data, merger_blend.merged_data))
+    assert(os.listdir(str(tmp_path / 'merged')) == ['merged_data.npy'])
+
+
+def test_export_pyramid(tmp_path):
+    import zarr
+    tiles, database = get_synthetic_tiles(tmp_path)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+    merged = []
+    for ds in [1, 2]:
+        merger.set_downsample(ds)
+        merger.merged_data = None
+        merger.merge_max(progress_bar=False)
+        merged.append(merger.merged_data)
+    merger.set_downsample(1)
+
+    # Levels reconstructed from the APR tree are identical to maximum merging at the same downsampling
+    merger.export_pyramid(str(tmp_path / 'pyramid_apr.zarr'), downsample=(1, 2), method='apr', chunks=(8, 16, 16),
+                          progress_bar=False)
+    root = zarr.open_group(str(tmp_path / 'pyramid_apr.zarr'), mode='r')
+    for i in range(2):
+        assert(np.array_equal(root[str(i)][:], merged[i]))
+    assert(len(root.attrs['multiscales'][0]['datasets']) == 2)
+
+    # Downsampled levels are bounded by the level below
+    merger.export_pyramid(str(tmp_path / 'pyramid_ds.zarr'), downsample=(1, 2), method='downsample',
+                          progress_bar=False)
+    root = zarr.open_group(str(tmp_path / 'pyramid_ds.zarr'), mode='r')
+    assert(np.array_equal(root['0'][:], merged[0]))
+    assert(root['1'].shape == merged[1].shape)
+    assert(root['1'][:].max() <= merged[0].max())
+    assert(merger.downsample == 1)
+
+    # The downsampling is restored if the export fails
+    def _fail(*args, **kwargs):
+        raise RuntimeError('Error: export failed.')
+    merger._merge_chunk_max = _fail
+    try:
+        merger.export_pyramid(str(tmp_path / 'pyramid_fail.zarr'), downsample=(2, 4), progress_bar=False)
+    except RuntimeError:
+        pass
+    assert(merger.downsample == 1 and merger.level_delta == 0)
+
+    # Downsampling by chunks with a last chunk of a single plane (25 planes, chunks of 24 planes)
+    tiles, database = get_synthetic_tiles(tmp_path / 'odd', n_planes=25)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+    merger.merge_max(progress_bar=False)
+    merger.activate_out_of_core(folder=str(tmp_path / 'odd' / 'merged'), chunk_size=23)
+    merger.export_pyramid(str(tmp_path / 'pyramid_odd.zarr'), downsample=(1, 2), method='downsample',
+                          progress_bar=False)
+    root = zarr.open_group(str(tmp_path / 'pyramid_odd.zarr'), mode='r')
+    assert(np.array_equal(root['0'][:], merger.merged_data))
+    assert(root['1'].shape[0] == 13)
+
+
+def test_merge_roi(tmp_path):
+    tiles, database = get_synthetic_tiles(tmp_path)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+    merger.merge_max(progress_bar=False)
+    merged = merger.merged_data
+
+    # Regions inside one tile, across the overlaps and clipped to the merged volume
+    for zlim, ylim, xlim in [((2, 10), (3, 20), (4, 21)), ((0, 24), (20, 40), (10, 50)), (None, (-5, 100), None),
+                             ((5, 8), (31, 32), (0, 56))]:
+        roi = merger.merge_roi(zlim=zlim, ylim=ylim, xlim=xlim)
+        sl = tuple(slice(None) if lim is None else slice(max(lim[0], 0), lim[1]) for lim in [zlim, ylim, xlim])
+        assert(np.array_equal(roi, merged[sl]))
+
+    # Region at a lower resolution
+    merger_ds = paprica.stitcher.tileMerger(tiles, database)
+    merger_ds.set_downsample(2)
+    merger_ds.merge_max(progress_bar=False)
+    roi = merger.merge_roi(ylim=(5, 20), downsample=2)
+    assert(np.array_equal(roi, merger_ds.merged_data[:, 5:20]))
+    assert(merger.downsample == 1)
+
+    # Empty region
+    try:
+        merger.merge_roi(zlim=(30, 40), downsample=2)
+        assert(False)
+    except ValueError:
+        pass
+    assert(merger.downsample == 1)
+
+
+def test_export_planes(tmp_path):
+    import tifffile
+    tiles, database = get_synthetic_tiles(tmp_path)
+    merger = paprica.stitcher.tileMerger(tiles, database)
+    merger.merge_max(progress_bar=False)
+    merged = merger.merged_data
+
+    # Slabs are yielded in order and concatenate to the merged volume
+    for slab_depth in [1, 5]:
+        slabs = list(merger.iter_planes(slab_depth=slab_depth, progress_bar=False))
+        assert([z for z, _ in slabs] == list(range(0, merged.shape[0], slab_depth)))
+        assert(np.array_equal(np.concatenate([slab for _, slab in slabs]), merged))
+
+    shape = merger.export_planes(str(tmp_path / 'merged.raw'), format='raw', slab_depth=7, progress_bar=False)
+    assert(shape == merged.shape)
+    assert(np.array_equal(np.fromfile(str(tmp_path / 'merged.raw'), dtype='uint16').reshape(shape), merged))
+
+    shape = merger.export_planes(str(tmp_path / 'merged.tif'), format='tiff', slab_depth=7, progress_bar=False)
+    assert(np.array_equal(tifffile.imread(str(tmp_path / 'merged.tif')), merged))
+
+
+def test_merge_segmentation_global(tmp_path):
+    # Two tiles side by side with an object spanning their overlap and an object seen by the first tile only
+    data = np.full((24, 32, 56), 100, dtype='uint16')
+    data[5:15, 10:20, 10:50] = 1000
+    data[5:15, 10:20, 2:6] = 1000
+    for h in range(2):
+        tile = np.ascontiguousarray(data[:, :, h*24:h*24+32])
+        apr, parts = pyapr.converter.get_apr(tile, verbose=False)
+        tree_parts = pyapr.tree.fill_tree_mean(apr, parts, pyapr.FloatParticles())
+        path = os.path.join(str(tmp_path), '0_{}.apr'.format(h))
+        pyapr.io.write(path, apr, parts, tree_parts=tree_parts)
+        cc = pyapr.LongParticles()
+        pyapr.measure.connected_component(apr, parts > 500, cc)
+        pyapr.io.write_particles(path, cc, parts_name='segmentation cc', tree=False, append=True)
+        pyapr.io.write_particles(path, pyapr.tree.fill_tree_max(apr, cc), parts_name='segmentation cc', tree=True,
+                                 append=True)
+
+    tiles = paprica.parser.tileParser(str(tmp_path), frame_size=32, ftype='apr', verbose=False)
+    stitcher = paprica.stitcher.tileStitcher(tiles, overlap_h=25, overlap_v=25)
+    stitcher.compute_expected_registration()
+
+    # In memory and out of core with a last chunk of a single plane
+    merger = paprica.stitcher.tileMerger(tiles, stitcher.database)
+    merger.merge_segmentation_global(progress_bar=False)
+    labels = np.unique(merger.merged_segmentation)
+    assert(labels.size == 3)
+    assert(np.unique(merger.merged_segmentation[5:15, 10:20, 10:50]).size == 1)
+    assert(merger.merged_segmentation[10, 15, 4] != merger.merged_segmentation[10, 15, 30] > 0)
+
+    merger_ooc = paprica.stitcher.tileMerger(tiles, stitcher.database)
+    merger_ooc.activate_out_of_core(folder=str(tmp_path / 'merged'), chunk_size=23)
+    merger_ooc.merge_segmentation_global(progress_bar=False)
+    assert(np.array_equal(merger_ooc.merged_segmentation, merger.merged_segmentation))
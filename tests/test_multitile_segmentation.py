@@ -153,4 +153,446 @@ def test_main():
 
     # Segment tiles
     segmenter = paprica.multitileSegmenter.from_trainer(tiles_apr, database=stitcher.database, trainer=trainer)
-    segmenter.compute_multitile_segmentation(save_cc=False)
\ No newline at end of file
+    segmenter.compute_multitile_segmentation(save_cc=False)
+
+
+def test_feature_hash(tmp_path):
+    import types
+    from functools import partial
+    from paprica.segmenter import _hash_function, _compute_features, featureBank
+
+    # Hash is stable and changes with the source code, the parameters and the version
+    assert(_hash_function(compute_features) == _hash_function(compute_features))
+    assert(_hash_function(compute_features) != _hash_function(compute_features, version=2))
+    assert(_hash_function(partial(gaussian_blur, sigma=1)) != _hash_function(partial(gaussian_blur, sigma=2)))
+    assert(_hash_function(lambda apr, parts: gaussian_blur(apr, parts, sigma=1)) !=
+           _hash_function(lambda apr, parts: gaussian_blur(apr, parts, sigma=2)))
+    assert(_hash_function(featureBank([('gaussian', 1)])) != _hash_function(featureBank([('gaussian', 2)])))
+
+    # Functions without source code can not be cached
+    globs = {}
+    exec('def f(apr, parts):\n    return parts', globs)
+    assert(_hash_function(globs['f']) is None)
+
+    # The cache is keyed on the tile content, writing other particles to the tile file does not invalidate it
+    img = (np.random.rand(16, 32, 32)*100 + 100).astype('float32')
+    apr, parts = pyapr.converter.get_apr(img)
+    path = str(tmp_path / 'tile.apr')
+    pyapr.io.write(path, apr, parts)
+    tile = types.SimpleNamespace(apr=apr, parts=parts, path=path)
+    bank = featureBank(['intensity', ('gaussian', 1.5)])
+    f = _compute_features(tile, bank, cache=True)
+    pyapr.io.write_particles(path, pyapr.LongParticles(apr.total_number_particles()), parts_name='segmentation cc',
+                             tree=False, append=True)
+    assert(np.array_equal(_compute_features(tile, bank, cache=True), f))
+    assert(len(os.listdir(str(tmp_path / 'features'))) == 1)
+    _compute_features(tile, bank, cache=True, cache_version=2)
+    assert(len(os.listdir(str(tmp_path / 'features'))) == 2)
+
+
+def test_compiled_forest():
+    from sklearn import preprocessing
+    from sklearn.pipeline import make_pipeline
+    from sklearn.ensemble import RandomForestClassifier
+    from paprica.segmenter import compiledForest
+
+    x = np.random.randn(2000, 6) * np.array([1, 10, 100, 1, 1, 1])
+    y = (x[:, 0] + x[:, 1] / 10 > 0) * 2 + (x[:, 2] > 50)
+    clf = make_pipeline(preprocessing.StandardScaler(), RandomForestClassifier(n_estimators=10)).fit(x, y)
+    compiled_clf = compiledForest(clf)
+
+    x = np.random.randn(10000, 6) * np.array([1, 10, 100, 1, 1, 1])
+    assert(np.allclose(compiled_clf.predict_proba(x), clf.predict_proba(x)))
+    assert((compiled_clf.predict(x) == clf.predict(x)).all())
+
+    # Float32 features (e.g. from featureBank) are scaled in float32 by sklearn, closely spaced values with a large
+    # offset make any difference in the scaling arithmetic flip decisions
+    x = (np.random.rand(10000, 6) * 1e-3 + np.array([1e4, 1, 1e3, 1, 1, 1])).astype('float32')
+    y = np.random.randint(0, 3, 10000)
+    clf = make_pipeline(preprocessing.StandardScaler(), RandomForestClassifier(n_estimators=10)).fit(x, y)
+    compiled_clf = compiledForest(clf)
+    assert((compiled_clf.predict_proba(x) == clf.predict_proba(x)).all())
+    assert((compiled_clf.predict(x) == clf.predict(x)).all())
+
+
+def test_cells_matching():
+    from paprica.segmenter import _match_cells
+
+    # Second set contains shifted duplicates of the first 500 cells and new cells
+    np.random.seed(0)
+    c1 = np.random.rand(1000, 3) * 500
+    c2 = np.vstack((c1[:500] + np.random.randn(500, 3) * 0.5, np.random.rand(500, 3) * 500 + 1000))
+    ind1, ind2 = _match_cells(c1, c2, lowe_ratio=0.7, distance_max=5)
+    assert((ind1 == ind2).all())
+    assert(np.isin(ind1, np.arange(500)).mean() == 1)
+    assert(ind1.size > 450)
+
+
+def test_feature_bank():
+    from paprica.segmenter import featureBank
+
+    img = (np.random.rand(32, 64, 64)*100 + 100).astype('float32')
+    img[10:20, 20:30, 20:30] += 500
+    apr, parts = pyapr.converter.get_apr(img)
+
+    bank = featureBank(['intensity', 'levels', ('gaussian', 1.5), ('gradmag', 1.5), ('laplacian', 1.5)])
+    f = bank(apr, parts)
+    gauss = np.array(gaussian_blur(apr, parts, sigma=1.5, size=11))
+    assert(f.shape == (apr.total_number_particles(), bank.n_features))
+    assert(f.dtype == np.float32)
+    assert(np.allclose(f[:, 0], np.array(parts)))
+    assert(np.allclose(f[:, 1], particle_levels(apr)))
+    assert(np.allclose(f[:, 2], gauss))
+    assert(np.allclose(f[:, 3], np.array(compute_gradmag(apr, gaussian_blur(apr, parts, sigma=1.5, size=11))),
+                       atol=1e-3))
+    assert(np.allclose(f[:, 4], np.array(compute_laplacian(apr, gaussian_blur(apr, parts, sigma=1.5, size=11)))))
+
+
+def test_tree_features():
+    from paprica.segmenter import featureBank, compute_tree_features
+
+    img = (np.random.rand(32, 64, 64)*100 + 100).astype('float32')
+    img[10:20, 20:30, 20:30] += 500
+    apr, parts = pyapr.converter.get_apr(img)
+
+    f = compute_tree_features(apr, parts, num_levels=(0, 1, 2))
+    assert(f.shape == (apr.total_number_particles(), 3))
+    assert(np.allclose(f[:, 0], np.array(parts)))
+    assert(np.allclose(featureBank([('tree', 1), ('tree', 2)])(apr, parts), f[:, 1:]))
+
+
+def test_training_sampler():
+    from paprica.segmenter import _hash_priority, _sample_stratified
+
+    idx = np.arange(10000)
+    labels = np.concatenate((np.ones(9000), np.full(900, 2), np.full(100, 3)))
+    priority = _hash_priority(idx)
+    assert((priority >= 0).all() and (priority < 1).all())
+
+    # Budget is shared equally between classes, small classes are fully used
+    ind = _sample_stratified(priority, labels, 1000)
+    assert(ind.size == 1000)
+    assert((np.bincount(labels[ind].astype(int)) == [0, 450, 450, 100]).all())
+
+    # Adding samples keeps the previous ones unless they are replaced (reservoir sampling)
+    ind_sub = _sample_stratified(priority[:5000], np.ones(5000), 100)
+    ind_all = _sample_stratified(priority, np.ones(10000), 100)
+    assert(np.isin(ind_all[ind_all < 5000], ind_sub).all())
+
+
+def test_out_of_core_features():
+    import types
+    import warnings
+    from paprica.segmenter import featureBank, _compute_features
+
+    img = (np.random.rand(32, 64, 64)*100 + 100).astype('float32')
+    apr, parts = pyapr.converter.get_apr(img)
+    tile = types.SimpleNamespace(apr=apr, parts=parts, path=None)
+
+    # featureBank features are written in a temporary memory mapped file
+    bank = featureBank(['intensity', ('gaussian', 1.5)])
+    f = _compute_features(tile, bank, out_of_core=True)
+    assert(isinstance(f, np.memmap))
+    assert(np.allclose(f, bank(apr, parts)))
+
+    # Other functions can not be computed out of core
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        f = _compute_features(tile, lambda apr, parts: bank(apr, parts), out_of_core=True)
+    assert(not isinstance(f, np.memmap))
+    assert(any('featureBank' in str(x.message) for x in w))
+
+
+def test_sample_pixel_list_on_APR():
+    import types
+
+    img = (np.random.rand(32, 64, 64)*100 + 100).astype('float32')
+    img[10:20, 20:30, 20:30] += 500
+    apr, parts = pyapr.converter.get_apr(img)
+    tile = types.SimpleNamespace(apr=apr, parts=parts, load_tile=lambda: None)
+    trainer = paprica.tileTrainer(tile, func_to_compute_features=None)
+
+    # Per pixel search of the particle containing each pixel
+    def find_particle(coords):
+        it = apr.iterator()
+        for level in range(it.level_min(), it.level_max()+1):
+            particle_size = 2 ** (apr.level_max() - level)
+            z_l, x_l, y_l = coords // particle_size
+            for idx in range(it.begin(level, z_l, x_l), it.end()):
+                if it.y(idx) == y_l:
+                    return idx
+
+    # Labels spread in the volume, then on a single plane and a single pixel row
+    pixel_list = np.random.randint(0, [32, 64, 64], (500, 3))
+    for coords in [pixel_list, np.column_stack((np.full(50, 15), pixel_list[:50, 1:])),
+                   np.column_stack((pixel_list[:50, 0], np.full(50, 25), pixel_list[:50, 2]))]:
+        trainer.pixel_list = coords
+        trainer._sample_pixel_list_on_APR(max_memory=1e5)
+        assert((trainer.parts_train_idx == [find_particle(c) for c in coords]).all())
+
+
+def get_duplicated_cells(path, nrow=3, ncol=3, shape=(30, 100, 100), overlap=20, seed=0):
+    # Cells on a jittered grid (at least 8 pixels apart), each tile detects the cells it contains with some noise
+    import types
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    step = np.array(shape) - np.array([shape[0], overlap, overlap])
+    extent = np.array(shape) + step * np.array([0, nrow-1, ncol-1])
+    grid = np.stack(np.meshgrid(*[np.arange(6, e - 5, 12) for e in extent], indexing='ij'), axis=-1).reshape(-1, 3)
+    cells = grid + rng.uniform(-2, 2, grid.shape)
+
+    tiles = types.SimpleNamespace(path=str(path), type='tiff3D', tiles_list=[], n_tiles=nrow*ncol, ncol=ncol,
+                                  nrow=nrow, neighbors=None, n_edges=0, path_list=[], frame_size=shape[1])
+    database = pd.DataFrame([(r, c, c*step[2], r*step[1], 0) for r in range(nrow) for c in range(ncol)],
+                            columns=['row', 'col', 'ABS_H', 'ABS_V', 'ABS_D'])
+    segmenter = paprica.multitileSegmenter(tiles, database, None, None, None, verbose=False)
+
+    detections = []
+    for r in range(nrow):
+        for c in range(ncol):
+            position = segmenter._get_tile_position(r, c)
+            inside = np.all((cells >= position) & (cells < position + shape), axis=1)
+            detections.append((cells[inside] - position + rng.normal(0, 0.5, (inside.sum(), 3)), position))
+
+    return segmenter, cells, detections
+
+
+def test_cells_deduplication(tmp_path):
+    from scipy.spatial import cKDTree
+
+    for method in ['flann', 'kdtree']:
+        segmenter, cells, detections = get_duplicated_cells(tmp_path)
+        segmenter.set_cells_matching(method=method)
+        for c, position in detections:
+            segmenter._add_cells(c, position, np.array([30, 100, 100]), lowe_ratio=0.7, distance_max=5)
+        segmenter._gather_cells()
+        assert(segmenter.cells.shape[0] == cells.shape[0])
+        assert(len(cKDTree(segmenter.cells).query_pairs(3)) == 0)
+
+
+def test_cells_matching_backends(tmp_path):
+    from paprica.segmenter import _match_cells
+
+    # Both backends find the same pairs on a fixed point set
+    segmenter, _, _ = get_duplicated_cells(tmp_path)
+    np.random.seed(0)
+    c1 = np.random.rand(1000, 3) * 500
+    c2 = np.vstack((c1[:500] + np.random.randn(500, 3) * 0.5, np.random.rand(500, 3) * 500 + 1000))
+    ind1_flann, ind2_flann = segmenter._find_duplicates_flann(c1, c2, lowe_ratio=0.7, distance_max=5)
+    ind1_kdtree, ind2_kdtree = _match_cells(c1, c2, lowe_ratio=0.7, distance_max=5, mutual=False)
+    assert((ind1_flann == ind1_kdtree).all() and (ind2_flann == ind2_kdtree).all())
+
+    # And remove the same duplicates when merging tiles
+    merged = {}
+    for method in ['flann', 'kdtree']:
+        segmenter, _, detections = get_duplicated_cells(tmp_path)
+        segmenter.set_cells_matching(method=method)
+        for c, position in detections:
+            segmenter._add_cells(c, position, np.array([30, 100, 100]), lowe_ratio=0.7, distance_max=5)
+        segmenter._gather_cells()
+        merged[method] = segmenter.cells
+    assert((merged['flann'] == merged['kdtree']).all())
+
+
+def test_train_classifier_validation():
+    import types
+
+    img = (np.random.rand(32, 64, 64)*100 + 100).astype('float32')
+    img[10:20, 20:30, 20:30] += 500
+    apr, parts = pyapr.converter.get_apr(img)
+    tile = types.SimpleNamespace(apr=apr, parts=parts, load_tile=lambda: None)
+    trainer = paprica.tileTrainer(tile, func_to_compute_features=compute_features)
+    trainer.pixel_list = np.concatenate((np.random.randint(0, [32, 64, 64], (200, 3)),
+                                         np.random.randint([10, 20, 20], [20, 30, 30], (50, 3))))
+    trainer.labels = np.concatenate((np.ones(200), np.full(50, 2))).astype('uint8')
+
+    # Holding out all the labelled particles leaves nothing to train on
+    try:
+        trainer.train_classifier(verbose=False, n_validation=250)
+        assert(False)
+    except ValueError:
+        pass
+    assert(trainer.f is None)
+
+    trainer.train_classifier(verbose=False, n_validation=20)
+    assert(trainer.clf is not None)
+
+
+def test_remove_ambiguities():
+    import types
+
+    img = (np.random.rand(16, 32, 32)*100 + 100).astype('float32')
+    apr, parts = pyapr.converter.get_apr(img)
+    tile = types.SimpleNamespace(apr=apr, parts=parts, load_tile=lambda: None)
+    trainer = paprica.tileTrainer(tile, func_to_compute_features=None)
+
+    # Particles labelled several times, some of them with different labels
+    rng = np.random.default_rng(0)
+    parts_train_idx = rng.integers(0, 500, 3000)
+    labels = (parts_train_idx % 3 + 1).astype('uint8')
+    ambiguous = rng.random(3000) < 0.02
+    labels[ambiguous] = rng.integers(1, 4, ambiguous.sum())
+
+    # Loop baseline
+    idx_expected, labels_expected = [], []
+    for idx in np.unique(parts_train_idx):
+        local_labels = np.unique(labels[parts_train_idx == idx])
+        if local_labels.size == 1:
+            idx_expected.append(idx)
+            labels_expected.append(local_labels[0])
+
+    trainer.parts_train_idx = parts_train_idx
+    trainer.labels = labels
+    trainer._remove_ambiguities(verbose=False)
+    assert(len(idx_expected) < 500)
+    assert((trainer.parts_train_idx == idx_expected).all())
+    assert((trainer.parts_labels == labels_expected).all())
+    assert((trainer.unique_labels == [1, 2, 3]).all())
+
+
+def test_measure_objects():
+    from paprica.segmenter import measure_objects
+
+    # Two boxes on a noisy background
+    rng = np.random.default_rng(0)
+    img = (rng.random((32, 64, 64))*100 + 100).astype('float32')
+    img[10:20, 20:30, 20:30] += 500
+    img[4:8, 40:50, 5:9] += 1000
+    apr, parts = pyapr.converter.get_apr(img, verbose=False)
+    mask = pyapr.ShortParticles((np.array(parts, copy=False) > 400).astype('uint16'))
+    cc = pyapr.LongParticles()
+    pyapr.measure.connected_component(apr, mask, cc)
+
+    df = measure_objects(apr, cc, parts)
+    assert((df['label'] == [1, 2]).all())
+    assert((df['volume'] == [1000, 160]).all())
+    assert(np.allclose(df[['z', 'y', 'x']], [[15, 25, 25], [6, 45, 7]]))
+    assert((df[['bbox_z0', 'bbox_y0', 'bbox_x0', 'bbox_z1', 'bbox_y1', 'bbox_x1']].to_numpy() ==
+            [[10, 20, 20, 20, 30, 30], [4, 40, 5, 8, 50, 9]]).all())
+
+    # Intensities are weighted by the particle volume, i.e. computed on the pixels
+    labels = np.array(pyapr.reconstruction.reconstruct_constant(apr, cc))
+    rec = np.array(pyapr.reconstruction.reconstruct_constant(apr, parts))
+    lvls = pyapr.ShortParticles(apr.total_number_particles())
+    lvls.fill_with_levels(apr)
+    lvls = np.array(lvls, copy=False)
+    cc_arr = np.array(cc, copy=False)
+    for i, row in df.iterrows():
+        assert(np.isclose(row['mean_intensity'], rec[labels == row['label']].mean(), rtol=1e-5))
+        assert(np.isclose(row['max_intensity'], rec[labels == row['label']].max()))
+        assert(row['n_particles'] == np.sum(cc_arr == row['label']))
+        assert(row['min_level'] == lvls[cc_arr == row['label']].min())
+        assert(row['max_level'] == lvls[cc_arr == row['label']].max())
+        assert(np.isclose(row['mean_level'], lvls[cc_arr == row['label']].mean()))
+
+
+def test_map_feature():
+    from paprica.segmenter import map_feature
+
+    img = (np.random.rand(32, 64, 64)*100 + 100).astype('float32')
+    img[10:20, 20:30, 20:30] += 500
+    img[4:8, 40:50, 5:9] += 1000
+    apr, parts = pyapr.converter.get_apr(img, verbose=False)
+    mask = pyapr.ShortParticles((np.array(parts, copy=False) > 400).astype('uint16'))
+    cc = pyapr.LongParticles()
+    pyapr.measure.connected_component(apr, mask, cc)
+    cc_arr = np.array(cc, copy=False)
+
+    # Integer features are painted as ShortParticles, float features as FloatParticles, background is 0
+    for features, particles_type in [(np.array([3, 65535]), pyapr.ShortParticles),
+                                     (np.array([True, False]), pyapr.ShortParticles),
+                                     (np.array([0.25, 1e6], dtype='float64'), pyapr.FloatParticles)]:
+        mapped = map_feature(apr, cc, features)
+        assert(isinstance(mapped, particles_type))
+        mapped = np.array(mapped, copy=False)
+        assert(mapped.size == apr.total_number_particles())
+        assert((mapped[cc_arr == 0] == 0).all())
+        assert((mapped[cc_arr == 1] == features[0]).all() and (mapped[cc_arr == 2] == features[1]).all())
+
+    # Integer features that do not fit in ShortParticles or of the wrong length are rejected
+    for features in [np.array([-1, 2]), np.array([1, 70000]), np.array([1, 2, 3])]:
+        try:
+            map_feature(apr, cc, features)
+            assert(False)
+        except ValueError:
+            pass
+
+
+def get_cc_from_mask(apr, parts_pred):
+    # Connected components of the particles classified as cells (class 2)
+    mask = pyapr.ShortParticles((np.array(parts_pred, copy=False) == 2).astype('uint16'))
+    cc = pyapr.LongParticles()
+    pyapr.measure.connected_component(apr, mask, cc)
+    return cc
+
+
+def get_segmentation_tiles(path, frame_size=64, overlap=25, n_planes=16):
+    # 2x2 tiles cropped from a volume with bright cubes and a classifier thresholding their intensity
+    from sklearn.ensemble import RandomForestClassifier
+    from paprica.segmenter import featureBank
+
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(0)
+    step = frame_size - int(overlap / 100 * frame_size)
+    data = (rng.random((n_planes, step + frame_size, step + frame_size)) * 100 + 100).astype('uint16')
+    for z, y, x in rng.integers(0, np.array(data.shape) - 4, (60, 3)):
+        data[z:z+4, y:y+4, x:x+4] += 1000
+    for v in range(2):
+        for h in range(2):
+            tile = np.ascontiguousarray(data[:, v*step:v*step+frame_size, h*step:h*step+frame_size])
+            apr, parts = pyapr.converter.get_apr(tile, verbose=False)
+            pyapr.io.write(os.path.join(path, '{}_{}.apr'.format(v, h)), apr, parts)
+
+    tiles = paprica.parser.tileParser(str(path), frame_size=frame_size, ftype='apr', verbose=False)
+    stitcher = paprica.stitcher.tileStitcher(tiles, overlap_h=overlap, overlap_v=overlap)
+    stitcher.compute_expected_registration()
+
+    bank = featureBank(['intensity', ('gaussian', 1)])
+    tile = tiles[0]
+    tile.load_tile()
+    x = bank(tile.apr, tile.parts)
+    clf = RandomForestClassifier(n_estimators=10, random_state=0).fit(x, (x[:, 0] > 600) + 1)
+    return tiles, stitcher.database, clf, bank
+
+
+def test_parallel_segmentation(tmp_path):
+    tiles, database, clf, bank = get_segmentation_tiles(tmp_path)
+
+    serial = paprica.multitileSegmenter(tiles, database, clf, bank, get_cc_from_mask, verbose=False)
+    serial.compute_multitile_segmentation(save_cc=False)
+    parallel = paprica.multitileSegmenter(tiles, database, clf, bank, get_cc_from_mask, verbose=False)
+    parallel.compute_multitile_segmentation(save_cc=False, n_jobs=2)
+    assert(serial.cells.shape[0] > 0)
+    assert(np.array_equal(serial.cells, parallel.cells))
+
+
+def test_cells_checkpoint_resume(tmp_path):
+    tiles, database, clf, bank = get_segmentation_tiles(tmp_path)
+
+    reference = paprica.multitileSegmenter(tiles, database, clf, bank, get_cc_from_mask, verbose=False)
+    reference.compute_multitile_segmentation(save_cc=False)
+
+    # Run interrupted on the third tile
+    calls = []
+
+    def get_cc_interrupted(apr, parts_pred):
+        calls.append(1)
+        if len(calls) == 3:
+            raise RuntimeError('Interrupted')
+        return get_cc_from_mask(apr, parts_pred)
+
+    segmenter = paprica.multitileSegmenter(tiles, database, clf, bank, get_cc_interrupted, verbose=False)
+    try:
+        segmenter.compute_multitile_segmentation(save_cc=False)
+        assert(False)
+    except RuntimeError:
+        pass
+
+    # A new segmenter resumes from the checkpoint and only segments the remaining tiles
+    resumed = paprica.multitileSegmenter(tiles, database, clf, bank, get_cc_interrupted, verbose=False)
+    assert(resumed.load_cells_checkpoint() == {(0, 0), (0, 1)})
+    calls.clear()
+    resumed.compute_multitile_segmentation(save_cc=False, resume=True)
+    assert(len(calls) == 2)
+    assert(np.array_equal(reference.cells, resumed.cells))
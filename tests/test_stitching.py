@@ -10,6 +10,7 @@ from time import time
 import paprica
 import pandas as pd
 import os
+import numpy as np
 
 
 def test_main():
@@ -49,4 +50,73 @@ def test_main():
     assert(stitcher1.ncol == tiles.ncol)
     assert(stitcher1.frame_size == tiles.frame_size)
     assert(stitcher1.n_edges == tiles.n_edges)
-    assert(stitcher1.n_vertex == tiles.n_tiles)
\ No newline at end of file
+    assert(stitcher1.n_vertex == tiles.n_tiles)
+
+
+def test_centroid_registration():
+    # Synthetic centroids seen by two neighboring tiles
+    rng = np.random.default_rng(0)
+    cells = rng.random((200, 3)) * [300, 500, 150]
+    d = np.array([3, -4, 12])
+    cells1 = cells + rng.normal(0, 0.3, cells.shape)
+    cells2 = cells - d + rng.normal(0, 0.3, cells.shape)
+
+    reg, rel = paprica.stitcher._get_centroid_shifts(cells1, cells2, d_expected=[0, 0, 10], search_radius=25)
+    assert(np.all(np.abs(reg - d) < 0.5))
+    assert(np.all(rel < 1))
+
+    # Negative shift with spurious detections on both tiles
+    d = np.array([-2, 5, 8])
+    cells1 = np.vstack((cells + rng.normal(0, 0.3, cells.shape), rng.random((100, 3)) * [300, 500, 150]))
+    cells2 = np.vstack((cells - d + rng.normal(0, 0.3, cells.shape), rng.random((100, 3)) * [300, 500, 150]))
+    reg, rel = paprica.stitcher._get_centroid_shifts(cells1, cells2, d_expected=[0, 0, 10], search_radius=25)
+    assert(np.all(np.abs(reg - d) < 0.5))
+    assert(np.all(rel > 0) and np.all(rel < 1))
+
+    # Few matching cells among many outliers are less reliable but still bounded
+    cells1 = np.vstack((cells[:20] + rng.normal(0, 0.3, (20, 3)), rng.random((200, 3)) * [300, 500, 150]))
+    cells2 = np.vstack((cells[:20] - d + rng.normal(0, 0.3, (20, 3)), rng.random((200, 3)) * [300, 500, 150]))
+    reg_out, rel_out = paprica.stitcher._get_centroid_shifts(cells1, cells2, d_expected=[0, 0, 10], search_radius=25)
+    assert(np.all(np.abs(reg_out - d) < 0.5))
+    assert(np.all(rel_out > rel) and np.all(rel_out < 1))
+
+    # Not enough cells to register
+    reg, rel = paprica.stitcher._get_centroid_shifts(cells1[:3], cells2, d_expected=[0, 0, 10], search_radius=25)
+    assert(np.all(reg == [0, 0, 10]))
+    assert(np.all(rel == 2))
+
+
+def test_slab_cache(tmp_path):
+    # Cached reads must match direct LazySlicer reads, including concurrent reads of the same tile
+    from concurrent.futures import ThreadPoolExecutor
+    import pyapr
+    rng = np.random.default_rng(0)
+    img = (rng.random((64, 48, 40)) * 1000).astype('uint16')
+    apr, parts = pyapr.converter.get_apr(img)
+    tree_parts = pyapr.tree.fill_tree_mean(apr, parts, pyapr.FloatParticles())
+    path = str(tmp_path / 'tile.apr')
+    pyapr.io.write(path, apr, parts, write_tree=True, tree_parts=tree_parts)
+    slicer = pyapr.reconstruction.LazySlicer(path, level_delta=0, parts_name='particles',
+                                             tree_parts_name='particles')
+    full = np.array(slicer[0:slicer.shape[0]])
+
+    requests = [(0, 10, 14), (0, 12, 13), (0, 30, 50), (1, 20, 22), (2, 15, 16), (0, 10, 14)]
+    for slab_size in [None, 16]:
+        cache = paprica.stitcher.slabCache(slab_size=slab_size, n_threads=4)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            data = list(executor.map(lambda r: cache.read(path, 0, 'particles', *r), requests * 4))
+        for (dim, begin, end), d in zip(requests * 4, data):
+            sl = [slice(None)] * 3
+            sl[dim] = slice(begin, end)
+            assert(np.array_equal(d, full[tuple(sl)]))
+
+    # Consecutive planes are read from the same slab with the default slab size
+    cache = paprica.stitcher.slabCache()
+    for z in range(3, 8):
+        assert(np.array_equal(cache.read(path, 0, 'particles', 0, z, z + 1), full[z:z+1]))
+    assert(len(cache.slabs) == 1)
+
+    # Slabs larger than the memory budget are not cached
+    cache = paprica.stitcher.slabCache(max_memory=1)
+    cache.read(path, 0, 'particles', 0, 0, 4)
+    assert(cache.memory == 0 and len(cache.slabs) == 0)